@@ -1,7 +1,21 @@
 import sys
 import os
+import functools
+import mmap
+import stat
+import multiprocessing
+import itertools
+import time
+import json
+import re
+import fnmatch
+import array
+import bisect
+import hashlib
+import threading
 
 class Node:
+    __slots__ = () # Nodes are small and numerous; subclasses list their fields
     def __repr__(self):
         # A generic representation, can be overwritten by subclasses
         return self.__class__.__name__
@@ -11,19 +25,23 @@ class Node:
     def walk(self):
         yield self
         for child in self.children:
-            yield from child.walk()
+            if child is not None: # Empty groups/branches are stored as None
+                yield from child.walk()
 
 class DotNode(Node):
+    __slots__ = ()
     def __repr__(self):
         return "DotNode()"
 
 class LiteralNode(Node):
+    __slots__ = ('char',)
     def __init__(self, char):
         self.char = char
     def __repr__(self):
         return f"LiteralNode('{self.char}')"
 
 class CaptureGroupNode(Node):
+    __slots__ = ('_child', 'index')
     def __init__(self, child, index):
         self._child = child # A single Node representing the group's content
         self.index = index # The index of this capturing
@@ -34,21 +52,34 @@ class CaptureGroupNode(Node):
         return f"CaptureGroupNode(index={self.index}, child={self.children[0]!r})"
        
 class CharClassNode(Node): # For /d, /w, etc.
+    __slots__ = ('type', 'char_class')
     def __init__(self, type):
-        self.type = type # 'digit', 'word', etc.
+        self.type = type # 'digit', 'word', 'space', 'non-digit', 'non-word' or 'non-space'
+        self.char_class = named_char_class(type)
     def __repr__(self):
         return f"CharClassNode(type='{self.type}')"
 
 class CharSetNode(Node): # For [...]
-    def __init__(self, chars, negated):
-        self.chars = chars
+    __slots__ = ('chars', 'negated', 'ranges', 'classes', 'char_class')
+    def __init__(self, chars, negated, ranges=(), classes=()):
+        self.chars = set(chars)
         self.negated = negated
+        self.ranges = tuple(ranges) # (first, last) character pairs, e.g. ('a', 'z')
+        self.classes = tuple(classes) # CharClassNode types from escapes such as [\d_]
+        self.char_class = CharClass(chars, self.ranges, self.classes, negated)
         # self.rest = rest
     def __repr__(self):
-        return f"CharSetNode(chars={self.chars}, negated={self.negated})"
+        extra = ""
+        if self.ranges:
+            extra += f", ranges={list(self.ranges)}"
+        if self.classes:
+            extra += f", classes={list(self.classes)}"
+        # Sorted: set order changes between runs, and the result cache keys on this repr.
+        return f"CharSetNode(chars={sorted(self.chars)}, negated={self.negated}{extra})"
         # return f"CharSetNode(chars={self.chars}, negated={self.negated}, rest={self.rest})"
 
 class ConcatenationNode(Node):
+    __slots__ = ('_children',)
     def __init__(self, children):
         self._children = children # List of Nodes
     @property
@@ -59,6 +90,7 @@ class ConcatenationNode(Node):
         
 
 class BackreferenceNode(Node):
+    __slots__ = ('index',)
     def __init__(self, index):
         self.index = index # The number of the group to refer to (e.g., 1 for \1)
     def __repr__(self):
@@ -66,12 +98,14 @@ class BackreferenceNode(Node):
 
 
 class AnchorNode(Node):
+    __slots__ = ('type',)
     def __init__(self, type):
         self.type = type # 'start', 'end'
     def __repr__(self):
         return f"AnchorNode(type='{self.type}')"
 
 class AlternationNode(Node):
+    __slots__ = ('_branches',)
     def __init__(self, branches):
         self._branches = branches # List of Nodes (each a branch)
     @property
@@ -80,18 +114,36 @@ class AlternationNode(Node):
     def __repr__(self):
         return f"AlternationNode(branches='{self.children!r}')"
 
+QUANTIFIER_COUNTS = {'ONE_OR_MORE': (1, None), 'ZERO_OR_MORE': (0, None), 'ZERO_OR_ONE': (0, 1)}
+
 class QuantifierNode(Node):
-    def __init__(self, child, type, greedy=True):
+    __slots__ = ('_child', 'type', 'greedy', 'min_count', 'max_count')
+    def __init__(self, child, type, greedy=True, min_count=None, max_count=None):
         self._child = child
-        self.type = type # e.g., 'ONE_OR_MORE', 'ZERO_OR_MORE', 'ZERO_OR_ONE'
-        self.greedy = greedy # For future non-greedy support
+        self.type = type # 'ONE_OR_MORE', 'ZERO_OR_MORE', 'ZERO_OR_ONE', or 'COUNTED' for {n}, {n,} and {n,m}
+        self.greedy = greedy # False for lazy quantifiers such as *? and {n,m}?
+        # The allowed number of repetitions; max_count is None when unbounded.
+        self.min_count, self.max_count = QUANTIFIER_COUNTS.get(type, (min_count, max_count))
     @property
     def children(self):
         return [self._child]
     def __repr__(self):
-        return f"QuantifierNode(child={self.children[0]!r}, type='{self.type}', greedy={self.greedy})"
+        counts = f", min_count={self.min_count}, max_count={self.max_count}" if self.type == 'COUNTED' else ""
+        return f"QuantifierNode(child={self.children[0]!r}, type='{self.type}', greedy={self.greedy}{counts})"
+
+@functools.lru_cache(maxsize=4096)
+def leaf(node_class, *args):
+    """
+    The shared instance of a leaf node. Leaves hold no per-pattern state, so the parser
+    interns them: every pattern reuses one LiteralNode('a'), one DotNode() and one
+    CharSetNode (with its CharClass tables) per distinct set. Arguments must be hashable.
+    """
+    return node_class(*args)
 
 
+MAX_REPEAT = 65535 # Largest count accepted in {n,m}
+COUNTS_RE = re.compile(r'\{([0-9]*)(,?)([0-9]*)\}')
+
 class RegexParser: 
     def __init__(self, pattern):
         self.pattern = pattern
@@ -155,13 +207,13 @@ class RegexParser:
         elif char == '\\':
             node = self._parse_escape_sequence()
         elif char == '.':
-            node = DotNode()
+            node = leaf(DotNode)
             self._consume('.')
         elif char in '^$': # Anchors are atoms
-            node = AnchorNode('start' if char == '^' else 'end')
+            node = leaf(AnchorNode, 'start' if char == '^' else 'end')
             self._consume(char)
         else: # Literal character
-            node = LiteralNode(char)
+            node = leaf(LiteralNode, char)
             self._consume(char)
 
         # Check for quantifiers only if a node was successfully parsed AND
@@ -169,17 +221,48 @@ class RegexParser:
         if node: # Ensure 'node' was successfully created
             next_char = self._peek() # Get the next character after the atom
             if next_char is not None and next_char in '+*?': # Safely check if it's a quantifier
-                quantifier_type = next_char
-                self._consume(quantifier_type)
-                if quantifier_type == '+':
-                    return QuantifierNode(node, 'ONE_OR_MORE')
-                elif quantifier_type == '*':
-                    return QuantifierNode(node, 'ZERO_OR_MORE')
-                elif quantifier_type == '?':
-                    return QuantifierNode(node, 'ZERO_OR_ONE')
-        
+                self._consume(next_char)
+                counts = {'+': (1, None), '*': (0, None), '?': (0, 1)}[next_char]
+            elif next_char == '{':
+                counts = self._parse_counts()
+                if counts is None:
+                    return node # Not a repetition: the '{' is read as a literal next
+            else:
+                return node
+            greedy = True
+            if self._peek() == '?': # Lazy: *?, +?, ??, {n,m}?
+                self._consume('?')
+                greedy = False
+            return self._quantify(node, counts, greedy)
+
         return node # Return the atom node (possibly quantified)
 
+    def _parse_counts(self):
+        # {n}, {n,}, {n,m} or {,m} at the current position, as (min_count, max_count).
+        # Anything else is left unconsumed and returns None, like Python's re.
+        match = COUNTS_RE.match(self.pattern, self.pos)
+        if match is None or not (match.group(1) or match.group(3)): # '{}' and '{,}' are literals
+            return None
+        self.pos = match.end()
+        low, comma, high = match.groups()
+        min_count = int(low) if low else 0
+        max_count = min_count if not comma else (int(high) if high else None)
+        if max(min_count, max_count or 0) > MAX_REPEAT:
+            raise ValueError(f"Repetition count larger than {MAX_REPEAT} at pos {match.start()}")
+        if max_count is not None and max_count < min_count:
+            raise ValueError(f"Repetition minimum larger than maximum at pos {match.start()}")
+        return min_count, max_count
+
+    @staticmethod
+    def _quantify(node, counts, greedy):
+        # The usual counts keep their own types, which every engine special-cases.
+        if counts == (1, 1):
+            return node
+        for type, type_counts in QUANTIFIER_COUNTS.items():
+            if counts == type_counts:
+                return QuantifierNode(node, type, greedy)
+        return QuantifierNode(node, 'COUNTED', greedy, *counts)
+
     def _parse_char_set(self):
         self._consume('[')
         negated = False
@@ -187,33 +270,54 @@ class RegexParser:
             self._consume('^')
             negated = True 
         chars = set()
+        ranges = []
+        classes = []
         while self.pos < len(self.pattern) and self._peek() != ']':
-            # Add range support here: e.g., [a-z] 
-            chars.add(self._peek())
-            self._consume(self._peek())
+            char = self._parse_set_char()
+            if char in ESCAPE_CLASSES.values():
+                classes.append(char) # \d, \w, \s and their negations inside the set
+                continue
+            # 'a-z' is a range; a '-' at either end of the set is a literal.
+            if self._peek() == '-' and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != ']':
+                self._consume('-')
+                last = self._parse_set_char()
+                if last in ESCAPE_CLASSES.values() or last < char:
+                    raise ValueError(f"Invalid range in character set at pos {self.pos}")
+                ranges.append((char, last))
+            else:
+                chars.add(char)
         self._expect(']')
         # rest = self[i+1:]
-        return CharSetNode(chars, negated)
+        return leaf(CharSetNode, frozenset(chars), negated, tuple(ranges), tuple(classes))
+
+    def _parse_set_char(self):
+        # Returns the next character of a [...] set, or a class type for \d, \w, \s, \D, \W, \S.
+        char = self._peek()
+        self._consume(char)
+        if char != '\\':
+            return char
+        escaped_char = self._peek()
+        if escaped_char is None:
+            raise ValueError("Incomplete escape sequence")
+        self._consume(escaped_char)
+        return ESCAPE_CLASSES.get(escaped_char, escaped_char)
 
     def _parse_escape_sequence(self):
         self._consume('\\')
         escaped_char = self._peek()
-        print(f"escaped_char: {escaped_char}", file=sys.stderr)
+        if DEBUG:
+            debug(f"escaped_char: {escaped_char}")
         if escaped_char is None:
             raise ValueError("Incomplete escape sequence")
 
         if escaped_char.isdigit():
             self._consume(escaped_char)
-            return BackreferenceNode(int(escaped_char))
+            return leaf(BackreferenceNode, int(escaped_char))
 
         self._consume(escaped_char)
-        if escaped_char == 'd':
-            print("digit", file=sys.stderr)
-            return CharClassNode('digit')
-        elif escaped_char == 'w':
-            return CharClassNode('word')
-        # Add more escape sequences as needed: \s, \S, \D, \W, \. etc.
-        return LiteralNode(escaped_char) # For escaped literal chars like '\+'
+        if escaped_char in ESCAPE_CLASSES: # \d, \w, \s, \D, \W, \S
+            return leaf(CharClassNode, ESCAPE_CLASSES[escaped_char])
+        return leaf(LiteralNode, escaped_char) # For escaped literal chars like '\+'
 
     def _peek(self):
         if self.pos < len(self.pattern):
@@ -260,268 +364,3618 @@ def _is_digit(char):
 def _is_word_char(char):
     return char.isalnum() or char == '_'
 
-def match_possibilities(ast_node, input_line, start_idx, captures):
+# --- Character classes ---
+# Character sets ([a-z0-9_], [^,]) and classes (\d, \w, \s and their negations) are compiled
+# into a CharClass. Membership of Latin-1 characters, which make up nearly all log text, is
+# one lookup in a 256-entry table; only other Unicode characters fall back to testing the
+# ranges and str methods. Small sets are expanded into a frozenset instead, which is faster
+# still, and lets the prefilter and start filter treat them as a few literal characters;
+# small negated sets keep the frozenset of the characters they exclude.
+
+def _is_space(char):
+    return char.isspace()
+
+CLASS_TESTS = {'digit': _is_digit, 'word': _is_word_char, 'space': _is_space}
+NEGATED_CLASSES = {'non-digit': 'digit', 'non-word': 'word', 'non-space': 'space'}
+ESCAPE_CLASSES = {'d': 'digit', 'w': 'word', 's': 'space',
+                  'D': 'non-digit', 'W': 'non-word', 'S': 'non-space'}
+MAX_EXPANDED_SET = 256 # Larger sets and ranges are not expanded into a frozenset
+
+class CharClass:
     """
-    Return a list of (end_idx, captures_snapshot) representing all ways ast_node can match input_line[start_idx:].
+    A set of characters made of single characters, (first, last) ranges and class types,
+    possibly negated. contains(ch) is the fastest membership test for the set.
     """
-    results = []
+    def __init__(self, chars=(), ranges=(), classes=(), negated=False):
+        self.chars = frozenset(chars)
+        self.ranges = tuple(ranges)
+        self.classes = tuple(classes)
+        self.negated = negated
+        expanded = self._expand()
+        self.members = None if negated else expanded # frozenset of every member, or None
+        self.excluded = expanded if negated else None # frozenset of every non-member, or None
+        self.table = tuple(self._matches(chr(code)) for code in range(256))
+        if self.members is not None:
+            self.contains = self.members.__contains__
+        elif self.excluded is not None:
+            excluded = self.excluded
+            self.contains = lambda ch: ch not in excluded
+        else:
+            table, fallback = self.table, self._matches
+            def contains(ch):
+                code = ord(ch)
+                return table[code] if code < 256 else fallback(ch)
+            self.contains = contains
+
+    def __reduce__(self):
+        # contains may be a closure, so a class pickles as its definition and is rebuilt.
+        if not self.chars and not self.ranges and len(self.classes) == 1 and not self.negated:
+            return named_char_class, self.classes
+        return CharClass, (self.chars, self.ranges, self.classes, self.negated)
+
+    def _expand(self):
+        # The characters of the set ignoring negation, if there are few enough to list.
+        if self.classes:
+            return None
+        if len(self.chars) + sum(ord(last) - ord(first) + 1 for first, last in self.ranges) > MAX_EXPANDED_SET:
+            return None
+        members = set(self.chars)
+        for first, last in self.ranges:
+            members.update(chr(code) for code in range(ord(first), ord(last) + 1))
+        return frozenset(members)
+
+    def _matches(self, ch):
+        # The Unicode fallback, also used to fill the table.
+        return self._in_set(ch) != self.negated
+
+    def _in_set(self, ch):
+        if ch in self.chars:
+            return True
+        for first, last in self.ranges:
+            if first <= ch <= last:
+                return True
+        for name in self.classes:
+            if name in NEGATED_CLASSES:
+                if not CLASS_TESTS[NEGATED_CLASSES[name]](ch):
+                    return True
+            elif CLASS_TESTS[name](ch):
+                return True
+        return False
+
+    def __contains__(self, ch):
+        return self.contains(ch)
+
+    @property
+    def mostly_matches(self):
+        """True for negated sets and classes, which match nearly every character."""
+        return self.negated or any(name in NEGATED_CLASSES for name in self.classes)
+
+    def __repr__(self):
+        return (f"CharClass(chars={sorted(self.chars)}, ranges={list(self.ranges)}, "
+                f"classes={list(self.classes)}, negated={self.negated})")
+
+@functools.lru_cache(maxsize=None)
+def named_char_class(name):
+    """The shared CharClass for a class type such as 'digit' or 'non-space'."""
+    return CharClass(classes=(name,))
 
-    # Literal
+def _char_test(ast_node):
+    """Returns a predicate for nodes that match exactly one character, or None."""
     if isinstance(ast_node, LiteralNode):
-        if start_idx < len(input_line) and input_line[start_idx] == ast_node.char:
-            results.append((start_idx+1, captures[:]))
-        return results
-
-    # CharClassNode
-    if isinstance(ast_node, CharClassNode):
-        if start_idx < len(input_line):
-            ch = input_line[start_idx]
-            ok = (ast_node.type == 'digit' and _is_digit(ch)) or (ast_node.type == 'word' and _is_word_char(ch))
-            if ok:
-                results.append((start_idx+1, captures[:]))
-        return results
-
-    # CharSetNode
-    if isinstance(ast_node, CharSetNode):
-        if start_idx < len(input_line):
-            ch = input_line[start_idx]
-            is_in = ch in ast_node.chars
-            if is_in != ast_node.negated:
-                results.append((start_idx+1, captures[:]))
-        return results
-
-    # Dot
+        return lambda ch: ch == ast_node.char
+    if isinstance(ast_node, (CharClassNode, CharSetNode)):
+        return ast_node.char_class.contains
     if isinstance(ast_node, DotNode):
-        if start_idx < len(input_line):
-            results.append((start_idx+1, captures[:]))
-        return results
+        return lambda ch: True
+    return None
+
+def match_possibilities(ast_node, input_line, start_idx, captures, memo=None):
+    """
+    Lazily yields (end_idx, captures) for every way ast_node can match input_line[start_idx:],
+    in priority order: alternation branches left to right, greedy quantifiers longest first.
+
+    captures is a capture store: a list of 2 * (group_count + 1) slots, holding the start
+    and end of group i at 2*i and 2*i+1 (None if unset), like Pike VM slots. There is one
+    store per search. A group sets its slots before yielding and restores them when it is
+    resumed, so the store always describes the possibility being explored and nothing is
+    copied while backtracking. The yielded store must be read before the generator is
+    resumed. Callers that only need the first match stop iterating, so the remaining
+    possibilities are never computed. With a BacktrackMemo, subtrees it covers are
+    evaluated once per position.
+    """
+    if memo is not None and id(ast_node) in memo.memoable:
+        return memo.possibilities(ast_node, (id(ast_node), start_idx), captures,
+                                  lambda caps: _match_node(ast_node, input_line, start_idx, caps, memo))
+    return _match_node(ast_node, input_line, start_idx, captures, memo)
+
+def _match_node(ast_node, input_line, start_idx, captures, memo):
+    # Empty group or branch, e.g. "()" or "a|": matches the empty string
+    if ast_node is None:
+        yield start_idx, captures
+        return
+
+    test = _char_test(ast_node)
+    if test is not None:
+        # Literal, CharClassNode, CharSetNode, Dot
+        if start_idx < len(input_line) and test(input_line[start_idx]):
+            yield start_idx + 1, captures
+        return
 
     # Backreference
     if isinstance(ast_node, BackreferenceNode):
-        if ast_node.index < len(captures) and captures[ast_node.index] is not None:
-            text = captures[ast_node.index]
+        slot = 2 * ast_node.index
+        if slot < len(captures) and captures[slot] is not None:
+            text = input_line[captures[slot]:captures[slot + 1]]
             if input_line.startswith(text, start_idx):
-                results.append((start_idx + len(text), captures[:]))
-        return results
+                yield start_idx + len(text), captures
+        return
 
     # Anchor
     if isinstance(ast_node, AnchorNode):
-        if ast_node.type == 'start':
-            if start_idx == 0:
-                results.append((start_idx, captures[:]))
-            return results
-        elif ast_node.type == 'end':
-            if start_idx == len(input_line):
-                results.append((start_idx, captures[:]))
-            return results
+        if ast_node.type == 'start' and start_idx == 0:
+            yield start_idx, captures
+        elif ast_node.type == 'end' and start_idx == len(input_line):
+            yield start_idx, captures
+        return
 
     # Capture group
     if isinstance(ast_node, CaptureGroupNode):
-        child_poss = match_possibilities(ast_node._child, input_line, start_idx, captures)
-        for end_idx, cap_snap in child_poss:
-            new_snap = cap_snap[:]
-            while len(new_snap) <= ast_node.index:
-                new_snap.append(None)
-            new_snap[ast_node.index] = input_line[start_idx:end_idx]
-            results.append((end_idx, new_snap))
-        return results
+        slot = 2 * ast_node.index
+        for end_idx, child_caps in match_possibilities(ast_node._child, input_line, start_idx, captures, memo):
+            saved_start, saved_end = child_caps[slot], child_caps[slot + 1]
+            child_caps[slot], child_caps[slot + 1] = start_idx, end_idx
+            yield end_idx, child_caps
+            child_caps[slot], child_caps[slot + 1] = saved_start, saved_end
+        return
 
     if isinstance(ast_node, QuantifierNode):
-        results = []
-
-        # ZERO_OR_ONE
-        if ast_node.type == 'ZERO_OR_ONE':
-            # Zero occurrences
-            results.append((start_idx, captures[:]))
-            # One occurrence
-            for end_idx, cap_snapshot in match_possibilities(ast_node._child, input_line, start_idx, captures):
-                results.append((end_idx, cap_snapshot[:]))
-            return results
-
-        # ONE_OR_MORE
-        elif ast_node.type == 'ONE_OR_MORE':
-            # First, get the first match
-            first_matches = match_possibilities(ast_node._child, input_line, start_idx, captures)
-            for end_idx, cap_snapshot in first_matches:
-                results.append((end_idx, cap_snapshot[:]))  # at least one occurrence
-                # Now try more matches recursively
-                more_matches = match_possibilities(ast_node, input_line, end_idx, cap_snapshot)
-                for more_end_idx, more_cap_snapshot in more_matches:
-                    results.append((more_end_idx, more_cap_snapshot[:]))
-            return results
-
-        # ZERO_OR_MORE
-        elif ast_node.type == 'ZERO_OR_MORE':
-            # Zero occurrences
-            results.append((start_idx, captures[:]))
-            # One or more occurrences
-            first_matches = match_possibilities(ast_node._child, input_line, start_idx, captures)
-            for end_idx, cap_snapshot in first_matches:
-                results.append((end_idx, cap_snapshot[:]))
-                more_matches = match_possibilities(ast_node, input_line, end_idx, cap_snapshot)
-                for more_end_idx, more_cap_snapshot in more_matches:
-                    results.append((more_end_idx, more_cap_snapshot[:]))
-            return results
+        yield from _match_repeat(ast_node, input_line, start_idx, captures,
+                                 ast_node.min_count, ast_node.max_count, memo)
+        return
 
     # Concatenation
     if isinstance(ast_node, ConcatenationNode):
-        results = []
-        # print(f"ast_node: {ast_node}", file=sys.stderr)
-        def match_from_child(child_idx, pos, caps):
-            if child_idx == len(ast_node.children):
-                results.append((pos, caps[:]))
-                return
+        yield from _match_sequence(ast_node.children, 0, input_line, start_idx, captures, memo)
+        return
 
-            child = ast_node.children[child_idx]
-            matches = match_possibilities(child, input_line, pos, caps)
+    # Alternation
+    if isinstance(ast_node, AlternationNode):
+        for branch in ast_node._branches:
+            yield from match_possibilities(branch, input_line, start_idx, captures, memo)
+        return
 
-            # --- FIX 1: IMPLEMENT GREEDY MATCHING ---
-            # For greedy quantifiers, try the longest possible match first.
-            # We reverse the list of matches because they are generated from
-            # shortest to longest.
-            if isinstance(child, QuantifierNode) and child.greedy:
-                matches.reverse()
+def _match_sequence(children, child_idx, input_line, pos, captures, memo):
+    # Matches children[child_idx:] one after another; depth grows with the number of children.
+    if child_idx == len(children):
+        yield pos, captures
+        return
+    for end_idx, child_caps in match_possibilities(children[child_idx], input_line, pos, captures, memo):
+        yield from _match_sequence(children, child_idx + 1, input_line, end_idx, child_caps, memo)
 
-            for end_idx, cap_snapshot in matches:
-                match_from_child(child_idx + 1, end_idx, cap_snapshot)
-        # print(f"captures: {captures}", file=sys.stderr)
-        match_from_child(0, start_idx, captures)
-        # print(f"results: {results}", file=sys.stderr)
-        return results
+def _match_repeat(node, input_line, pos, captures, min_count, max_count, memo):
+    """
+    Yields the ways node's child can repeat between min_count and max_count (None for
+    unbounded) times from pos, preferring more repetitions if node is greedy.
+    """
+    test = _char_test(node._child)
+    if test is not None:
+        # Single-character child: find the longest run iteratively instead of recursing.
+        end = pos
+        limit = len(input_line) if max_count is None else min(len(input_line), pos + max_count)
+        while end < limit and test(input_line[end]):
+            end += 1
+        ends = range(end, pos + min_count - 1, -1)
+        for end_idx in (ends if node.greedy else reversed(ends)):
+            yield end_idx, captures
+        return
 
+    child = lambda line, start, caps: match_possibilities(node._child, line, start, caps, memo)
+    yield from _repeat_possibilities(child, input_line, pos, captures, min_count, max_count, node.greedy)
 
-    # Alternation
-    if isinstance(ast_node, AlternationNode):
-        for branch in ast_node._branches:
-            branch_poss = match_possibilities(branch, input_line, start_idx, captures)
-            for end_idx, cap_snap in branch_poss:
-                results.append((end_idx, cap_snap))
-        return results
+def _repeat_possibilities(child, line, pos, captures, min_count, max_count, greedy):
+    """
+    Yields the ways child, a generator function called like match_possibilities, can repeat
+    between min_count and max_count (None for unbounded) times from pos, preferring more
+    repetitions if greedy.
+
+    Each repetition is a frame on an explicit stack instead of a nested generator, so long
+    lines like "abab...ab" under (ab)+ do not recurse once per repetition: the call depth
+    depends on the pattern's nesting, not on the input. What a frame yields depends only on
+    its position, remaining counts and the capture store, so a frame another path already
+    explored is skipped: it would repeat earlier possibilities. The frames and the explored
+    set are on the heap and grow with the positions one call reaches, i.e. linearly in the
+    length of the line; they are dropped when the call returns.
+    """
+    explored = set()
+    frames = [[pos, min_count, max_count, None]] # [pos, min_count, max_count, child possibilities]
+    while frames:
+        frame = frames[-1]
+        pos, min_count, max_count, iterations = frame
+        if iterations is None:
+            if not greedy and min_count == 0:
+                yield pos, captures
+            iterations = child(line, pos, captures) if max_count is None or max_count > 0 else iter(())
+            frame[3] = iterations
+        for end_idx, captures in iterations:
+            if end_idx == pos:
+                # An empty iteration makes no progress; it can only satisfy the minimum.
+                if min_count > 0:
+                    yield end_idx, captures
+                continue
+            state = (end_idx, max(min_count - 1, 0), None if max_count is None else max_count - 1)
+            key = state + tuple(captures)
+            if key not in explored:
+                explored.add(key)
+                frames.append([*state, None])
+                break
+        else:
+            frames.pop()
+            if greedy and min_count == 0:
+                yield pos, captures
 
-    return results
+# --- Backtracking memo ---
+# Patterns with a backreference must backtrack, but most of their subexpressions contain
+# no backreference. What such a subtree can match from a position does not depend on the
+# captures made before it, so its possibilities are computed once per (node, position),
+# stored as end positions plus the capture spans it sets, and replayed whenever the
+# backtracker comes back to the same place.
 
-def match_entire_ast(ast, input_line, parser):
-    # Try to match the pattern starting from every position in the input string.
-    # If the pattern starts with '^', we only try from the beginning.
-    if parser.pattern.startswith('^'):
-        start_positions = [0]
+MEMO_MAX_ENTRIES = 100000 # Per-line limit on cached (node, position) results
+
+_UNSET = object() # Marks capture groups not yet set inside a memoized subtree
+
+def _analyze_memoable(ast):
+    """
+    Returns {id(node): capture group indices inside node} for the compound subtrees that
+    contain no backreference.
+    """
+    memoable = {}
+    def visit(node):
+        # Returns (capture indices in node, whether node is backreference free).
+        if node is None:
+            return (), True
+        groups, free = [], True
+        for child in node.children:
+            child_groups, child_free = visit(child)
+            groups.extend(child_groups)
+            free = free and child_free
+        if isinstance(node, BackreferenceNode):
+            return (), False
+        if isinstance(node, CaptureGroupNode):
+            groups.append(node.index)
+        if free and isinstance(node, (ConcatenationNode, AlternationNode, QuantifierNode, CaptureGroupNode)):
+            memoable[id(node)] = tuple(sorted(set(groups)))
+        return groups, free
+    visit(ast)
+    return memoable
+
+class BacktrackMemo:
+    """
+    Caches the possibilities of backreference-free subtrees as (end_idx, spans) pairs in
+    priority order. The groups inside a subtree are numbered consecutively, so their
+    capture store slots form one range, and spans holds the values of that range (with
+    _UNSET starts for groups the possibility does not set). Duplicate pairs are dropped:
+    they would only repeat the same continuation. reset() must be called between lines;
+    the counters are kept.
+    """
+    def __init__(self, ast, max_entries=MEMO_MAX_ENTRIES):
+        self.ast = ast # Keeps the nodes behind the ids in memoable alive
+        self.memoable = _analyze_memoable(ast)
+        # The capture store slots of the groups inside each memoable node, as a (start, end) range
+        self.slot_ranges = {key: (2 * groups[0], 2 * groups[-1] + 2) if groups else None
+                            for key, groups in self.memoable.items()}
+        self.max_entries = max_entries
+        self.table = {}
+        self.hits = 0 # Each hit is a subtree evaluation the memo saved
+        self.misses = 0
+        self.overflows = 0 # Results not stored because the table was full
+
+    def reset(self):
+        self.table.clear()
+
+    def possibilities(self, node, key, captures, compute):
+        """
+        Yields the possibilities stored under key, applied to the capture store (which is
+        restored between them, see match_possibilities). On a miss they are computed with
+        compute(captures), while the groups inside node are marked unset.
+        """
+        entry = self.table.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._compute(node, captures, compute)
+            if len(self.table) < self.max_entries:
+                self.table[key] = entry
+            else:
+                self.overflows += 1
+        else:
+            self.hits += 1
+        slots = self.slot_ranges[id(node)]
+        if slots is None:
+            for end_idx, _ in entry:
+                yield end_idx, captures
+            return
+        first, last = slots
+        saved = captures[first:last]
+        for end_idx, spans in entry:
+            if _UNSET not in spans:
+                captures[first:last] = spans
+            else:
+                for slot in range(first, last, 2):
+                    if spans[slot - first] is not _UNSET:
+                        captures[slot], captures[slot + 1] = spans[slot - first], spans[slot - first + 1]
+            yield end_idx, captures
+            captures[first:last] = saved
+
+    def _compute(self, node, captures, compute):
+        # Returns the memo entry of node (see the class docstring).
+        entry = []
+        seen = set()
+        slots = self.slot_ranges[id(node)]
+        if slots is None:
+            for end_idx, _ in compute(captures):
+                if end_idx not in seen:
+                    seen.add(end_idx)
+                    entry.append((end_idx, ()))
+            return entry
+        first, last = slots
+        saved = captures[first:last]
+        captures[first:last:2] = [_UNSET] * ((last - first) // 2)
+        for end_idx, caps in compute(captures):
+            item = (end_idx, tuple(caps[first:last]))
+            if item not in seen:
+                seen.add(item)
+                entry.append(item)
+        captures[first:last] = saved
+        return entry
+
+    def stats(self):
+        return {'saved': self.hits, 'misses': self.misses, 'overflows': self.overflows,
+                'memoable_nodes': len(self.memoable)}
+
+# --- Closure compiler ---
+# match_possibilities works out what each node is with a chain of isinstance checks every
+# time it visits the node, at every position of every line. _ClosureCompiler does that once
+# per pattern (see Backtracker), turning each node into a generator function specialized for it: runs of
+# literals become one str.startswith check and character sets become set lookups. The
+# compiled matcher yields exactly what match_possibilities does, in the same order.
+
+def _compile_char_test(node):
+    """Like _char_test, with the node's fields bound into the predicate."""
+    if isinstance(node, LiteralNode):
+        return node.char.__eq__
+    return _char_test(node)
+
+def _compile_step(nodes):
+    """
+    Compiles a run of nodes that each match in at most one way (literals, single-character
+    nodes, anchors and backreferences) into step(line, pos, caps) -> end position, or -1.
+    """
+    checks = []
+    literal = ''
+    for node in nodes:
+        if isinstance(node, LiteralNode):
+            literal += node.char
+            continue
+        if literal:
+            checks.append(_literal_check(literal))
+            literal = ''
+        checks.append(_single_check(node))
+    if literal:
+        checks.append(_literal_check(literal))
+    if len(checks) == 1:
+        return checks[0]
+    def step(line, pos, caps):
+        for check in checks:
+            pos = check(line, pos, caps)
+            if pos < 0:
+                break
+        return pos
+    return step
+
+def _literal_check(literal):
+    size = len(literal)
+    if size == 1:
+        def check(line, pos, caps):
+            return pos + 1 if pos < len(line) and line[pos] == literal else -1
     else:
-        start_positions = range(len(input_line) + 1)
+        def check(line, pos, caps):
+            return pos + size if line.startswith(literal, pos) else -1
+    return check
 
-    for pos in start_positions:
-        initial_caps = [None] * (parser.group_count + 1)
-        
-        # Get all possible ways the pattern can match from the current position `pos`.
-        possibilities = match_possibilities(ast, input_line, pos, initial_caps)
+def _single_check(node):
+    if isinstance(node, AnchorNode):
+        if node.type == 'start':
+            return lambda line, pos, caps: pos if pos == 0 else -1
+        return lambda line, pos, caps: pos if pos == len(line) else -1
+    if isinstance(node, BackreferenceNode):
+        slot = 2 * node.index
+        def check(line, pos, caps):
+            start = caps[slot] if slot < len(caps) else None
+            if start is None:
+                return -1
+            end = caps[slot + 1]
+            if not line.startswith(line[start:end], pos):
+                return -1
+            return pos + end - start
+        return check
+    test = _compile_char_test(node)
+    def check(line, pos, caps):
+        return pos + 1 if pos < len(line) and test(line[pos]) else -1
+    return check
+
+def _is_step_node(node):
+    return (isinstance(node, (AnchorNode, BackreferenceNode))
+            or (node is not None and _char_test(node) is not None))
+
+def _counted(possibilities):
+    # Counts, into the current STATS, each evaluation of a node and each time the matcher
+    # comes back to it for another possibility.
+    def counted(line, pos, caps):
+        STATS.nodes_evaluated += 1
+        for item in possibilities(line, pos, caps):
+            yield item
+            STATS.backtracks += 1
+    return counted
+
+class _ClosureCompiler:
+    def __init__(self, memo, counted=False):
+        self.memo = memo
+        self.counted = counted
+
+    def compile(self, node):
+        possibilities = self._compile_node(node)
+        if node is not None and id(node) in self.memo.memoable:
+            memo, key_id, inner = self.memo, id(node), possibilities
+            def possibilities(line, pos, caps):
+                return memo.possibilities(node, (key_id, pos), caps, lambda blank: inner(line, pos, blank))
+        if self.counted:
+            possibilities = _counted(possibilities)
+        return possibilities
+
+    def _compile_node(self, node):
+        if node is None:
+            def empty(line, pos, caps):
+                yield pos, caps
+            return empty
+
+        if _is_step_node(node):
+            step = _compile_step([node])
+            def single(line, pos, caps):
+                end = step(line, pos, caps)
+                if end >= 0:
+                    yield end, caps
+            return single
+
+        if isinstance(node, CaptureGroupNode):
+            child, slot = self.compile(node._child), 2 * node.index
+            def group(line, pos, caps):
+                # Sets the group's span for the rest of the match, undone on backtracking.
+                for end, child_caps in child(line, pos, caps):
+                    saved_start, saved_end = child_caps[slot], child_caps[slot + 1]
+                    child_caps[slot], child_caps[slot + 1] = pos, end
+                    yield end, child_caps
+                    child_caps[slot], child_caps[slot + 1] = saved_start, saved_end
+            return group
+
+        if isinstance(node, QuantifierNode):
+            return self._compile_repeat(node)
+
+        if isinstance(node, ConcatenationNode):
+            return self._compile_sequence(node.children)
+
+        if isinstance(node, AlternationNode):
+            branches = [self.compile(branch) for branch in node.children]
+            def alternation(line, pos, caps):
+                for branch in branches:
+                    yield from branch(line, pos, caps)
+            return alternation
+
+        raise ValueError(f"Cannot compile {node!r}")
+
+    def _compile_sequence(self, children):
+        # Groups consecutive step nodes, then chains the parts right to left so each part
+        # hands its end position straight to the rest of the sequence.
+        parts = []
+        for child in children:
+            if _is_step_node(child):
+                if parts and isinstance(parts[-1], list):
+                    parts[-1].append(child)
+                else:
+                    parts.append([child])
+            else:
+                parts.append(child)
+
+        rest = None
+        for part in reversed(parts):
+            if isinstance(part, list):
+                rest = self._chain_step(_compile_step(part), rest)
+            else:
+                rest = self._chain(self.compile(part), rest)
+        return rest
+
+    @staticmethod
+    def _chain_step(step, rest):
+        if rest is None:
+            def sequence(line, pos, caps):
+                end = step(line, pos, caps)
+                if end >= 0:
+                    yield end, caps
+        else:
+            def sequence(line, pos, caps):
+                end = step(line, pos, caps)
+                if end >= 0:
+                    yield from rest(line, end, caps)
+        return sequence
+
+    @staticmethod
+    def _chain(first, rest):
+        if rest is None:
+            return first
+        def sequence(line, pos, caps):
+            for end, child_caps in first(line, pos, caps):
+                yield from rest(line, end, child_caps)
+        return sequence
 
-        # --- FIX 2: ACCEPT ANY VALID MATCH ---
-        # If the list of possibilities is not empty, a match has been found.
-        # The logic within AnchorNode handles the '$' anchor, so if a pattern
-        # must match to the end, 'possibilities' will only be populated if it does.
-        if possibilities:
-            # We found a match, so we can exit successfully.
-            return True, possibilities[0][0], possibilities[0][1]
+    def _compile_repeat(self, node):
+        min_count, max_count = node.min_count, node.max_count
+        greedy = node.greedy
 
-    # If we've tried all starting positions and found no match.
-    return False, None, None
+        if _char_test(node._child) is not None:
+            # Single-character child: find the longest run iteratively instead of recursing.
+            test = _compile_char_test(node._child)
+            def run(line, pos, caps):
+                end = pos
+                limit = len(line) if max_count is None else min(len(line), pos + max_count)
+                while end < limit and test(line[end]):
+                    end += 1
+                ends = range(end, pos + min_count - 1, -1)
+                for end_idx in (ends if greedy else reversed(ends)):
+                    yield end_idx, caps
+            return lambda line, pos, caps: run(line, pos, caps)
 
-def search_file(filename, ast, parser, print_filenames):
+        child = self.compile(node._child)
+        return lambda line, pos, caps: _repeat_possibilities(child, line, pos, caps, min_count, max_count, greedy)
+
+# --- Thompson NFA compiler and Pike VM ---
+# The backtracking matcher above explores every way a pattern can match, which is
+# exponential for patterns like "(a*)*b". Patterns without backreferences are instead
+# compiled into a Thompson NFA program and run by a Pike VM, which advances all
+# threads in lockstep and therefore runs in O(len(program) * len(input_line)).
+# Counted repetitions such as \d{4} or [0-9a-f]{6,12} are expanded into copies of their
+# child, since an NFA cannot count. MAX_PROGRAM_SIZE (--max-program-size) bounds the
+# copies: larger patterns run on the backtracker, which loops with counters instead.
+
+MAX_PROGRAM_SIZE = 10000 # Most instructions a Pike VM program may have
+
+# Opcodes. Each instruction is a tuple (op, x, y).
+OP_CHAR = 0   # x: literal character
+OP_ANY = 1    # any single character
+OP_CLASS = 2  # x: CharClass.contains of a class or a large/negated set
+OP_SET = 3    # x: frozenset of the characters in a small set, y: negated
+OP_SPLIT = 4  # fork: x is preferred over y
+OP_JMP = 5    # x: target pc
+OP_SAVE = 6   # x: capture slot (2*i is the start of group i, 2*i+1 its end)
+OP_ASSERT = 7 # x: 'start' or 'end'
+OP_MATCH = 8
+
+# A Program stores its instructions flat, as three array('i') of opcodes and operands:
+# characters as code points, assertions as indices into ASSERTIONS, sets and classes as
+# indices into Program.classes and missing operands as -1. That is a few bytes per
+# instruction, and it pickles to -j workers without the functions the engines call.
+# The engines run on the (op, x, y) tuples, decoded once per program by a jump table
+# indexed by opcode.
+ASSERTIONS = ('start', 'end')
+NO_OPERAND = -1
+
+def _operand(value):
+    return None if value == NO_OPERAND else value
+
+_DECODERS = ( # Indexed by opcode: (classes, x, y) -> the decoded (x, y)
+    lambda classes, x, y: (chr(x), None), # OP_CHAR
+    lambda classes, x, y: (None, None), # OP_ANY
+    lambda classes, x, y: (classes[x].contains, None), # OP_CLASS
+    lambda classes, x, y: (classes[x].excluded, True) if y else (classes[x].members, False), # OP_SET
+    lambda classes, x, y: (x, y), # OP_SPLIT
+    lambda classes, x, y: (x, None), # OP_JMP
+    lambda classes, x, y: (x, None), # OP_SAVE
+    lambda classes, x, y: (ASSERTIONS[x], None), # OP_ASSERT
+    lambda classes, x, y: (None, None), # OP_MATCH
+)
+
+class Program:
+    __slots__ = ('ops', 'xs', 'ys', 'classes', 'group_count', 'n_slots', '_insts')
+
+    def __init__(self, ops, xs, ys, classes, group_count):
+        self.ops = ops # array('i') of opcodes
+        self.xs = xs # array('i') of encoded x operands
+        self.ys = ys # array('i') of encoded y operands
+        self.classes = classes # Tuple of the CharClass objects OP_CLASS and OP_SET refer to
+        self.group_count = group_count
+        self.n_slots = 2 * (group_count + 1) # Slots 0 and 1 hold the overall match
+        self._insts = None
+
+    @classmethod
+    def encode(cls, insts, group_count):
+        """
+        Builds a Program from (op, x, y) instructions whose OP_CLASS and OP_SET operand
+        is the CharClass itself (OP_SET is only used for classes with members or excluded).
+        """
+        ops, xs, ys = array.array('i'), array.array('i'), array.array('i')
+        classes = []
+        for op, x, y in insts:
+            if op in (OP_CLASS, OP_SET):
+                index = next((i for i, known in enumerate(classes) if known is x), len(classes))
+                if index == len(classes):
+                    classes.append(x)
+                x, y = index, (int(x.members is None) if op == OP_SET else None)
+            elif op == OP_CHAR:
+                x = ord(x)
+            elif op == OP_ASSERT:
+                x = ASSERTIONS.index(x)
+            ops.append(op)
+            xs.append(NO_OPERAND if x is None else x)
+            ys.append(NO_OPERAND if y is None else y)
+        return cls(ops, xs, ys, tuple(classes), group_count)
+
+    @property
+    def insts(self):
+        """The decoded list of (op, x, y) tuples."""
+        if self._insts is None:
+            classes = self.classes
+            self._insts = [(op,) + _DECODERS[op](classes, _operand(x), _operand(y))
+                           for op, x, y in zip(self.ops, self.xs, self.ys)]
+        return self._insts
+
+    def __getstate__(self):
+        return (self.ops.tobytes() + self.xs.tobytes() + self.ys.tobytes(), self.classes, self.group_count)
+
+    def __setstate__(self, state):
+        code, classes, group_count = state
+        arrays = [array.array('i') for _ in range(3)]
+        size = len(code) // 3
+        for i, operands in enumerate(arrays):
+            operands.frombytes(code[i * size:(i + 1) * size])
+        self.__init__(*arrays, classes, group_count)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __repr__(self):
+        return f"Program(insts={len(self)}, group_count={self.group_count})"
+
+class ProgramTooLarge(ValueError):
+    pass
+
+class NFACompiler:
     """
-    Searches a single file for the pattern defined by the AST.
+    Compiles a RegexParser AST into a Program for the Pike VM.
+    Backreferences cannot be expressed in an NFA and raise ValueError; programs with more
+    than max_size instructions raise ProgramTooLarge.
+    """
+    def __init__(self, max_size=None):
+        self.insts = []
+        self.max_size = MAX_PROGRAM_SIZE if max_size is None else max_size
 
-    Returns:
-        True if a match was found in this file, False otherwise.
+    def compile(self, ast, group_count):
+        self._emit(OP_SAVE, 0)
+        self._compile_node(ast)
+        self._emit(OP_SAVE, 1)
+        self._emit(OP_MATCH)
+        return Program.encode(self.insts, group_count)
+
+    def _emit(self, op, x=None, y=None):
+        if len(self.insts) >= self.max_size:
+            raise ProgramTooLarge(f"Pattern needs more than {self.max_size} NFA instructions")
+        self.insts.append([op, x, y])
+        return len(self.insts) - 1
+
+    def _compile_node(self, node):
+        if node is None: # Empty group or branch matches the empty string
+            return
+        if isinstance(node, LiteralNode):
+            self._emit(OP_CHAR, node.char)
+        elif isinstance(node, DotNode):
+            self._emit(OP_ANY)
+        elif isinstance(node, (CharClassNode, CharSetNode)):
+            char_class = node.char_class
+            if char_class.members is not None or char_class.excluded is not None:
+                self._emit(OP_SET, char_class)
+            else:
+                self._emit(OP_CLASS, char_class)
+        elif isinstance(node, AnchorNode):
+            self._emit(OP_ASSERT, node.type)
+        elif isinstance(node, CaptureGroupNode):
+            self._emit(OP_SAVE, 2 * node.index)
+            self._compile_node(node._child)
+            self._emit(OP_SAVE, 2 * node.index + 1)
+        elif isinstance(node, ConcatenationNode):
+            for child in node.children:
+                self._compile_node(child)
+        elif isinstance(node, AlternationNode):
+            # SPLIT L1, next; L1: branch; JMP end; next: SPLIT L2, next2; ... last branch; end:
+            jumps = []
+            for branch in node.children[:-1]:
+                split = self._emit(OP_SPLIT, len(self.insts) + 1)
+                self._compile_node(branch)
+                jumps.append(self._emit(OP_JMP))
+                self.insts[split][2] = len(self.insts)
+            self._compile_node(node.children[-1])
+            for jump in jumps:
+                self.insts[jump][1] = len(self.insts)
+        elif isinstance(node, QuantifierNode):
+            self._compile_quantifier(node)
+        elif isinstance(node, BackreferenceNode):
+            raise ValueError("Backreferences are not supported by the NFA engine")
+        else:
+            raise ValueError(f"Unknown AST node: {node!r}")
+
+    def _compile_quantifier(self, node):
+        def split(pc, body, exit):
+            # Greedy quantifiers prefer another iteration, lazy ones prefer to stop.
+            if node.greedy:
+                self.insts[pc][1], self.insts[pc][2] = body, exit
+            else:
+                self.insts[pc][1], self.insts[pc][2] = exit, body
+
+        if node.type == 'ZERO_OR_ONE':
+            # SPLIT L1, L2; L1: child; L2:
+            pc = self._emit(OP_SPLIT)
+            self._compile_node(node._child)
+            split(pc, pc + 1, len(self.insts))
+        elif node.type == 'ZERO_OR_MORE' or (node.type == 'COUNTED' and node.max_count is None):
+            # {n,} is n copies of the child followed by the loop of '*'.
+            for _ in range(node.min_count):
+                self._compile_node(node._child)
+            # L0: SPLIT L1, L2; L1: child; JMP L0; L2:
+            pc = self._emit(OP_SPLIT)
+            self._compile_node(node._child)
+            self._emit(OP_JMP, pc)
+            split(pc, pc + 1, len(self.insts))
+        elif node.type == 'ONE_OR_MORE':
+            # L0: child; SPLIT L0, L1; L1:
+            start = len(self.insts)
+            self._compile_node(node._child)
+            pc = self._emit(OP_SPLIT)
+            split(pc, start, pc + 1)
+        elif node.type == 'COUNTED':
+            # An NFA has no counters, so {n,m} is n copies of the child followed by m - n
+            # optional copies that all skip to the end, as in (x(x(x)?)?)? for x{0,3}:
+            # child...; SPLIT L1, END; L1: child; SPLIT L2, END; L2: child; ... END:
+            # MAX_PROGRAM_SIZE bounds the copies; the backtracker counts instead.
+            for _ in range(node.min_count):
+                self._compile_node(node._child)
+            splits = []
+            for _ in range(node.max_count - node.min_count):
+                splits.append(self._emit(OP_SPLIT))
+                self._compile_node(node._child)
+            for pc in splits:
+                split(pc, pc + 1, len(self.insts))
+        else:
+            raise ValueError(f"Unknown quantifier type: {node.type}")
+
+@functools.lru_cache(maxsize=64)
+def has_backreference(ast):
+    return ast is not None and any(isinstance(node, BackreferenceNode) for node in ast.walk())
+
+@functools.lru_cache(maxsize=64)
+def compile_program(ast, group_count):
+    """Compiles (and caches) the Pike VM program for a parsed pattern."""
+    return NFACompiler().compile(ast, group_count)
+
+@functools.lru_cache(maxsize=64)
+def nfa_program(ast, group_count):
     """
-    file_had_match = False
+    The Pike VM program for a parsed pattern, or None if the pattern must run on the
+    backtracker: it has a backreference, or its counted repetitions would make a program
+    larger than MAX_PROGRAM_SIZE.
+    """
+    if has_backreference(ast):
+        return None
     try:
-        with open(filename, 'r') as f:
-            for line in f:
-                clean_line = line.strip()
-                success, _, _ = match_entire_ast(ast, clean_line, parser)
-                if success:
-                    if print_filenames:
-                        # Prepend the filename to the matched line.
-                        print(f"{filename}:{clean_line}")
-                    else:
-                        print(clean_line)
-                    file_had_match = True
-    except Exception as e:
-        # Silently skip files that can't be read (e.g., binary files, permissions errors).
-        # You could print an error to stderr here if you prefer.
-        pass
-    
-    return file_had_match
+        return compile_program(ast, group_count)
+    except ProgramTooLarge:
+        return None
 
-def main():
-    # --- 1. Argument Parsing ---
-    args = sys.argv[1:]
-    recursive = False
-    pattern_str = None
-    paths = []
+def _add_thread(insts, threads, visited, pc, slots, pos, line_len):
+    """
+    Follows the empty transitions (JMP, SPLIT, SAVE, ASSERT) from pc and appends the
+    resulting character-consuming threads to 'threads' in priority order.
+    """
+    stack = [(pc, slots)]
+    while stack:
+        pc, slots = stack.pop()
+        if pc in visited:
+            continue # A higher-priority thread already reached this instruction
+        visited.add(pc)
+        op, x, y = insts[pc]
+        if op == OP_JMP:
+            stack.append((x, slots))
+        elif op == OP_SPLIT:
+            # Push the less preferred branch first so the preferred one is explored first.
+            stack.append((y, slots))
+            stack.append((x, slots))
+        elif op == OP_SAVE:
+            slots = slots[:]
+            slots[x] = pos
+            stack.append((pc + 1, slots))
+        elif op == OP_ASSERT:
+            if (x == 'start' and pos == 0) or (x == 'end' and pos == line_len):
+                stack.append((pc + 1, slots))
+        else:
+            threads.append((pc, slots))
 
-    # Handle flags that can appear anywhere, like -r
-    if '-r' in args:
-        recursive = True
-        args.remove('-r')
-    
-    # The -E flag must be followed by the pattern
-    try:
-        if '-E' in args:
-            e_index = args.index('-E')
-            pattern_str = args[e_index + 1]
-            # Remove both -E and the pattern from the list
-            args.pop(e_index)
-            args.pop(e_index)
+def pike_vm(program, input_line, starts=None, pos=0, after_empty=False):
+    """
+    Runs the program over input_line with leftmost-first semantics, trying matches that
+    start at pos or later. If a StartFilter is given, new threads are only started where
+    it says a match can begin. With after_empty (for a search that resumes after an empty
+    match at pos), only a non-empty match starting at pos is accepted.
+
+    Returns:
+        The capture slots of the first match (slots[0]/slots[1] are its start and end),
+        or None if there is no match.
+    """
+    insts = program.insts
+    line_len = len(input_line)
+    initial_slots = [None] * program.n_slots
+    matched = None
+    clist, visited = [], set()
+    first_pos = pos
+    while True:
+        # Start a new, lowest priority thread at this position until a match is found.
+        if matched is None and (not after_empty or pos == first_pos):
+            if starts is None or starts.can_start(input_line, pos):
+                _add_thread(insts, clist, visited, 0, initial_slots, pos, line_len)
+            elif not clist and not after_empty:
+                # Nothing in flight: jump straight to the next possible start.
+                pos = starts.next_candidate(input_line, pos)
+                if pos < 0:
+                    break
+                _add_thread(insts, clist, visited, 0, initial_slots, pos, line_len)
+        if not clist:
+            if matched is not None or pos >= line_len or after_empty:
+                break
+            # Every new thread failed an assertion here, e.g. '$' before the end: try the next position.
+            visited = set()
+            pos += 1
+            continue
+        ch = input_line[pos] if pos < line_len else None
+        nlist, nvisited = [], set()
+        for pc, slots in clist:
+            op, x, y = insts[pc]
+            if op == OP_MATCH:
+                if after_empty and pos == first_pos:
+                    continue # The empty match was already found; try the lower-priority threads
+                matched = slots
+                break # Lower-priority threads can no longer win
+            if ch is None:
+                continue
+            if op == OP_CHAR:
+                ok = ch == x
+            elif op == OP_ANY:
+                ok = True
+            elif op == OP_CLASS:
+                ok = x(ch)
+            else: # OP_SET
+                ok = (ch in x) != y
+            if ok:
+                _add_thread(insts, nlist, nvisited, pc + 1, slots, pos + 1, line_len)
+        if ch is None:
+            break
+        clist, visited = nlist, nvisited
+        pos += 1
+    return matched
+
+def _slots_to_captures(slots, input_line, group_count):
+    # Converts Pike VM slots into the captures list used by match_possibilities.
+    captures = [None] * (group_count + 1)
+    for index in range(1, group_count + 1):
+        start, end = slots[2 * index], slots[2 * index + 1]
+        if start is not None and end is not None:
+            captures[index] = input_line[start:end]
+    return captures
+
+# --- Lazy DFA ---
+# Most callers only need to know whether a line matches. For that question the NFA can be
+# turned into a DFA whose states are sets of NFA instructions. States are built on demand
+# and kept in a bounded cache; when the cache keeps filling up the search falls back to the
+# Pike VM rather than rebuilding states for every character.
+
+DFA_CACHE_SIZE = 1000 # Default maximum number of cached DFA states
+
+def _dfa_closure(insts, seeds, at_start, at_end):
+    """
+    Returns the sorted tuple of instructions reachable from 'seeds' through empty
+    transitions. Character-consuming instructions and MATCH are kept; so are end
+    anchors that cannot be resolved yet (at_end is False).
+    """
+    reached = set()
+    seen = set()
+    stack = list(seeds)
+    while stack:
+        pc = stack.pop()
+        if pc in seen:
+            continue
+        seen.add(pc)
+        op, x, y = insts[pc]
+        if op == OP_JMP:
+            stack.append(x)
+        elif op == OP_SPLIT:
+            stack.append(x)
+            stack.append(y)
+        elif op == OP_SAVE:
+            stack.append(pc + 1)
+        elif op == OP_ASSERT:
+            if x == 'start':
+                if at_start:
+                    stack.append(pc + 1)
+            elif at_end:
+                stack.append(pc + 1)
+            else:
+                reached.add(pc) # Resolved once we know whether the line ends here
         else:
-            if len(args) >= 2:
-                 pattern_str = args[0]
-                 args.pop(0)
+            reached.add(pc)
+    return tuple(sorted(reached))
 
-        paths = args
-    except IndexError:
-        print("Usage: python3 ast.py [-r] -E <pattern> [path1] [path2] ...", file=sys.stderr)
-        exit(2)
+def _inst_accepts(inst, ch):
+    # True if the instruction consumes ch.
+    op, x, y = inst
+    if op == OP_CHAR:
+        return ch == x
+    if op == OP_ANY:
+        return True
+    if op == OP_CLASS:
+        return x(ch)
+    if op == OP_SET:
+        return (ch in x) != y
+    return False # MATCH or a pending end anchor
 
-    # --- THIS IS THE FIX ---
-    # Only exit if the pattern is missing. It's okay if 'paths' is empty.
-    if not pattern_str:
-        print("Usage: python3 ast.py [-r] -E <pattern> [path1] [path2] ...", file=sys.stderr)
-        exit(2)
-    
-    # --- 2. Main Logic ---
-    any_match_found = False
-    try:
-        parser = RegexParser(pattern_str)
-        ast = parser.parse()
+def _dfa_step(insts, pcs, ch, restart):
+    # Advance every thread of a DFA state over ch, then restart the search at the next position.
+    seeds = [pc + 1 for pc in pcs if _inst_accepts(insts[pc], ch)]
+    pcs = _dfa_closure(insts, seeds, at_start=False, at_end=False)
+    if restart:
+        pcs = tuple(sorted(set(pcs).union(restart)))
+    return pcs
 
-        print_filenames = recursive or len(paths) > 1
+class DFAState:
+    def __init__(self, pcs, at_start, is_match):
+        self.pcs = pcs # Sorted tuple of NFA instructions this state stands for
+        self.at_start = at_start # True only for the state before the first character
+        self.is_match = is_match
+        self.idle = False # True when no match attempt is in progress
+        self.transitions = {} # char -> DFAState
+        self.accepts_at_end = None # Computed lazily by LazyDFA._accepts_at_end
+    def __repr__(self):
+        return f"DFAState(pcs={self.pcs}, is_match={self.is_match})"
 
-        if paths:
-            for path in paths:
-                if recursive and os.path.isdir(path):
-                    for dirpath, _, filenames in os.walk(path):
-                        for filename in filenames:
-                            full_path = os.path.join(dirpath, filename)
-                            if search_file(full_path, ast, parser, print_filenames=True):
-                                any_match_found = True
-                elif os.path.isfile(path):
-                    if search_file(path, ast, parser, print_filenames):
-                        any_match_found = True
-                elif not os.path.isdir(path):
-                     print(f"Error: '{path}' is not a valid file or directory.", file=sys.stderr)
-        
+class LazyDFA:
+    """
+    Answers "does the program match anywhere in this line?" by simulating a DFA built
+    lazily from the Pike VM program.
+
+    At most max_states states are cached. When the cache is full it is flushed; if the
+    search made too little progress since the previous flush, search() returns None and
+    the caller should fall back to the Pike VM.
+
+    An anchored DFA only tries a match at the start of the line. Otherwise, when a
+    StartFilter is given, idle stretches of the line are skipped with it.
+    """
+    MIN_CHARS_PER_STATE = 10 # Flushing more often than this means the cache is thrashing
+
+    def __init__(self, program, max_states=DFA_CACHE_SIZE, anchored=False, starts=None):
+        self.program = program
+        self.insts = program.insts
+        self.max_states = max(max_states, 2)
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.fallbacks = 0
+        self._progress = 0 # Characters scanned since the last flush
+        self._restart = () if anchored else _dfa_closure(self.insts, [0], at_start=False, at_end=False)
+        self.starts = starts if starts is not None and starts.skip else None
+        self._start = None
+
+    def __getstate__(self):
+        # States are rebuilt on demand, so only the program and the settings are pickled.
+        state = dict(self.__dict__, cache={}, _start=None)
+        del state['insts']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.insts = self.program.insts
+
+    def stats(self):
+        return {
+            'states': len(self.cache),
+            'max_states': self.max_states,
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+            'fallbacks': self.fallbacks,
+        }
+
+    def _state(self, pcs, at_start):
+        key = (pcs, at_start)
+        state = self.cache.get(key)
+        if state is None:
+            is_match = any(self.insts[pc][0] == OP_MATCH for pc in pcs)
+            state = DFAState(pcs, at_start, is_match)
+            state.idle = not at_start and bool(pcs) and pcs == self._restart
+            self.cache[key] = state
+        return state
+
+    def _start_state(self):
+        if self._start is None or (self._start.pcs, True) not in self.cache:
+            pcs = _dfa_closure(self.insts, [0], at_start=True, at_end=False)
+            self._start = self._state(pcs, True)
+        return self._start
+
+    def _step(self, state, ch):
+        return _dfa_step(self.insts, state.pcs, ch, self._restart)
+
+    def _accepts_at_end(self, state):
+        if state.accepts_at_end is None:
+            pcs = _dfa_closure(self.insts, state.pcs, at_start=state.at_start, at_end=True)
+            state.accepts_at_end = any(self.insts[pc][0] == OP_MATCH for pc in pcs)
+        return state.accepts_at_end
+
+    def _flush(self, pos):
+        """Empties the state cache. Returns False instead if the cache is thrashing."""
+        if self.flushes and self._progress + pos < self.MIN_CHARS_PER_STATE * self.max_states:
+            self.fallbacks += 1
+            return False
+        self.flushes += 1
+        self._progress = -pos
+        self.cache.clear()
+        return True
+
+    def search(self, input_line):
+        """Returns True/False, or None if the cache thrashed and the caller must use the NFA."""
+        state = self._start_state()
+        hits = misses = 0
+        pos = 0
+        while not state.is_match and pos < len(input_line):
+            if state.idle and self.starts is not None:
+                pos = self.starts.next_candidate(input_line, pos)
+                if pos < 0:
+                    pos = len(input_line)
+                    break
+            elif not state.pcs:
+                break # Dead state: an anchored search can no longer match
+            ch = input_line[pos]
+            next_state = state.transitions.get(ch)
+            if next_state is None:
+                misses += 1
+                if len(self.cache) >= self.max_states:
+                    if not self._flush(pos):
+                        self._record(hits, misses, pos)
+                        return None
+                    state = self._state(state.pcs, state.at_start)
+                next_state = self._state(self._step(state, ch), False)
+                state.transitions[ch] = next_state
+            else:
+                hits += 1
+            state = next_state
+            pos += 1
+        self._record(hits, misses, pos)
+        return state.is_match or self._accepts_at_end(state)
+
+    def _record(self, hits, misses, scanned):
+        self.hits += hits
+        self.misses += misses
+        self._progress += scanned
+
+# --- Batch DFA (NumPy) ---
+# With NumPy installed, a backreference-free pattern matches whole blocks of lines at once.
+# Its program is compiled eagerly into a dense DFA whose columns are character classes:
+# characters that every instruction treats alike, plus an end-of-line symbol. A block's
+# lines are translated to class numbers and packed, shortest first, into a uint8 matrix
+# with one column per line, padded with end-of-line symbols. All lines then advance in
+# lockstep, one character per step, with a single table gather. Matching and dead states
+# are absorbing, so each line's final state says whether it matched. Lines with characters
+# outside the known classes (non-ASCII characters that no ASCII character resembles), and
+# lines too long to pad economically, go to the normal engine. NumPy is only imported for
+# buffers large enough to repay it.
+
+BATCH_MAX_STATES = 256 # Patterns whose DFA is larger use the lazy DFA
+BATCH_MIN_BYTES = 64 * 1024 # Smaller buffers are scanned line by line
+BATCH_BLOCK_SIZE = 1024 * 1024 # Bytes of lines matched per batch
+BATCH_MAX_LINE = 1024 # Longer lines are matched one at a time
+BATCH_ROWS = 4096 # Lines per matrix
+BATCH_PREFILTER_MIN = 3 # A prefilter literal this long skips enough lines to beat batching
+BATCH_SPARSE_HITS = 8 # Blocks where fewer lines than 1 in this contain a prefilter literal skip batching
+
+_numpy = False # The numpy module once imported, or None if it is not installed
+
+def _import_without_script_dir(name):
+    # While this file runs as a script its directory comes first on sys.path, so an
+    # "import ast" inside the module (e.g. through inspect) would load this file instead
+    # of the standard library module. The directory is left out for the import.
+    if name not in sys.modules:
+        here = os.path.dirname(os.path.abspath(__file__))
+        saved = sys.path[:]
+        sys.path[:] = [entry for entry in sys.path if os.path.abspath(entry or os.curdir) != here]
+        try:
+            __import__(name)
+        finally:
+            sys.path[:] = saved
+    return sys.modules[name]
+
+def _load_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            _numpy = _import_without_script_dir('numpy')
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+class BatchDFA:
+    """
+    A dense DFA for matching many lines at once (see the section comment). The table is
+    flat: the row of a state starts at state * width, and its entries are the next states'
+    row starts, so a step is one addition and one gather. State 0 rejects, state 1 accepts.
+    """
+    def __init__(self, table, start, width, ascii_classes, signatures, consuming):
+        self.table = table
+        self.start = start
+        self.width = width # Classes plus the end-of-line symbol, which is the last column
+        self.accept = width
+        self.ascii_classes = ascii_classes # Class of each ASCII character
+        self.signatures = signatures # Instruction results for a character -> its class
+        self.consuming = consuming
+        self._classes = {} # Class of non-ASCII characters seen so far, or -1
+
+    def _class_of(self, code):
+        if code not in self._classes:
+            signature = tuple(_inst_accepts(inst, chr(code)) for inst in self.consuming)
+            self._classes[code] = self.signatures.get(signature, -1)
+        return self._classes[code]
+
+    def symbols(self, codes):
+        """Returns the classes of an array of code points, and the positions of unknown ones."""
+        np = _numpy
+        is_ascii = codes < 128
+        if is_ascii.all():
+            return self.ascii_classes.take(codes), codes[:0]
+        symbols = np.empty(len(codes), dtype=np.uint8)
+        symbols[is_ascii] = self.ascii_classes.take(codes[is_ascii])
+        others = np.flatnonzero(~is_ascii)
+        distinct, inverse = np.unique(codes[others], return_inverse=True)
+        classes = np.array([self._class_of(int(code)) for code in distinct], dtype=np.int16)[inverse]
+        symbols[others] = np.maximum(classes, 0)
+        return symbols, others[classes < 0]
+
+    def match_rows(self, symbols, starts, lengths):
+        """Returns a bool array: whether each line (symbols[start:start + length]) matches."""
+        np = _numpy
+        steps = int(lengths.max()) + 1 # Every line ends with at least one end-of-line symbol
+        offsets = np.arange(steps)[:, None]
+        if len(symbols):
+            matrix = symbols.take(starts[None, :] + offsets, mode='clip')
         else:
-            input_text = sys.stdin.read().strip()
-            for line in input_text.splitlines():
-                clean_line = line.strip()
-                success, _, _ = match_entire_ast(ast, clean_line, parser)
-                if success:
-                    print(clean_line)
-                    any_match_found = True
+            matrix = np.empty((steps, len(starts)), dtype=np.uint8)
+        matrix[offsets >= lengths[None, :]] = self.width - 1
+        state = np.full(len(starts), self.start, dtype=np.int32)
+        table = self.table
+        for step, column in enumerate(matrix):
+            state = table.take(state + column)
+            if step % 64 == 63 and not (state > self.accept).any():
+                break # Every line has matched or failed
+        return state == self.accept
 
-    except Exception as e:
-        print(f"An error occurred: {e}", file=sys.stderr)
-        exit(1)
+    def scan_block(self, block, matcher):
+        """Yields the matching lines (decoded and stripped) of block, a bytes of whole lines."""
+        np = _numpy
+        text = block.decode('utf-8', 'replace')
+        lines = text.split('\n')
+        if text.endswith('\n'):
+            lines.pop()
+        lines = [line.strip() for line in lines]
+        count = len(lines)
+        lengths = np.fromiter(map(len, lines), dtype=np.int64, count=count)
+        codes = np.frombuffer(''.join(lines).encode('utf-32-le'), dtype=np.uint32)
+        symbols, unknown = self.symbols(codes)
+        eligible = lengths <= BATCH_MAX_LINE
+        if len(unknown):
+            eligible[np.repeat(np.arange(count), lengths)[unknown]] = False
+        matched = np.zeros(count, dtype=bool)
+        rows = np.flatnonzero(eligible)
+        if len(rows):
+            starts = np.cumsum(lengths) - lengths
+            rows = rows[np.argsort(lengths[rows], kind='stable')]
+            for first in range(0, len(rows), BATCH_ROWS):
+                group = rows[first:first + BATCH_ROWS]
+                matched[group] = self.match_rows(symbols, starts[group], lengths[group])
+        for i in np.flatnonzero(~eligible).tolist():
+            matched[i] = matcher.engine_matches(lines[i])
+        for i in np.flatnonzero(matched).tolist():
+            yield lines[i]
+
+@functools.lru_cache(maxsize=64)
+def compile_batch_dfa(ast, group_count):
+    """
+    Returns the BatchDFA of a backreference-free pattern, or None if NumPy is not installed
+    or the DFA has more than BATCH_MAX_STATES states.
+    """
+    np = _load_numpy()
+    if np is None:
+        return None
+    insts = compile_program(ast, group_count).insts
+    restart = _dfa_closure(insts, [0], at_start=False, at_end=False)
+    consuming = [inst for inst in insts if inst[0] in (OP_CHAR, OP_ANY, OP_CLASS, OP_SET)]
+    signatures = {}
+    ascii_classes = []
+    for code in range(128):
+        signature = tuple(_inst_accepts(inst, chr(code)) for inst in consuming)
+        ascii_classes.append(signatures.setdefault(signature, len(signatures)))
+    representatives = [chr(ascii_classes.index(i)) for i in range(len(signatures))]
+    width = len(representatives) + 1
+
+    ids = {}
+    pending = []
+    def state_id(pcs, at_start):
+        if any(insts[pc][0] == OP_MATCH for pc in pcs):
+            return 1
+        if not pcs:
+            return 0
+        key = (pcs, at_start)
+        if key not in ids:
+            ids[key] = len(ids) + 2
+            pending.append(key)
+        return ids[key]
+
+    start = state_id(_dfa_closure(insts, [0], at_start=True, at_end=False), True)
+    rows = {0: [0] * width, 1: [1] * width}
+    while pending:
+        if len(ids) > BATCH_MAX_STATES:
+            return None
+        pcs, at_start = key = pending.pop()
+        row = [state_id(_dfa_step(insts, pcs, ch, restart), False) for ch in representatives]
+        at_end = _dfa_closure(insts, pcs, at_start=at_start, at_end=True)
+        row.append(1 if any(insts[pc][0] == OP_MATCH for pc in at_end) else 0)
+        rows[ids[key]] = row
+    table = np.array([rows[i] for i in range(len(rows))], dtype=np.int32) * width
+    return BatchDFA(table.ravel(), start * width, width, np.array(ascii_classes, dtype=np.uint8),
+                    signatures, consuming)
+
+# --- Start positions ---
+# Trying every start position is wasteful when the pattern can only begin with a few
+# characters. The FIRST set of a pattern lists the characters a match can start with;
+# positions holding any other character are skipped without running an engine.
+
+def first_set(node):
+    """
+    Returns (chars, classes, nullable): the literal characters and CharClass objects a
+    match of node can start with, and whether node can match without consuming anything.
+    chars is None when a match can start with any character.
+    """
+    if node is None or isinstance(node, AnchorNode):
+        return set(), set(), True
+    if isinstance(node, LiteralNode):
+        return {node.char}, set(), False
+    if isinstance(node, (CharClassNode, CharSetNode)):
+        char_class = node.char_class
+        if char_class.members is not None:
+            return set(char_class.members), set(), False
+        if char_class.mostly_matches:
+            return None, set(), False # Nearly any character, so nothing worth skipping
+        return set(), {char_class}, False
+    if isinstance(node, DotNode):
+        return None, set(), False
+    if isinstance(node, BackreferenceNode):
+        return None, set(), True # The referenced group may have matched anything
+    if isinstance(node, CaptureGroupNode):
+        return first_set(node._child)
+    if isinstance(node, QuantifierNode):
+        if node.max_count == 0:
+            return set(), set(), True
+        chars, classes, nullable = first_set(node._child)
+        return chars, classes, nullable or node.min_count == 0
+
+    if isinstance(node, AlternationNode):
+        parts = [first_set(branch) for branch in node.children]
+        nullable = any(part[2] for part in parts)
+    else: # ConcatenationNode: children contribute until one of them must consume
+        parts = []
+        nullable = True
+        for child in node.children:
+            part = first_set(child)
+            parts.append(part)
+            if not part[2]:
+                nullable = False
+                break
+    chars, classes = set(), set()
+    for part_chars, part_classes, _ in parts:
+        if part_chars is None:
+            return None, set(), nullable
+        chars |= part_chars
+        classes |= part_classes
+    return chars, classes, nullable
+
+def is_start_anchored(node):
+    """True if every match of node must begin at the start of the line."""
+    if isinstance(node, AnchorNode):
+        return node.type == 'start'
+    if isinstance(node, CaptureGroupNode):
+        return is_start_anchored(node._child)
+    if isinstance(node, ConcatenationNode):
+        return is_start_anchored(node.children[0])
+    if isinstance(node, AlternationNode):
+        return all(is_start_anchored(branch) for branch in node.children)
+    return False
+
+def is_end_anchored(node):
+    """True if every match of node must finish at the end of the line."""
+    if isinstance(node, AnchorNode):
+        return node.type == 'end'
+    if isinstance(node, CaptureGroupNode):
+        return is_end_anchored(node._child)
+    if isinstance(node, ConcatenationNode):
+        return is_end_anchored(node.children[-1])
+    if isinstance(node, AlternationNode):
+        return all(is_end_anchored(branch) for branch in node.children)
+    return False
+
+def reverse_ast(node):
+    """Returns an AST matching the reversed strings of node, used to match from the line end."""
+    if isinstance(node, ConcatenationNode):
+        return ConcatenationNode([reverse_ast(child) for child in reversed(node.children)])
+    if isinstance(node, AlternationNode):
+        return AlternationNode([reverse_ast(branch) for branch in node.children])
+    if isinstance(node, CaptureGroupNode):
+        return CaptureGroupNode(reverse_ast(node._child), node.index)
+    if isinstance(node, QuantifierNode):
+        return QuantifierNode(reverse_ast(node._child), node.type, node.greedy, node.min_count, node.max_count)
+    if isinstance(node, AnchorNode):
+        return AnchorNode('end' if node.type == 'start' else 'start')
+    return node # Single-character nodes read the same in both directions
+
+class StartFilter:
+    """Finds the positions in a line where a match of the pattern could begin."""
+    def __init__(self, ast):
+        self.anchored = is_start_anchored(ast)
+        chars, classes, nullable = first_set(ast)
+        # A nullable pattern can match the empty string anywhere, so nothing can be skipped.
+        self.skip = not self.anchored and not nullable and chars is not None
+        self.literal = None
+        self.table = None
+        if self.skip:
+            self.chars = frozenset(chars)
+            self.classes = frozenset(classes)
+            if len(chars) == 1 and not classes:
+                self.literal = next(iter(chars))
+            else:
+                # Lookup table for ASCII; other characters go through _can_start_with.
+                self.table = bytes(self._can_start_with(chr(code)) for code in range(128))
+
+    def _can_start_with(self, ch):
+        return ch in self.chars or any(ch in char_class for char_class in self.classes)
+
+    def can_start(self, line, pos):
+        if self.anchored:
+            return pos == 0
+        if not self.skip:
+            return True
+        if pos >= len(line):
+            return False
+        ch = line[pos]
+        if self.literal is not None:
+            return ch == self.literal
+        code = ord(ch)
+        return self.table[code] if code < 128 else self._can_start_with(ch)
+
+    def next_candidate(self, line, pos):
+        """Returns the first position >= pos where a match could begin, or -1."""
+        if self.anchored:
+            return 0 if pos == 0 else -1
+        if not self.skip:
+            return pos if pos <= len(line) else -1
+        if self.literal is not None:
+            return line.find(self.literal, pos)
+        table = self.table
+        for i in range(pos, len(line)):
+            code = ord(line[i])
+            if table[code] if code < 128 else self._can_start_with(line[i]):
+                return i
+        return -1
+
+@functools.lru_cache(maxsize=64)
+def compile_start_filter(ast):
+    return StartFilter(ast)
+
+def match_entire_ast(ast, input_line, parser):
+    # Patterns without backreferences run on the Pike VM in linear time.
+    program = nfa_program(ast, parser.group_count)
+    if program is not None:
+        slots = pike_vm(program, input_line, compile_start_filter(ast))
+        if slots is None:
+            return False, None, None
+        return True, slots[1], _slots_to_captures(slots, input_line, parser.group_count)
+
+    # Backreferences (and programs too large to compile) need the backtracking matcher.
+    slots = backtrack_search(ast, input_line, parser.group_count)
+    if slots is None:
+        return False, None, None
+    return True, slots[1], _slots_to_captures(slots, input_line, parser.group_count)
+
+class Backtracker:
+    """
+    The backtracking matcher of one pattern: its start filter, closures and memo, compiled
+    once. Matchers keep one for as long as they search, so lines are matched without
+    looking anything up in the module's compile caches, which only keep recent patterns.
+    search() uses the memo, so one Backtracker must not search in two threads at once.
+    """
+    def __init__(self, ast, group_count):
+        self.ast = ast
+        self.group_count = group_count
+        self.starts = StartFilter(ast)
+        self.memo = BacktrackMemo(ast)
+        # possibilities(line, pos, caps) behaves like match_possibilities(ast, line, pos, caps, memo).
+        self.possibilities = _ClosureCompiler(self.memo).compile(ast)
+        self._counted_possibilities = None # Also counts into STATS; compiled for --stats
+
+    def __reduce__(self):
+        # Closures cannot be pickled, so a copy (e.g. in a -j worker) is compiled afresh.
+        return Backtracker, (self.ast, self.group_count)
+
+    def _compiled(self):
+        if STATS is None:
+            return self.possibilities
+        if self._counted_possibilities is None:
+            self._counted_possibilities = _ClosureCompiler(self.memo, counted=True).compile(self.ast)
+        return self._counted_possibilities
+
+    def search(self, input_line, pos=0, after_empty=False):
+        """
+        Runs the backtracking matcher, trying matches that start at pos or later. With
+        after_empty, only a non-empty match starting at pos is accepted, as in pike_vm.
+
+        Returns:
+            The capture slots of the first match, as pike_vm does, or None if there is no match.
+        """
+        # Try to match the pattern starting from every position where the start filter says
+        # a match can begin (only position 0 if the pattern is anchored with '^').
+        starts = self.starts
+        # Failed starts leave the capture store as they found it, so one store serves every start.
+        captures = [None] * (2 * (self.group_count + 1))
+        possibilities = self._compiled()
+        self.memo.reset()
+        if after_empty:
+            start = pos
+            first = next((item for item in possibilities(input_line, start, captures) if item[0] > start), None)
+            if first is None:
+                return None
+            captures[0], captures[1] = start, first[0]
+            return captures
+        pos = starts.next_candidate(input_line, pos)
+        while pos >= 0:
+            # Only the first (highest priority) way the pattern can match from `pos` is needed,
+            # so the lazy matcher stops as soon as it finds one.
+            # The logic within AnchorNode handles the '$' anchor, so if a pattern
+            # must match to the end, a possibility is only produced if it does.
+            first = next(possibilities(input_line, pos, captures), None)
+            if first is not None:
+                captures[0], captures[1] = pos, first[0]
+                return captures
+            pos = starts.next_candidate(input_line, pos + 1)
+
+        # If we've tried all starting positions and found no match.
+        return None
+
+@functools.lru_cache(maxsize=64)
+def compile_backtracker(ast, group_count):
+    return Backtracker(ast, group_count)
+
+def backtrack_search(ast, input_line, group_count, pos=0, after_empty=False):
+    """Backtracker.search for a one-off search; matchers hold their Backtracker instead."""
+    return compile_backtracker(ast, group_count).search(input_line, pos, after_empty)
+
+# --- Required literal prefilter ---
+# Most patterns contain a literal that every match must include, e.g. "ERROR " in
+# "ERROR \d+ (timeout|refused)". Lines that contain none of the required literals cannot
+# match, and checking that with str.find is far cheaper than running any engine.
+
+MAX_LITERAL_SET = 16 # Largest set of alternative literals the prefilter will track
+
+def _exact_strings(node):
+    """Returns the finite set of strings node can match, or None if it is unknown or too large."""
+    if node is None or isinstance(node, AnchorNode):
+        return {''}
+    if isinstance(node, LiteralNode):
+        return {node.char}
+    if isinstance(node, CharSetNode):
+        members = node.char_class.members
+        if members is not None and len(members) <= MAX_LITERAL_SET:
+            return set(members)
+        return None
+    if isinstance(node, CaptureGroupNode):
+        return _exact_strings(node._child)
+    if isinstance(node, QuantifierNode) and node.max_count is not None and node.max_count <= MAX_LITERAL_SET:
+        # Each allowed count contributes the child's strings repeated that many times.
+        child = _exact_strings(node._child)
+        strings, repeated = set(), {''}
+        for count in range(node.max_count + 1):
+            if repeated is None:
+                return None
+            if count >= node.min_count:
+                strings |= repeated
+            repeated = _cross_product(repeated, child)
+        return strings if len(strings) <= MAX_LITERAL_SET else None
+    if isinstance(node, AlternationNode):
+        strings = set()
+        for branch in node.children:
+            branch_strings = _exact_strings(branch)
+            if branch_strings is None:
+                return None
+            strings |= branch_strings
+        return strings if len(strings) <= MAX_LITERAL_SET else None
+    if isinstance(node, ConcatenationNode):
+        strings = {''}
+        for child in node.children:
+            strings = _cross_product(strings, _exact_strings(child))
+            if strings is None:
+                return None
+        return strings
+    return None
+
+def _cross_product(prefixes, suffixes):
+    if suffixes is None or len(prefixes) * len(suffixes) > MAX_LITERAL_SET:
+        return None
+    return {prefix + suffix for prefix in prefixes for suffix in suffixes}
+
+def _better_literals(a, b):
+    # Prefers longer literals, but beyond a few characters every extra literal costs
+    # another scan of the line for little extra selectivity, so then prefers fewer literals.
+    if a is None or '' in a:
+        return b
+    if b is None or '' in b:
+        return a
+    score_a = (min(min(len(s) for s in a), 4), -len(a), min(len(s) for s in a))
+    score_b = (min(min(len(s) for s in b), 4), -len(b), min(len(s) for s in b))
+    return a if score_a >= score_b else b
+
+def _repeated_affix(node):
+    """
+    For a quantifier that repeats its child at least once, the strings every match starts
+    with and ends with: the child's exact strings repeated min_count times, or fewer times
+    if that makes too many strings. None for other nodes.
+    """
+    if not isinstance(node, QuantifierNode) or node.min_count == 0:
+        return None
+    child = _exact_strings(node._child)
+    affix = child
+    for _ in range(node.min_count - 1):
+        longer = _cross_product(affix, child)
+        if longer is None:
+            break
+        affix = longer
+    return affix
+
+def required_literals(node):
+    """
+    Returns a set of strings such that every match of node contains at least one of them,
+    or None if no useful set exists.
+    """
+    best = None
+    exact = _exact_strings(node)
+    if exact is not None:
+        best = _better_literals(best, exact)
+    if isinstance(node, CaptureGroupNode):
+        best = _better_literals(best, required_literals(node._child))
+    elif isinstance(node, QuantifierNode) and node.min_count > 0:
+        best = _better_literals(best, required_literals(node._child))
+        best = _better_literals(best, _repeated_affix(node))
+    elif isinstance(node, AlternationNode):
+        strings = set()
+        for branch in node.children:
+            branch_strings = required_literals(branch)
+            if branch_strings is None:
+                return best
+            strings |= branch_strings
+        best = _better_literals(best, strings)
+    elif isinstance(node, ConcatenationNode):
+        # Consecutive children with exact strings form a literal run, e.g. "ERROR ".
+        run = {''}
+        for child in node.children:
+            child_exact = _exact_strings(child)
+            extended = _cross_product(run, child_exact)
+            if extended is None:
+                # A repetition such as (ab|cd){3,5} continues the run with its first copies,
+                # and its last copies start the next run.
+                affix = _repeated_affix(child) if child_exact is None else None
+                best = _better_literals(best, _cross_product(run, affix) or run)
+                run = child_exact if child_exact is not None else affix or {''}
+                if child_exact is None:
+                    best = _better_literals(best, required_literals(child))
+            else:
+                run = extended
+        best = _better_literals(best, run)
+    if best is None or '' in best:
+        return None
+    return best
+
+class LiteralPrefilter:
+    """Rejects lines that contain none of the literals every match requires."""
+    def __init__(self, literals, exact=False):
+        self.literals = sorted(literals)
+        self.exact = exact # True if containing a literal is all the pattern requires
+        self.encoded = [literal.encode('utf-8') for literal in self.literals] # For raw buffers
+        self.kind = 'literal' if len(self.literals) == 1 else 'literal-set'
+
+    def might_match(self, line):
+        if len(self.literals) == 1:
+            return self.literals[0] in line
+        for literal in self.literals:
+            if literal in line:
+                return True
+        return False
+
+    def __repr__(self):
+        return f"LiteralPrefilter(kind='{self.kind}', literals={self.literals!r}, exact={self.exact})"
+
+def build_prefilter(ast):
+    literals = required_literals(ast)
+    if literals is None:
+        return None
+    # A pattern made only of literals (no anchors) matches exactly when a literal is present.
+    exact = literals == _exact_strings(ast) and not any(isinstance(node, AnchorNode) for node in ast.walk())
+    return LiteralPrefilter(literals, exact)
+
+class LineMatcher:
+    """
+    Answers "does this line match?" for a parsed pattern. Lines are first checked against
+    the required-literal prefilter, then run on the fastest available engine: the lazy DFA,
+    the Pike VM if the DFA cache thrashes, or the backtracker for patterns with backreferences
+    or with counted repetitions too large for MAX_PROGRAM_SIZE.
+
+    Patterns anchored with '$' (but not '^') are matched backwards from the end of the line,
+    so the DFA stops as soon as the suffix can no longer match.
+    """
+    def __init__(self, ast, parser, dfa_cache_size=DFA_CACHE_SIZE):
+        self.ast = ast
+        self.parser = parser
+        self.prefilter = build_prefilter(ast)
+        self.program = nfa_program(ast, parser.group_count)
+        self.backtracker = None if self.program is not None else Backtracker(ast, parser.group_count)
+        self.dfa = None
+        self.reverse = False
+        if self.program is not None:
+            self.starts = compile_start_filter(ast)
+            self.reverse = is_end_anchored(ast) and not self.starts.anchored
+            if self.reverse:
+                reversed_program = compile_program(reverse_ast(ast), parser.group_count)
+                self.dfa = LazyDFA(reversed_program, dfa_cache_size, anchored=True)
+            else:
+                self.dfa = LazyDFA(self.program, dfa_cache_size, anchored=self.starts.anchored,
+                                   starts=self.starts)
+        if self.prefilter is not None and self.prefilter.exact:
+            self.engine = 'literal'
+        elif self.dfa is not None:
+            self.engine = 'reverse-dfa' if self.reverse else 'dfa'
+        else:
+            self.engine = 'backtrack'
+
+    def matches(self, line):
+        if self.prefilter is not None and not self.prefilter.might_match(line):
+            return False
+        return self.engine_matches(line)
+
+    def engine_matches(self, line):
+        """Like matches(), for lines whose raw bytes are already known to pass the prefilter."""
+        if self.prefilter is not None and self.prefilter.exact:
+            return self.prefilter.might_match(line)
+        if self.dfa is not None:
+            result = self.dfa.search(line[::-1] if self.reverse else line)
+            if result is None:
+                result = pike_vm(self.program, line, self.starts) is not None
+            return result
+        return self.backtracker.search(line) is not None
+
+    def batch_dfa(self):
+        """The BatchDFA of the pattern, or None if lines must be matched one at a time."""
+        if self.dfa is None:
+            return None
+        if self.prefilter is not None and (self.prefilter.exact or
+                                           min(map(len, self.prefilter.literals)) >= BATCH_PREFILTER_MIN):
+            return None
+        return compile_batch_dfa(self.ast, self.parser.group_count)
+
+    def stats(self):
+        if self.dfa is not None:
+            return {'dfa': self.dfa.stats()}
+        return {'backtrack_memo': self.backtracker.memo.stats()}
+
+# --- Multi-pattern search ---
+# Patterns given with repeated -e flags or read from a -f file are searched together. Patterns
+# that only ever match a fixed set of strings go into one Aho-Corasick automaton, so a single
+# pass over a line checks all of them. The remaining patterns are joined into one alternation
+# and run on a single DFA, except those with backreferences, whose group numbers would shift,
+# and those too large to compile into an NFA program.
+
+class AhoCorasick:
+    """Finds whether any of a set of literal strings occurs in a line, in one pass."""
+    def __init__(self, keywords):
+        self.keywords = sorted(set(keywords))
+        goto = [{}]
+        accepting = [False]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if char not in goto[state]:
+                    goto[state][char] = len(goto)
+                    goto.append({})
+                    accepting.append(False)
+                state = goto[state][char]
+            accepting[state] = True
+
+        # Breadth-first, each state's transitions are its failure state's transitions overlaid
+        # with its own trie edges, giving a DFA that needs one dict lookup per character.
+        self.delta = [dict(goto[0])]
+        self.delta.extend({} for _ in range(len(goto) - 1))
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            transitions = dict(self.delta[fail[state]])
+            transitions.update(goto[state])
+            self.delta[state] = transitions
+            accepting[state] = accepting[state] or accepting[fail[state]]
+            for char, child in goto[state].items():
+                fail[child] = self.delta[fail[state]].get(char, 0)
+                queue.append(child)
+        self.accepting = accepting
+
+    def search(self, line):
+        if self.accepting[0]: # The empty string matches every line
+            return True
+        delta = self.delta
+        accepting = self.accepting
+        state = 0
+        for char in line:
+            state = delta[state].get(char, 0)
+            if accepting[state]:
+                return True
+        return False
+
+    def __repr__(self):
+        return f"AhoCorasick(keywords={len(self.keywords)}, states={len(self.delta)})"
+
+def literal_strings(ast):
+    """Returns the strings a pattern matches if it is a plain set of literals, else None."""
+    if ast is not None and any(isinstance(node, AnchorNode) for node in ast.walk()):
+        return None
+    return _exact_strings(ast)
+
+class MultiPatternMatcher:
+    """
+    A line matches if any of several patterns matches it. The patterns are given as
+    (pattern, ast, parser) triples.
+    """
+    def __init__(self, parsed, dfa_cache_size=DFA_CACHE_SIZE):
+        keywords = []
+        regex_patterns = []
+        self.matchers = []
+        for pattern, ast, parser in parsed:
+            strings = literal_strings(ast)
+            if strings is not None:
+                keywords.extend(strings)
+            elif nfa_program(ast, parser.group_count) is None:
+                self.matchers.append(LineMatcher(ast, parser, dfa_cache_size))
+            else:
+                regex_patterns.append(pattern)
+        self.automaton = AhoCorasick(keywords) if keywords else None
+        if regex_patterns:
+            # Each pattern parsed on its own above, so joining them at the top level is safe.
+            parser = RegexParser('|'.join(regex_patterns))
+            self.matchers.insert(0, LineMatcher(parser.parse(), parser, dfa_cache_size))
+        # Lines are checked by the automaton and engines directly, not prefiltered.
+        self.prefilter = None
+        engines = ['aho-corasick'] if self.automaton is not None else []
+        self.engine = 'multi(' + ', '.join(engines + [matcher.engine for matcher in self.matchers]) + ')'
+
+    def matches(self, line):
+        return self.engine_matches(line)
+
+    def engine_matches(self, line):
+        if self.automaton is not None and self.automaton.search(line):
+            return True
+        for matcher in self.matchers:
+            if matcher.matches(line):
+                return True
+        return False
+
+    def batch_dfa(self):
+        return None
+
+    def stats(self):
+        return {'aho_corasick': repr(self.automaton),
+                'patterns': [matcher.stats() for matcher in self.matchers]}
+
+def build_matcher(patterns, dfa_cache_size=DFA_CACHE_SIZE):
+    started = time.perf_counter()
+    parsed = []
+    for pattern in patterns:
+        parser = RegexParser(pattern)
+        parsed.append((pattern, parser.parse(), parser))
+    compile_started = time.perf_counter()
+    if len(parsed) == 1:
+        _, ast, parser = parsed[0]
+        matcher = LineMatcher(ast, parser, dfa_cache_size)
+    else:
+        matcher = MultiPatternMatcher(parsed, dfa_cache_size)
+    if STATS is not None:
+        STATS.parse_seconds += compile_started - started
+        STATS.compile_seconds += time.perf_counter() - compile_started
+    return matcher
+
+# --- Compiled patterns (compile) ---
+# compile() parses a pattern once into a Pattern, for programs that use this file as a
+# library and for -o. A Pattern reports where matches are, with their group captures:
+# patterns without backreferences run on the Pike VM, the others on the backtracker.
+# Whole-string searches are first rejected cheaply by the line matcher (prefilter and DFA).
+# A Pattern can be shared between threads: the DFA cache and the backtracking memo, the
+# only state that changes while matching, are used under the Pattern's lock.
+
+class Match:
+    """
+    A match of a Pattern in a string. Group 0 is the whole match, and groups that did not
+    take part in it have the span (-1, -1) and the value None.
+    """
+    def __init__(self, pattern, string, slots):
+        self.re = pattern
+        self.string = string
+        self._slots = slots # Start and end of each group, as in the Pike VM
+
+    def _check(self, group):
+        if not 0 <= group <= self.re.groups:
+            raise IndexError(f"no such group: {group}")
+
+    def span(self, group=0):
+        self._check(group)
+        start, end = self._slots[2 * group], self._slots[2 * group + 1]
+        if start is None or end is None:
+            return -1, -1
+        return start, end
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def group(self, *groups):
+        """Returns the text of a group (the whole match by default), or a tuple for several."""
+        if len(groups) > 1:
+            return tuple(self.group(group) for group in groups)
+        group = groups[0] if groups else 0
+        self._check(group)
+        start, end = self._slots[2 * group], self._slots[2 * group + 1]
+        if start is None or end is None:
+            return None
+        return self.string[start:end]
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+    def groups(self, default=None):
+        """Returns the texts of groups 1 and up, with default for those that did not match."""
+        return tuple(default if text is None else text
+                     for text in (self.group(group) for group in range(1, self.re.groups + 1)))
+
+    def __repr__(self):
+        return f"<Match span={self.span()!r} match={self.group()!r}>"
+
+class Pattern:
+    """A parsed pattern with its compiled engines (see compile)."""
+    def __init__(self, pattern, dfa_cache_size=DFA_CACHE_SIZE):
+        parser = RegexParser(pattern)
+        self.pattern = pattern
+        self.ast = parser.parse()
+        self.groups = parser.group_count
+        self.dfa_cache_size = dfa_cache_size
+        self._matcher = LineMatcher(self.ast, parser, dfa_cache_size)
+        # fullmatch runs the pattern between '^' and '$' anchors.
+        self._full_ast = ConcatenationNode([AnchorNode('start'), self.ast, AnchorNode('end')])
+        # (program, StartFilter, None) for the Pike VM or (None, None, Backtracker), for search
+        # and fullmatch. They are held here because the module's compile caches only keep the
+        # most recent patterns; search uses the line matcher's.
+        matcher = self._matcher
+        if matcher.program is not None:
+            self._search_engine = (matcher.program, matcher.starts, None)
+        else:
+            self._search_engine = (None, None, matcher.backtracker)
+        self._full_engine = self._compile_engine(self._full_ast)
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # The lock cannot be pickled, so a copy (e.g. in a -j worker) is compiled afresh.
+        return Pattern, (self.pattern, self.dfa_cache_size)
+
+    def __repr__(self):
+        return f"Pattern({self.pattern!r})"
+
+    def _may_match(self, string):
+        matcher = self._matcher
+        if matcher.prefilter is not None and not matcher.prefilter.might_match(string):
+            return False
+        if matcher.dfa is None:
+            return True # The backtracker runs once, in _find
+        with self._lock:
+            return matcher.engine_matches(string)
+
+    def _compile_engine(self, ast):
+        program = nfa_program(ast, self.groups)
+        if program is not None:
+            return program, StartFilter(ast), None
+        return None, None, Backtracker(ast, self.groups)
+
+    def _find(self, engine, string, pos, after_empty=False):
+        program, starts, backtracker = engine
+        if program is not None:
+            slots = pike_vm(program, string, starts, pos, after_empty)
+        else:
+            with self._lock:
+                slots = backtracker.search(string, pos, after_empty)
+        return None if slots is None else Match(self, string, slots)
+
+    def search(self, string, pos=0):
+        """Returns the leftmost match in string that starts at pos or later, or None."""
+        pos = min(pos, len(string))
+        if pos == 0 and not self._may_match(string):
+            return None
+        return self._find(self._search_engine, string, pos)
+
+    def fullmatch(self, string):
+        """Returns the match of the pattern that spans all of string, or None."""
+        if not self._may_match(string):
+            return None
+        return self._find(self._full_engine, string, 0)
+
+    def finditer(self, string, pos=0):
+        """
+        Yields the non-overlapping matches in string, left to right, from pos on. Each
+        search resumes where the previous match ended, so the string is scanned once. As in
+        re, an empty match may be followed by a non-empty one at the same position.
+        """
+        if pos == 0 and not self._may_match(string):
+            return
+        after_empty = False
+        while pos <= len(string):
+            match = self._find(self._search_engine, string, pos, after_empty)
+            if match is None:
+                if not after_empty:
+                    return
+                after_empty, pos = False, pos + 1
+                continue
+            yield match
+            start, end = match.span()
+            pos, after_empty = end, end == start
+
+def compile(pattern):
+    """Parses and compiles pattern into a Pattern, raising ValueError if it is invalid."""
+    return Pattern(pattern)
+
+DEBUG = False
+
+def debug(message):
+    if DEBUG:
+        print(f"debug: {message}", file=sys.stderr)
+
+# --- Statistics (--stats) ---
+# STATS is None unless --stats is given. Code paths that collect statistics check it once per
+# buffer, file or compiled pattern and switch to counting variants, so a normal search runs
+# exactly the same code as before.
+
+STATS = None
+SLOWEST_FILES = 10 # Files listed in the --stats report
+STATS_COUNT_SLICE = 1024 * 1024 # Bytes copied at a time when counting lines (also for -n)
+
+def _count_newlines(buf, start, end):
+    # mmap has no count(), so newlines are counted in slices of a bounded size.
+    lines = 0
+    for pos in range(start, end, STATS_COUNT_SLICE):
+        lines += buf[pos:min(pos + STATS_COUNT_SLICE, end)].count(b"\n")
+    return lines
+
+class SearchStats:
+    """Counters and timings for one search, reported by --stats."""
+    def __init__(self):
+        self.lines = 0 # Lines scanned
+        self.bytes = 0 # Bytes scanned
+        self.prefilter_rejects = 0 # Lines skipped by the literal prefilter without decoding
+        self.lines_matched = 0
+        self.nodes_evaluated = 0 # Backtracker node evaluations
+        self.backtracks = 0 # Times the backtracker went back to a node for another way to match
+        self.parse_seconds = 0.0
+        self.compile_seconds = 0.0
+        self.match_seconds = 0.0
+        self.file_seconds = {} # filename -> seconds spent searching it
+
+    def record_scan(self, buf, start, end, candidates, matched):
+        lines = _count_newlines(buf, start, end)
+        if end > start and buf[end - 1:end] != b"\n":
+            lines += 1 # The last line has no newline in the range
+        self.lines += lines
+        self.bytes += end - start
+        self.prefilter_rejects += lines - candidates
+        self.lines_matched += matched
+
+    def record_file(self, filename, seconds):
+        self.file_seconds[filename] = self.file_seconds.get(filename, 0.0) + seconds
+
+    def merge(self, other):
+        # Adds the counters collected by a worker process.
+        for name in ('lines', 'bytes', 'prefilter_rejects', 'lines_matched', 'nodes_evaluated', 'backtracks'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for filename, seconds in other.file_seconds.items():
+            self.record_file(filename, seconds)
+
+    def report(self, matcher):
+        slowest = sorted(self.file_seconds.items(), key=lambda item: item[1], reverse=True)
+        return {
+            'engine': matcher.engine,
+            'lines_scanned': self.lines,
+            'bytes_scanned': self.bytes,
+            'prefilter_rejects': self.prefilter_rejects,
+            'lines_matched': self.lines_matched,
+            'nodes_evaluated': self.nodes_evaluated,
+            'backtracks': self.backtracks,
+            'parse_seconds': round(self.parse_seconds, 6),
+            'compile_seconds': round(self.compile_seconds, 6),
+            'match_seconds': round(self.match_seconds, 6),
+            'slowest_files': [{'file': filename, 'seconds': round(seconds, 6)}
+                              for filename, seconds in slowest[:SLOWEST_FILES]],
+            'engine_stats': matcher.stats(),
+        }
+
+def format_stats(report):
+    lines = ["stats:"]
+    for key, value in report.items():
+        if key == 'slowest_files':
+            lines.append("  slowest files:")
+            lines.extend(f"    {entry['seconds'] * 1000:10.3f}ms  {entry['file']}" for entry in value)
+        elif key.endswith('_seconds'):
+            lines.append(f"  {key[:-len('_seconds')].replace('_', ' ')} time: {value * 1000:.3f}ms")
+        else:
+            lines.append(f"  {key.replace('_', ' ')}: {value}")
+    return "\n".join(lines)
+
+def _pop_option(args, name):
+    """Removes '--name VALUE' or '--name=VALUE' from args and returns VALUE (or None)."""
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            args.pop(i)
+            return args.pop(i)
+        if arg.startswith(name + '='):
+            args.pop(i)
+            return arg[len(name) + 1:]
+    return None
+
+def _pop_options(args, name):
+    """Like _pop_option, for an option that can be repeated: returns every VALUE in order."""
+    values = []
+    value = _pop_option(args, name)
+    while value is not None:
+        values.append(value)
+        value = _pop_option(args, name)
+    return values
+
+def _pop_pattern_options(args):
+    """
+    Removes -E PATTERN, -e PATTERN (or -e=PATTERN) and -f FILE (or -f=FILE) from args,
+    left to right, so each takes the argument after it even if that looks like a flag,
+    e.g. the pattern in -E "-c". Returns (the -E pattern or None, the other patterns, the
+    -f file or None); a repeated -E adds to the other patterns. A trailing -E is left in
+    args.
+    """
+    pattern, patterns, pattern_file = None, [], None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-E', '-e', '-f') and i + 1 < len(args):
+            args.pop(i)
+            value = args.pop(i)
+        elif arg.startswith(('-e=', '-f=')):
+            args.pop(i)
+            arg, value = arg[:2], arg[3:]
+        else:
+            i += 1
+            continue
+        if arg == '-E' and pattern is None:
+            pattern = value
+        elif arg == '-f':
+            pattern_file = value
+        else:
+            patterns.append(value)
+    return pattern, patterns, pattern_file
+
+# --- File scanning ---
+# Regular files are memory-mapped and scanned as raw bytes: line boundaries are found with
+# bytes.find(b"\n"), and with a literal prefilter the buffer is searched for the literals
+# directly, so lines that cannot match are never sliced or decoded. Pipes, stdin and other
+# special files, which cannot be mapped, are read in large chunks that are scanned the same way.
+
+STREAM_READ_SIZE = 128 * 1024 # Bytes requested per read from pipes and stdin
+BINARY_BLOCK_SIZE = 32 * 1024 # Bytes checked for a NUL byte to detect binary files
+
+class BinaryFileMatches(Exception):
+    """Raised by scan_file at the first match in a binary file reported as 'binary'."""
+
+class BinaryFiles:
+    """
+    How files with a NUL byte in their first block_size bytes are searched: 'binary' (the
+    default) reports "Binary file X matches" instead of printing lines, 'without-match'
+    skips them without reading any further, and 'text' searches them like any other file.
+    The check is made on the first block only, before any line is matched.
+    """
+    def __init__(self, mode='binary', block_size=BINARY_BLOCK_SIZE):
+        self.mode = mode
+        self.block_size = block_size
+
+    def is_binary(self, head):
+        return self.mode != 'text' and head.find(b"\0", 0, self.block_size) >= 0
+
+    def __repr__(self):
+        return f"BinaryFiles({self.mode!r}, {self.block_size})"
+
+SEARCH_BINARY = BinaryFiles()
+
+def _candidate_lines(buf, start, end, prefilter):
+    """Yields (line_start, line_end) for the lines of buf[start:end] that may match."""
+    if prefilter is None:
+        pos = start
+        while pos < end:
+            newline = buf.find(b"\n", pos, end)
+            line_end = end if newline < 0 else newline
+            yield pos, line_end
+            pos = line_end + 1
+        return
+
+    if len(prefilter.encoded) == 1:
+        literal = prefilter.encoded[0]
+        pos = start
+        while True:
+            hit = buf.find(literal, pos, end)
+            if hit < 0:
+                return
+            newline = buf.rfind(b"\n", pos, hit)
+            line_start = pos if newline < 0 else newline + 1
+            newline = buf.find(b"\n", hit, end)
+            line_end = end if newline < 0 else newline
+            yield line_start, line_end
+            pos = line_end + 1
+
+    literals = prefilter.encoded
+    next_hits = [buf.find(literal, start, end) for literal in literals]
+    pos = start # Always the start of a line
+    while pos < end:
+        # The earliest literal occurrence at or after pos; stale positions are searched again.
+        hit = -1
+        for i, next_hit in enumerate(next_hits):
+            if 0 <= next_hit < pos:
+                next_hit = next_hits[i] = buf.find(literals[i], pos, end)
+            if next_hit >= 0 and (hit < 0 or next_hit < hit):
+                hit = next_hit
+        if hit < 0:
+            return
+        newline = buf.rfind(b"\n", pos, hit)
+        line_start = pos if newline < 0 else newline + 1
+        newline = buf.find(b"\n", hit, end)
+        line_end = end if newline < 0 else newline
+        yield line_start, line_end
+        pos = line_end + 1
+
+def scan_buffer(buf, matcher, start=0, end=None):
+    """Yields the matching lines (decoded and stripped) of buf[start:end]."""
+    if end is None:
+        end = len(buf)
+    if STATS is not None:
+        yield from _scan_buffer_counted(buf, matcher, start, end, STATS)
+        return
+    if end - start >= BATCH_MIN_BYTES:
+        batch = matcher.batch_dfa()
+        if batch is not None:
+            yield from _scan_buffer_batched(buf, matcher, batch, start, end)
+            return
+    for line_start, line_end in _candidate_lines(buf, start, end, matcher.prefilter):
+        clean_line = buf[line_start:line_end].decode('utf-8', 'replace').strip()
+        if matcher.engine_matches(clean_line):
+            yield clean_line
+
+def scan_buffer_spans(buf, matcher, start=0, end=None):
+    """Like scan_buffer, but yields (line_start, line_end, clean_line) for each match."""
+    if end is None:
+        end = len(buf)
+    candidates = matched = 0
+    for line_start, line_end in _candidate_lines(buf, start, end, matcher.prefilter):
+        candidates += 1
+        clean_line = buf[line_start:line_end].decode('utf-8', 'replace').strip()
+        if matcher.engine_matches(clean_line):
+            matched += 1
+            yield line_start, line_end, clean_line
+    if STATS is not None:
+        STATS.record_scan(buf, start, end, candidates, matched)
+
+class LocatedLine:
+    """
+    A matching line with its position, for -n and -b: the 1-based line number, the byte
+    offset of the line in its file, and the byte length of the whitespace stripped from its start.
+    """
+    def __init__(self, text, number, offset, indent):
+        self.text = text
+        self.number = number
+        self.offset = offset
+        self.indent = indent
+
+    def __repr__(self):
+        return f"LocatedLine({self.text!r}, number={self.number}, offset={self.offset})"
+
+def scan_buffer_located(buf, matcher, start=0, end=None, number=1, offset=0):
+    """
+    Like scan_buffer, but yields a LocatedLine for each match. 'number' is the line number
+    of the line at start, and 'offset' the position of buf in its file.
+    """
+    counted = start # Newlines before this position are included in number
+    for line_start, line_end, clean_line in scan_buffer_spans(buf, matcher, start, end):
+        number += _count_newlines(buf, counted, line_start)
+        counted = line_start
+        raw_line = buf[line_start:line_end].decode('utf-8', 'replace')
+        indent = len(raw_line[:len(raw_line) - len(raw_line.lstrip())].encode('utf-8'))
+        yield LocatedLine(clean_line, number, offset + line_start, indent)
+
+def _scan_buffer_batched(buf, matcher, batch, start, end):
+    # scan_buffer with a BatchDFA, one block of whole lines at a time. Blocks are copied out
+    # of buf, so no NumPy array holds on to an mmap.
+    pos = start
+    while pos < end:
+        block_end = min(pos + BATCH_BLOCK_SIZE, end)
+        if block_end < end:
+            newline = buf.rfind(b"\n", pos, block_end)
+            if newline < 0:
+                newline = buf.find(b"\n", block_end, end)
+            block_end = end if newline < 0 else newline + 1
+        block = buf[pos:block_end]
+        prefilter = matcher.prefilter
+        if prefilter is not None and (sum(block.count(literal) for literal in prefilter.encoded) *
+                                      BATCH_SPARSE_HITS < block.count(b"\n")):
+            # The prefilter's literals are rare here, so skipping lines beats matching them all
+            for line_start, line_end in _candidate_lines(block, 0, len(block), prefilter):
+                clean_line = block[line_start:line_end].decode('utf-8', 'replace').strip()
+                if matcher.engine_matches(clean_line):
+                    yield clean_line
+        else:
+            yield from batch.scan_block(block, matcher)
+        pos = block_end
+
+def _scan_buffer_counted(buf, matcher, start, end, stats):
+    # scan_buffer for --stats. If the caller stops early (-q, -l, -m), only the part of the
+    # buffer that was actually scanned is recorded.
+    candidates = matched = 0
+    scanned = start
+    try:
+        for line_start, line_end in _candidate_lines(buf, start, end, matcher.prefilter):
+            candidates += 1
+            scanned = min(line_end + 1, end)
+            clean_line = buf[line_start:line_end].decode('utf-8', 'replace').strip()
+            if matcher.engine_matches(clean_line):
+                matched += 1
+                yield clean_line
+        scanned = end
+    finally:
+        stats.record_scan(buf, start, scanned, candidates, matched)
+
+def scan_stream(stream, matcher, read_size=STREAM_READ_SIZE, head=b"", located=False):
+    """
+    Yields the matching lines of a binary stream as soon as each line is complete.
+    read1() returns whatever data is available, so slow producers (tail -f) are not held up
+    waiting for a full chunk. Memory is bounded by read_size plus the longest line.
+    'head' is data already read from the stream, which is scanned first.
+    With located=True, LocatedLine objects are yielded instead of strings.
+    """
+    read = getattr(stream, 'read1', stream.read)
+    partial = [] # Pieces of a line whose newline has not arrived yet
+    number, offset = 1, 0 # Line number and stream position of the next chunk
+    def scan(buf, end=None):
+        if located:
+            return scan_buffer_located(buf, matcher, 0, end, number, offset)
+        return scan_buffer(buf, matcher, 0, end)
+    while True:
+        chunk = head or read(read_size)
+        head = b""
+        if not chunk:
+            break
+        last_newline = chunk.rfind(b"\n")
+        if last_newline < 0:
+            partial.append(chunk)
+            continue
+        if partial:
+            partial.append(chunk)
+            chunk = b"".join(partial)
+            partial = []
+            last_newline = chunk.rfind(b"\n")
+        yield from scan(chunk, last_newline)
+        if located:
+            number += chunk.count(b"\n", 0, last_newline + 1)
+            offset += last_newline + 1
+        if last_newline + 1 < len(chunk):
+            partial.append(chunk[last_newline + 1:])
+    if partial:
+        yield from scan(b"".join(partial))
+
+def _map_file(f):
+    # Returns a read-only mmap of f, or None for empty, special or unmappable files.
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+def scan_file(filename, matcher, binary_files=None, located=False):
+    """
+    Yields the matching lines of a file, using mmap where possible. Binary files are
+    handled as binary_files says; by default every file is searched as text.
+    With located=True, LocatedLine objects are yielded instead of strings.
+    """
+    with open(filename, 'rb') as f:
+        yield from scan_open_file(f, matcher, binary_files, located)
+
+def scan_open_file(f, matcher, binary_files=None, located=False):
+    """scan_file for a file object opened in binary mode, such as sys.stdin.buffer."""
+    buf = _map_file(f)
+    if buf is None:
+        head = b""
+        if binary_files is not None:
+            read = getattr(f, 'read1', f.read)
+            head = read(binary_files.block_size)
+        yield from _check_binary(scan_stream(f, matcher, head=head, located=located), head, binary_files)
+        return
+    with buf:
+        lines = scan_buffer_located(buf, matcher) if located else scan_buffer(buf, matcher)
+        yield from _check_binary(lines, buf, binary_files)
+
+def _check_binary(lines, head, binary_files):
+    # Yields lines, unless head (the start of the file) shows a binary file that binary_files
+    # skips or reports. Nothing is read from a skipped file.
+    if binary_files is not None and binary_files.is_binary(head):
+        if binary_files.mode == 'binary' and next(lines, None) is not None:
+            raise BinaryFileMatches()
+        return
+    yield from lines
+
+def search_file(filename, matcher, print_filenames, output=None, binary_files=None, data=None):
+    """
+    Searches a single file for the pattern defined by the AST, reporting the result as the
+    OutputMode says (by default, every matching line is printed). Binary files are handled
+    as binary_files says (by default, "Binary file X matches" is printed for them).
+    'data' is the file's content if it has already been read (see search_pipelined).
+
+    Returns:
+        True if a match was found in this file (with -L: if it had none and was listed),
+        False otherwise.
+    """
+    output = output or PRINT_LINES
+    binary_files = _binary_files_for(output, binary_files or SEARCH_BINARY)
+    file_had_match = False
+    started = time.perf_counter()
+    try:
+        if data is not None:
+            lines = scan_buffer_located(data, matcher) if output.located else scan_buffer(data, matcher)
+            lines = _check_binary(lines, data, binary_files)
+        else:
+            lines = _file_lines(filename, matcher, binary_files, output)
+        if output.mode == 'lines':
+            for line in output.limit(lines):
+                _print_match(filename, line, print_filenames, output)
+                file_had_match = True
+        else:
+            file_had_match = output.emit(output.collect(lines), filename, print_filenames)
+    except BinaryFileMatches:
+        _print_binary_match(filename)
+        file_had_match = True
+    except OSError:
+        # Silently skip files that can't be read (e.g., permissions errors).
+        # You could print an error to stderr here if you prefer. Errors from the matcher
+        # are not caught: skipping the file would silently drop its matches.
+        pass
+    if STATS is not None:
+        STATS.record_file(filename, time.perf_counter() - started)
+    
+    return file_had_match
+
+def _print_match(filename, line, print_filenames, output=None):
+    # line is a LocatedLine with -n or -b. With -o, each match in the line is printed on a
+    # line of its own, and -b gives the offset of the match instead of the line's.
+    output = output or PRINT_LINES
+    prefix = f"{filename}:" if print_filenames else ""
+    text = line
+    if isinstance(line, LocatedLine):
+        text = line.text
+        if output.line_numbers:
+            prefix += f"{line.number}:"
+    if output.only_matching is None:
+        if output.byte_offsets:
+            prefix += f"{line.offset}:"
+        print(prefix + text)
+        return
+    for match in only_matches(output.only_matching, text):
+        if output.byte_offsets:
+            offset = line.offset + line.indent + len(text[:match.start()].encode('utf-8'))
+            print(f"{prefix}{offset}:{match.group()}")
+        else:
+            print(prefix + match.group())
+
+def only_matches(patterns, text):
+    """
+    Yields the matches -o prints: the non-empty, non-overlapping matches of any of the
+    Patterns in text, leftmost first (the longest, when several start at the same place).
+    """
+    if len(patterns) == 1:
+        for match in patterns[0].finditer(text):
+            if match.end() > match.start():
+                yield match
+        return
+    pos = 0
+    while pos <= len(text):
+        found = [match for match in (pattern.search(text, pos) for pattern in patterns) if match is not None]
+        if not found:
+            return
+        match = min(found, key=lambda match: (match.start(), match.start() - match.end()))
+        if match.end() > match.start():
+            yield match
+            pos = match.end()
+        else:
+            pos = match.start() + 1
+
+def _print_binary_match(filename):
+    print(f"Binary file {filename} matches")
+
+def _binary_files_for(output, binary_files):
+    # Only printed lines are replaced by "Binary file X matches"; -c, -l, -L and -q treat
+    # binary files that are not skipped like text.
+    if output.mode != 'lines' and binary_files.mode == 'binary':
+        return BinaryFiles('text', binary_files.block_size)
+    return binary_files
+
+class OutputMode:
+    """
+    What is reported for each file: every matching line ('lines', the default), nothing
+    ('quiet', -q), the file name if it has a match ('files-with-matches', -l) or has none
+    ('files-without-match', -L), or the number of matching lines ('count', -c).
+    max_count (-m NUM) stops reading a file after NUM matching lines.
+
+    Matching lines are consumed lazily and only as far as the mode needs, so -q, -l and -L
+    stop reading a file at its first match and -m stops at the NUMth.
+
+    In 'lines' mode, only_matching (-o) is a list of Patterns whose matches are printed
+    instead of whole lines, and line_numbers (-n) and byte_offsets (-b) prefix each line.
+    """
+    def __init__(self, mode='lines', max_count=None, only_matching=None, line_numbers=False,
+                 byte_offsets=False):
+        self.mode = mode
+        self.max_count = max_count
+        self.only_matching = only_matching
+        self.line_numbers = line_numbers
+        self.byte_offsets = byte_offsets
+
+    @property
+    def located(self):
+        """True if the matching lines must be LocatedLine objects."""
+        return self.mode == 'lines' and (self.line_numbers or self.byte_offsets)
+
+    def limit(self, lines):
+        return lines if self.max_count is None else itertools.islice(lines, self.max_count)
+
+    def collect(self, lines):
+        """Returns what the mode needs from lines: a list of lines, a count, or whether any matched."""
+        lines = self.limit(lines)
+        if self.mode == 'lines':
+            return list(lines)
+        if self.mode == 'count':
+            return sum(1 for _ in lines)
+        return next(lines, None) is not None
+
+    def merge(self, first, second):
+        """Combines the collected results of two consecutive parts of one file."""
+        if self.mode == 'lines':
+            return self.collect(itertools.chain(first, second))
+        if self.mode == 'count':
+            total = first + second
+            return total if self.max_count is None else min(total, self.max_count)
+        return first or second
+
+    def emit(self, result, filename, print_filename):
+        """Prints a collected result. Returns True if the file counts as a success."""
+        if self.mode == 'lines':
+            for line in result:
+                _print_match(filename, line, print_filename, self)
+            return bool(result)
+        if self.mode == 'count':
+            print(f"{filename}:{result}" if print_filename else result)
+            return result > 0
+        if self.mode == 'files-without-match':
+            if not result:
+                print(filename)
+            return not result
+        if self.mode == 'files-with-matches' and result:
+            print(filename)
+        return result
+
+PRINT_LINES = OutputMode()
+STDIN_NAME = '(standard input)' # Name printed for stdin by -l, -L and -c
+
+# --- Directory traversal (-r) ---
+# Directories are read with os.scandir, whose DirEntry objects carry the file type from the
+# directory listing, so most entries are classified without a stat call. Files are yielded
+# as each directory is read, so searching starts before the walk is finished, in the same
+# order as os.walk: a directory's files, then its subdirectories, depth first.
+# .git is never entered, and .gitignore and .ignore files prune what they exclude.
+
+IGNORE_FILES = ('.gitignore', '.ignore') # Read in this order; later rules win
+SKIPPED_DIRS = frozenset(['.git'])
+INDEX_NAME = '.grep-index' # The trigram index of a directory, stored in it
+SKIPPED_FILES = frozenset([INDEX_NAME, INDEX_NAME + '.tmp'])
+
+def _glob_regex(glob):
+    # Translates a gitignore glob to a regex: '*', '?' and [...] stay within one path
+    # segment, and '**' spans segments.
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif glob[i] == '[' and glob.find(']', i + 2) > 0:
+            close = glob.find(']', i + 2)
+            body = glob[i + 1:close].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append(f"[{body}]")
+            i = close + 1
+        elif glob[i] == '\\' and i + 1 < len(glob):
+            parts.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return ''.join(parts)
+
+class IgnoreFile:
+    """
+    The rules of one .gitignore or .ignore file, which apply below its directory.
+    Supported: blank lines and # comments, ! negation, a trailing / for directories only,
+    and patterns containing a / being relative to the file's directory (others match the
+    name at any depth).
+    """
+    def __init__(self, directory, lines):
+        self.prefix = os.path.join(directory, '')
+        self.rules = [] # (compiled regex, negated, directories only, matches the whole relative path)
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            elif line.startswith('\\'):
+                line = line[1:] # \# and \! are literal
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line:
+                regex = re.compile(_glob_regex(line) + r'\Z', re.DOTALL)
+                self.rules.append((regex, negated, dir_only, anchored))
+
+    @classmethod
+    def read(cls, path):
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                return cls(os.path.dirname(path), f)
+        except OSError:
+            return None
+
+    def match(self, path, is_dir):
+        """True if path is ignored, False if it is re-included with !, None if no rule applies."""
+        relative = path[len(self.prefix):]
+        name = relative.rpartition('/')[2]
+        result = None
+        for regex, negated, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative if anchored else name):
+                result = not negated
+        return result
+
+class WalkFilter:
+    """
+    Which files and directories a recursive search visits: --include, --exclude and
+    --exclude-dir globs on the base name (an excluded directory is not entered), and the
+    ignore files unless use_ignore_files is False.
+    """
+    def __init__(self, include=(), exclude=(), exclude_dirs=(), use_ignore_files=True):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.exclude_dirs = list(exclude_dirs)
+        self.use_ignore_files = use_ignore_files
+
+    def wants_file(self, name):
+        if self.include and not any(fnmatch.fnmatchcase(name, glob) for glob in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(name, glob) for glob in self.exclude)
+
+    def wants_dir(self, name):
+        return name not in SKIPPED_DIRS and not any(fnmatch.fnmatchcase(name, glob) for glob in self.exclude_dirs)
+
+SEARCH_EVERYTHING = WalkFilter()
+
+def _ignored(path, is_dir, ignore_files):
+    # Inner ignore files override outer ones, and later rules override earlier ones.
+    for ignore_file in reversed(ignore_files):
+        result = ignore_file.match(path, is_dir)
+        if result is not None:
+            return result
+    return False
+
+def walk_files(top, walk_filter=SEARCH_EVERYTHING):
+    """Yields the regular files below the directory top (see the section comment)."""
+    stack = [(top, ())]
+    while stack:
+        directory, ignore_files = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue # Unreadable directories are skipped, like os.walk does
+        if walk_filter.use_ignore_files:
+            names = {entry.name for entry in entries}
+            for name in IGNORE_FILES:
+                if name in names:
+                    ignore_file = IgnoreFile.read(os.path.join(directory, name))
+                    if ignore_file is not None and ignore_file.rules:
+                        ignore_files += (ignore_file,)
+        subdirectories = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+                if is_dir:
+                    # Like os.walk, symlinks to directories are not followed.
+                    if entry.is_symlink() or not walk_filter.wants_dir(entry.name):
+                        continue
+                elif not entry.is_file() or entry.name in SKIPPED_FILES:
+                    continue # Devices, pipes and broken links are not searched
+                elif not walk_filter.wants_file(entry.name):
+                    continue
+            except OSError:
+                continue
+            if ignore_files and _ignored(entry.path, is_dir, ignore_files):
+                continue
+            if is_dir:
+                subdirectories.append(entry.path)
+            else:
+                yield entry.path
+        stack.extend((path, ignore_files) for path in reversed(subdirectories))
+
+def iter_search_targets(paths, recursive, print_filenames, walk_filter=SEARCH_EVERYTHING,
+                        use_index=False, index_query=None):
+    """
+    Yields (filename, print_filename) for every file to search, in walk order.
+    Invalid paths are reported on stderr and skipped. With use_index, the files of an
+    indexed directory are the index's candidates for index_query.
+    """
+    for path in paths:
+        if recursive and os.path.isdir(path):
+            filenames = None
+            if use_index:
+                filenames = indexed_files(path, index_query, walk_filter)
+                if filenames is None:
+                    debug(f"index: {path} has no index; walking it")
+            for filename in filenames or walk_files(path, walk_filter):
+                yield filename, True
+        elif os.path.exists(path) and not os.path.isdir(path):
+            # Regular files are memory-mapped; pipes and devices are read as streams.
+            yield path, print_filenames
+        elif not os.path.isdir(path):
+             print(f"Error: '{path}' is not a valid file or directory.", file=sys.stderr)
+
+# --- Trigram index (index subcommand, --index) ---
+# "python3 ast.py index DIR" records, for every byte trigram, which files under DIR contain
+# it. A search with --index turns the pattern into a query over trigrams (every file with a
+# match of "timeout (after|in)" contains "tim", "ime", ..., and "aft"... or " in") and
+# reads only the files that satisfy it, which the normal engine then verifies. Files added
+# or changed (in size or mtime) since indexing are searched directly, so a stale index
+# only makes a search slower; rerunning index rereads just those files.
+
+INDEX_MAGIC = b"GREPIDX1"
+INDEX_READ_SIZE = 1024 * 1024 # Bytes read at a time when collecting a file's trigrams
+
+def _trigram_keys(data):
+    # The distinct trigrams of a bytes-like object, each packed into an int.
+    view = memoryview(data)
+    return {a << 16 | b << 8 | c for a, b, c in set(zip(view, view[1:], view[2:]))}
+
+def _file_trigrams(filename):
+    keys = set()
+    with open(filename, 'rb') as f:
+        tail = b""
+        while True:
+            block = f.read(INDEX_READ_SIZE)
+            if not block:
+                return keys
+            data = tail + block
+            keys |= _trigram_keys(data)
+            tail = data[-2:]
+
+# A query is None (any file), ('trigram', key), ('and', [queries]) or ('or', [queries]).
+
+def _and_query(parts):
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else ('and', parts)
+
+def _or_query(parts):
+    if not parts or any(part is None for part in parts):
+        return None
+    return parts[0] if len(parts) == 1 else ('or', parts)
+
+def _strings_query(strings):
+    # Files containing one of strings. Strings shorter than a trigram constrain nothing.
+    if strings is None:
+        return None
+    queries = []
+    for string in strings:
+        encoded = string.encode('utf-8')
+        if len(encoded) < 3:
+            return None
+        queries.append(_and_query([('trigram', key) for key in sorted(_trigram_keys(encoded))]))
+    return _or_query(queries)
+
+def trigram_query(node):
+    """Returns a trigram query that every file containing a match of node satisfies."""
+    exact = _exact_strings(node)
+    if exact is not None:
+        return _strings_query(exact)
+    if isinstance(node, CaptureGroupNode):
+        return trigram_query(node._child)
+    if isinstance(node, QuantifierNode) and node.min_count > 0:
+        return trigram_query(node._child)
+    if isinstance(node, AlternationNode):
+        return _or_query([trigram_query(branch) for branch in node.children])
+    if isinstance(node, ConcatenationNode):
+        # Like required_literals, but every literal run is required, not just the best one.
+        parts = []
+        run = {''}
+        for child in node.children:
+            child_exact = _exact_strings(child)
+            extended = _cross_product(run, child_exact)
+            if extended is None:
+                affix = _repeated_affix(child) if child_exact is None else None
+                parts.append(_strings_query(_cross_product(run, affix) or run))
+                run = child_exact if child_exact is not None else affix or {''}
+                if child_exact is None:
+                    parts.append(trigram_query(child))
+            else:
+                run = extended
+        parts.append(_strings_query(run))
+        return _and_query(parts)
+    return None
+
+def patterns_query(patterns):
+    """The trigram query of a search for any of patterns."""
+    return _or_query([trigram_query(RegexParser(pattern).parse()) for pattern in patterns])
+
+def _little_endian(values):
+    # Index arrays are stored little-endian whatever the machine.
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+class TrigramIndex:
+    """
+    The index of one directory. On disk: INDEX_MAGIC, an 8-byte header length and a JSON
+    header listing the files as [relative path, size, mtime_ns], then uint32 arrays: the
+    sorted trigram keys, the offset of each key's posting list, and the posting lists of
+    file numbers. A search reads the header and the key and offset tables, then only the
+    posting lists of the query's trigrams.
+    """
+    def __init__(self, directory, files, keys, offsets, f=None, postings_start=0):
+        self.directory = directory
+        self.files = files
+        self.keys = keys
+        self.offsets = offsets
+        self._f = f
+        self._postings_start = postings_start
+
+    @classmethod
+    def open(cls, directory):
+        """Returns the index of directory, or None if it has none or it cannot be read."""
+        try:
+            f = open(os.path.join(directory, INDEX_NAME), 'rb')
+        except OSError:
+            return None
+        try:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("not an index file")
+            header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+            count = header['trigrams']
+            keys = cls._read_array(f, count)
+            offsets = cls._read_array(f, count + 1)
+            return cls(directory, header['files'], keys, offsets, f, f.tell())
+        except (OSError, ValueError, KeyError, EOFError):
+            f.close()
+            return None
+
+    @staticmethod
+    def _read_array(f, count):
+        values = array.array('I')
+        values.fromfile(f, count)
+        return _little_endian(values)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+
+    def postings(self, key):
+        """The numbers of the files containing the trigram key."""
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return []
+        self._f.seek(self._postings_start + 4 * self.offsets[i])
+        return self._read_array(self._f, self.offsets[i + 1] - self.offsets[i])
+
+    def all_postings(self):
+        """Yields (key, posting list) for every trigram."""
+        for i, key in enumerate(self.keys):
+            self._f.seek(self._postings_start + 4 * self.offsets[i])
+            yield key, self._read_array(self._f, self.offsets[i + 1] - self.offsets[i])
+
+    def candidates(self, query):
+        """Returns the numbers of the files that satisfy query, in index (walk) order."""
+        if query is None:
+            return range(len(self.files))
+        cache = {}
+        def evaluate(query):
+            if query[0] == 'trigram':
+                if query[1] not in cache:
+                    cache[query[1]] = set(self.postings(query[1]))
+                return cache[query[1]]
+            results = [evaluate(part) for part in query[1]]
+            if query[0] == 'and':
+                return set.intersection(*results)
+            return set.union(*results)
+        return sorted(evaluate(query))
+
+    @staticmethod
+    def write(directory, files, postings):
+        """Atomically writes the index of directory: postings maps keys to file numbers."""
+        keys = sorted(postings)
+        offsets = array.array('I', [0])
+        flat = array.array('I')
+        for key in keys:
+            flat.extend(postings[key])
+            offsets.append(len(flat))
+        header = json.dumps({'files': files, 'trigrams': len(keys)}).encode('utf-8')
+        path = os.path.join(directory, INDEX_NAME)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for values in (array.array('I', keys), offsets, flat):
+                _little_endian(values).tofile(f)
+        os.replace(temporary, path)
+
+def update_index(directory, walk_filter=SEARCH_EVERYTHING):
+    """
+    Creates or updates the index of directory, covering the files walk_files finds.
+    Returns (files indexed, files read): unchanged files keep their postings unread.
+    """
+    old = TrigramIndex.open(directory)
+    old_numbers = {}
+    if old is not None:
+        old_numbers = {entry[0]: number for number, entry in enumerate(old.files)}
+    prefix = os.path.join(directory, '')
+    files = []
+    renumbered = {} # Old file number -> new, for unchanged files
+    changed = [] # (new file number, filename) of files to read
+    for filename in walk_files(directory, walk_filter):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        entry = [filename[len(prefix):], st.st_size, st.st_mtime_ns]
+        old_number = old_numbers.get(entry[0])
+        if old_number is not None and old.files[old_number] == entry:
+            renumbered[old_number] = len(files)
+        else:
+            changed.append((len(files), filename))
+        files.append(entry)
+
+    postings = {}
+    if old is not None:
+        for key, numbers in old.all_postings():
+            kept = [renumbered[number] for number in numbers if number in renumbered]
+            if kept:
+                postings[key] = kept
+        old.close()
+    for number, filename in changed:
+        try:
+            keys = _file_trigrams(filename)
+        except OSError:
+            continue
+        for key in keys:
+            postings.setdefault(key, []).append(number)
+    TrigramIndex.write(directory, files, postings)
+    return len(files), len(changed)
+
+def indexed_files(directory, query, walk_filter=SEARCH_EVERYTHING):
+    """
+    Yields the files under directory that the query selects from its index, or None if
+    the directory has no index. --include, --exclude and --exclude-dir still apply.
+    """
+    index = TrigramIndex.open(directory)
+    if index is None:
+        return None
+    return _indexed_files(index, query, walk_filter)
+
+def _indexed_files(index, query, walk_filter):
+    # The directory is walked, so files added since it was indexed are searched too, as are
+    # indexed files whose size or mtime changed. Only unchanged files are left to the query.
+    try:
+        candidates = set(index.candidates(query))
+        debug(f"index: {len(candidates)} of {len(index.files)} files in {index.directory} are candidates")
+        numbers = {entry[0]: number for number, entry in enumerate(index.files)}
+        prefix = os.path.join(index.directory, '')
+        stale = 0
+        for filename in walk_files(index.directory, walk_filter):
+            number = numbers.get(filename[len(prefix):])
+            if number in candidates:
+                yield filename
+            elif number is None or not _unchanged_since_indexed(filename, index.files[number]):
+                stale += 1
+                yield filename
+        if stale:
+            debug(f"index: {stale} files in {index.directory} are new or changed; searching them directly")
+    finally:
+        index.close()
+
+def _unchanged_since_indexed(filename, entry):
+    # entry is the file's [relative path, size, mtime_ns] in the index.
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    return [st.st_size, st.st_mtime_ns] == entry[1:]
+
+# --- Result cache (--cache) ---
+# Reruns of the same patterns over mostly unchanged files are answered from an on-disk
+# cache of per-file results: the byte spans of the matching lines. The key covers the
+# file's identity and version (path, device, inode, size, mtime) and the search (the
+# parsed patterns and the binary-file settings), so a changed file or pattern is a miss.
+# A hit needs no matching at all: -c, -l, -L and -q only count the spans, and printed
+# lines are sliced straight out of the file. Binary files are only cached when they are
+# searched as text, and only those searches use their entries. Entries are written to a temporary file and
+# renamed into place, so concurrent processes never see partial entries, and reading an
+# entry refreshes its mtime, which evict() uses to drop the least recently used ones.
+
+CACHE_VERSION = 1 # Part of every key; bump it when the engines' results change
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # Default total size of the cache directory
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'grep-ast')
+
+class ResultCache:
+    """An on-disk cache of per-file match results for one search (see the section comment)."""
+    def __init__(self, directory, patterns=(), max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Equivalent spellings of a pattern parse to the same AST, so its repr normalizes it.
+        self.search_key = [CACHE_VERSION, [repr(RegexParser(pattern).parse()) for pattern in patterns]]
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _key(self, filename, st, binary_files):
+        return json.dumps(self.search_key + [binary_files.block_size, os.path.abspath(filename),
+                                             st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns])
+
+    def get(self, key, binary_files):
+        """Returns the cached spans for key, or None."""
+        path = self._entry_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['key'] != key or (entry['binary'] and binary_files.mode != 'text'):
+                return None
+            os.utime(path) # Most recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        flat = entry['spans']
+        return list(zip(flat[::2], flat[1::2]))
+
+    def put(self, key, filename, spans, binary):
+        entry = {'key': key, 'path': os.path.abspath(filename), 'binary': binary,
+                 'spans': [offset for span in spans for offset in span]}
+        path = self._entry_path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(temporary, path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    def lines(self, filename, matcher, binary_files, output):
+        """
+        The matching lines of a file, like scan_file, from the cache if possible. For a hit
+        in a mode that does not print lines, the spans themselves stand in for the lines.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return scan_file(filename, matcher, binary_files)
+        if not stat.S_ISREG(st.st_mode):
+            return scan_file(filename, matcher, binary_files)
+        binary_files = binary_files or BinaryFiles('text')
+        key = self._key(filename, st, binary_files)
+        spans = self.get(key, binary_files)
+        if spans is not None:
+            return _read_spans(filename, spans) if output.mode == 'lines' else iter(spans)
+        if output.mode not in ('lines', 'count') or output.max_count is not None:
+            return scan_file(filename, matcher, binary_files) # It stops early: nothing to cache
+        return self._fill(key, filename, matcher, binary_files)
+
+    def _fill(self, key, filename, matcher, binary_files):
+        # scan_file that stores the spans once the whole file has been scanned.
+        spans = []
+        with open(filename, 'rb') as f:
+            buf = _map_file(f)
+            if buf is None:
+                yield from scan_open_file(f, matcher, binary_files)
+                return
+            with buf:
+                if binary_files.is_binary(buf):
+                    yield from _check_binary(scan_buffer(buf, matcher), buf, binary_files)
+                    return
+                binary = BinaryFiles('binary', binary_files.block_size).is_binary(buf)
+                for line_start, line_end, clean_line in scan_buffer_spans(buf, matcher):
+                    spans.append((line_start, line_end))
+                    yield clean_line
+        self.put(key, filename, spans, binary)
+
+    def _entries(self):
+        # (path, DirEntry) of every cache entry.
+        try:
+            with os.scandir(self.directory) as it:
+                return [(entry.path, entry) for entry in it if entry.name.endswith('.json')]
+        except OSError:
+            return []
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for path, entry in self._entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue # Removed by another process
+            entries.append((st.st_mtime_ns, st.st_size, path))
+            total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, paths=()):
+        """Removes the entries of files under any of paths, or every entry. Returns the count."""
+        prefixes = [os.path.abspath(path) for path in paths]
+        removed = 0
+        for path, _ in self._entries():
+            if prefixes:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        cached = json.load(f)['path']
+                except (OSError, ValueError, KeyError):
+                    continue
+                if not any(cached == prefix or cached.startswith(os.path.join(prefix, ''))
+                           for prefix in prefixes):
+                    continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+RESULT_CACHE = None # The ResultCache of the search, if --cache is given
+
+def _read_spans(filename, spans):
+    # Yields the lines at the cached spans of a file.
+    with open(filename, 'rb') as f:
+        buf = _map_file(f)
+        if buf is None:
+            return
+        with buf:
+            for line_start, line_end in spans:
+                yield buf[line_start:line_end].decode('utf-8', 'replace').strip()
+
+def _file_lines(filename, matcher, binary_files, output):
+    # The matching lines of a whole file, through the result cache if there is one. The
+    # cache does not know line numbers, so -n and -b always scan the file.
+    if RESULT_CACHE is None or output.located:
+        return scan_file(filename, matcher, binary_files, output.located)
+    return RESULT_CACHE.lines(filename, matcher, binary_files, output)
+
+# --- Read-ahead pipeline (--readahead N) ---
+# For trees of many small files a serial search mostly waits on open() and read(), one file
+# at a time. With --readahead, an asyncio loop keeps up to N reads in flight on a thread pool
+# (the GIL is released during the system calls) while the loop thread matches the files
+# that have been read. Each read is a batch of a few files, so the hand-off between threads
+# is paid per batch rather than per file. Batches are queued in walk order and consumed in
+# that order, so the output is the same as a serial search; the bounded queue makes the
+# walk wait when the matcher falls behind. Large, special and unreadable files, and all
+# files when the result cache is on, are left to search_file.
+
+READAHEAD_MAX_FILE = 1024 * 1024 # Larger files are memory-mapped by search_file instead
+READAHEAD_BATCH = 16 # Files per read task
+
+def _read_small_files(filenames):
+    # Runs on a reader thread. Returns the content of each file, or None for files that
+    # are not small regular files or cannot be read.
+    contents = []
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode) or st.st_size > READAHEAD_MAX_FILE:
+                    contents.append(None)
+                else:
+                    contents.append(f.read())
+        except OSError:
+            contents.append(None)
+    return contents
+
+def search_pipelined(targets, matcher, readahead, output=PRINT_LINES, binary_files=SEARCH_BINARY):
+    """
+    Searches the targets like serial search_file calls, with up to 'readahead' reads in
+    flight (see the section comment).
+
+    Returns:
+        True if any match was found (with -L: any file was listed), False otherwise.
+    """
+    asyncio = _import_without_script_dir('asyncio')
+    import concurrent.futures
+
+    async def run(pool):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(readahead)
+
+        async def produce():
+            batches = iter(lambda: list(itertools.islice(targets, READAHEAD_BATCH)), [])
+            for batch in batches:
+                if RESULT_CACHE is None:
+                    read = loop.run_in_executor(pool, _read_small_files, [filename for filename, _ in batch])
+                else:
+                    read = None
+                await queue.put((batch, read)) # Waits while the queue is full
+            await queue.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        any_match_found = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                batch, read = item
+                contents = [None] * len(batch) if read is None else await read
+                for (filename, print_filename), data in zip(batch, contents):
+                    if search_file(filename, matcher, print_filename, output, binary_files, data):
+                        any_match_found = True
+                        if output.mode == 'quiet':
+                            return True
+        finally:
+            producer.cancel()
+        return any_match_found
+
+    pool = concurrent.futures.ThreadPoolExecutor(readahead)
+    try:
+        return asyncio.run(run(pool))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+# --- Parallel search (-j N) ---
+# Files, and fixed-size chunks of large files, are searched by a pool of worker processes.
+# Each worker receives the LineMatcher once, through the pool initializer. Results come back
+# through Pool.imap, which returns them in submission order, so the output is the same as
+# a serial search and is printed as soon as the next task in order is done.
+
+PARALLEL_CHUNK_SIZE = 32 * 1024 * 1024 # Files larger than this are split between workers
+
+_worker_matcher = None
+_worker_output = PRINT_LINES
+_worker_binary_files = SEARCH_BINARY
+
+def _init_worker(matcher, output=PRINT_LINES, binary_files=SEARCH_BINARY, collect_stats=False,
+                 result_cache=None):
+    global _worker_matcher, _worker_output, _worker_binary_files, STATS, RESULT_CACHE
+    _worker_matcher = matcher
+    _worker_output = output
+    _worker_binary_files = _binary_files_for(output, binary_files)
+    STATS = SearchStats() if collect_stats else None
+    RESULT_CACHE = result_cache
+
+def scan_file_range(filename, matcher, start, end, binary_files=None):
+    """
+    Yields the matching lines of a file that start within the byte range [start, end).
+    The line straddling 'end' is scanned to its end; the one straddling 'start' is skipped.
+    Every range checks the start of the file, so all of them agree on whether it is binary.
+    """
+    with open(filename, 'rb') as f:
+        buf = _map_file(f)
+        if buf is None:
+            return
+        with buf:
+            end = min(end, len(buf))
+            if start > 0 and buf[start - 1:start] != b"\n":
+                newline = buf.find(b"\n", start, end)
+                if newline < 0:
+                    return # No line starts inside this chunk
+                start = newline + 1
+                if start >= end:
+                    return # The chunk ends with the newline of the line straddling it
+            newline = buf.find(b"\n", end - 1)
+            end = len(buf) if newline < 0 else newline
+            yield from _check_binary(scan_buffer(buf, matcher, start, end), buf, binary_files)
+
+def _iter_parallel_tasks(targets, split=True):
+    # Splits search targets into tasks: (filename, print_filename, start, end). With
+    # split=False (for -n and -b, which need positions from the start of the file), files
+    # are searched whole.
+    for filename, print_filename in targets:
+        try:
+            st = os.stat(filename)
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+        except OSError:
+            size = 0
+        if size <= PARALLEL_CHUNK_SIZE or not split:
+            yield filename, print_filename, 0, None
+            continue
+        for start in range(0, size, PARALLEL_CHUNK_SIZE):
+            yield filename, print_filename, start, start + PARALLEL_CHUNK_SIZE
+
+def _search_task(task):
+    # Runs in a worker. Returns (task, the result collected for the output mode, whether
+    # reading the file failed, the task's SearchStats or None). In 'lines' mode the result
+    # holds the lines read before a failure, or is a BinaryFileMatches for a binary file.
+    global STATS
+    filename, _, start, end = task
+    if STATS is not None:
+        STATS = SearchStats()
+    started = time.perf_counter()
+    if end is None:
+        lines = _file_lines(filename, _worker_matcher, _worker_binary_files, _worker_output)
+    else:
+        lines = scan_file_range(filename, _worker_matcher, start, end, _worker_binary_files)
+    result = [] if _worker_output.mode == 'lines' else None
+    failed = False
+    try:
+        if _worker_output.mode == 'lines':
+            result.extend(_worker_output.limit(lines))
+        else:
+            result = _worker_output.collect(lines)
+    except BinaryFileMatches as e:
+        result = e
+    except OSError:
+        failed = True
+    if STATS is not None:
+        STATS.record_file(filename, time.perf_counter() - started)
+    return task, result, failed, STATS
+
+def search_parallel(targets, matcher, jobs, output=PRINT_LINES, binary_files=SEARCH_BINARY):
+    """
+    Searches the targets with a pool of 'jobs' worker processes, printing matches in the
+    same order as a serial search.
+
+    Returns:
+        True if any match was found (with -L: any file was listed), False otherwise.
+    """
+    any_match_found = False
+    failed_file = None
+    pending = None # [result, filename, print_filename] of the file whose parts are being combined
+    printed = 0 # Lines printed so far from the current file, for -m
+    initargs = (matcher, output, binary_files, STATS is not None, RESULT_CACHE)
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        for task, result, failed, task_stats in pool.imap(_search_task, _iter_parallel_tasks(targets, not output.located)):
+            filename, print_filename, start = task[0], task[1], task[2]
+            if task_stats is not None:
+                STATS.merge(task_stats)
+            if start == 0:
+                # The first part of a new file: the previous file is complete.
+                if pending is not None and output.emit(*pending):
+                    any_match_found = True
+                pending = None
+                printed = 0
+            elif filename == failed_file:
+                continue # Like search_file, stop at the first unreadable part of a file
+            if isinstance(result, BinaryFileMatches):
+                if not printed: # Every part of a binary file reports its match
+                    _print_binary_match(filename)
+                    any_match_found = True
+                printed = 1
+            elif output.mode == 'lines':
+                if output.max_count is not None:
+                    result = result[:output.max_count - printed]
+                for line in result:
+                    _print_match(filename, line, print_filename, output)
+                    any_match_found = True
+                printed += len(result)
+            elif failed:
+                pending = None # Unreadable files are not reported
+            elif pending is None:
+                pending = [result, filename, print_filename]
+            else:
+                pending[0] = output.merge(pending[0], result)
+            if output.mode == 'quiet' and result:
+                return True # Leaving the with block stops the workers
+            if failed:
+                failed_file = filename
+    if pending is not None and output.emit(*pending):
+        any_match_found = True
+    return any_match_found
+
+
+def index_main(directories, walk_filter):
+    """Runs "index DIR...". Returns the exit status."""
+    if not directories:
+        print("Usage: python3 ast.py index [--no-ignore] [--include=GLOB] [--exclude=GLOB] [--exclude-dir=GLOB] dir1 [dir2] ...", file=sys.stderr)
+        return 2
+    status = 0
+    for directory in directories:
+        if not os.path.isdir(directory):
+            print(f"Error: '{directory}' is not a directory.", file=sys.stderr)
+            status = 2
+            continue
+        try:
+            indexed, read = update_index(directory, walk_filter)
+        except OSError as e:
+            print(f"An error occurred: {e}", file=sys.stderr)
+            status = 2
+            continue
+        print(f"{directory}: indexed {indexed} files ({read} read)", file=sys.stderr)
+    return status
+
+def main():
+    # --- 1. Argument Parsing ---
+    args = sys.argv[1:]
+    recursive = False
+    paths = []
+    global DEBUG, STATS, RESULT_CACHE, MAX_PROGRAM_SIZE
+
+    # Subcommands are only recognized as the first argument, so a file named like one can
+    # still be searched ("-E foo index" searches the file index).
+    subcommand = args.pop(0) if args and args[0] in ('index', 'invalidate-cache') else None
+
+    # Patterns are taken out first, so a pattern such as "-c" is not mistaken for a flag.
+    # Any number of patterns can be given with -e, and -f reads one pattern per line.
+    pattern_str, patterns, pattern_file = _pop_pattern_options(args)
+    if subcommand is not None and (pattern_str is not None or patterns or pattern_file is not None):
+        print(f"Error: '{subcommand}' takes no pattern (-E, -e or -f).", file=sys.stderr)
+        exit(2)
+
+    # Handle flags that can appear anywhere, like -r
+    if '-r' in args:
+        recursive = True
+        args.remove('-r')
+    if '--debug' in args:
+        DEBUG = True
+        args.remove('--debug')
+    line_buffered = False
+    if '--line-buffered' in args:
+        line_buffered = True
+        args.remove('--line-buffered')
+    # --stats prints a report to stderr at the end; --stats=json prints it as JSON.
+    stats_format = None
+    for arg in list(args):
+        if arg == '--stats' or arg.startswith('--stats='):
+            stats_format = arg.partition('=')[2] or 'text'
+            args.remove(arg)
+    if stats_format not in (None, 'text', 'json'):
+        print(f"Unknown --stats format: {stats_format} (expected text or json)", file=sys.stderr)
+        exit(2)
+    if stats_format is not None:
+        STATS = SearchStats()
+    dfa_cache_size = _pop_option(args, '--dfa-cache-size')
+    max_program_size = _pop_option(args, '--max-program-size')
+    jobs = _pop_option(args, '-j')
+    readahead = _pop_option(args, '--readahead')
+    # Output modes; -q wins over -l/-L, which win over -c.
+    mode = 'lines'
+    for flag, flag_mode in (('-c', 'count'), ('-L', 'files-without-match'),
+                            ('-l', 'files-with-matches'), ('-q', 'quiet')):
+        if flag in args:
+            mode = flag_mode
+            args.remove(flag)
+    max_count = _pop_option(args, '-m')
+    # -o prints only the matching parts of lines; -n and -b prefix the line number and the
+    # byte offset (of the match, with -o).
+    line_options = {}
+    for flags, name in ((('-o', '--only-matching'), 'only_matching'), (('-n', '--line-number'), 'line_numbers'),
+                        (('-b', '--byte-offset'), 'byte_offsets')):
+        for flag in flags:
+            if flag in args:
+                line_options[name] = True
+                args.remove(flag)
+    # Files with a NUL byte in their first block are binary: see BinaryFiles.
+    binary_mode = _pop_option(args, '--binary-files') or 'binary'
+    if binary_mode not in ('binary', 'text', 'without-match'):
+        print(f"Unknown --binary-files type: {binary_mode} (expected binary, text or without-match)",
+              file=sys.stderr)
+        exit(2)
+    binary_block_size = _pop_option(args, '--binary-block-size')
+
+    # -r filters; the globs can be repeated. --no-ignore searches files that .gitignore
+    # and .ignore exclude.
+    use_ignore_files = '--no-ignore' not in args
+    if not use_ignore_files:
+        args.remove('--no-ignore')
+    walk_filter = WalkFilter(_pop_options(args, '--include'), _pop_options(args, '--exclude'),
+                             _pop_options(args, '--exclude-dir'), use_ignore_files)
+
+    # "index DIR..." builds or updates the trigram index of each directory; --index searches
+    # indexed directories through their index (and implies -r).
+    if subcommand == 'index':
+        exit(index_main(args, walk_filter))
+    # "invalidate-cache [PATH...]" removes the cached results of files under the paths,
+    # or all of them.
+    cache_dir = _pop_option(args, '--cache-dir')
+    use_cache = '--cache' in args or cache_dir is not None
+    if '--cache' in args:
+        args.remove('--cache')
+    cache_size = _pop_option(args, '--cache-size')
+    cache_dir = cache_dir or default_cache_dir()
+    if subcommand == 'invalidate-cache':
+        removed = ResultCache(cache_dir).invalidate(args)
+        print(f"{cache_dir}: removed {removed} cached results", file=sys.stderr)
+        exit(0)
+    use_index = '--index' in args
+    if use_index:
+        recursive = True
+        args.remove('--index')
+
+    if pattern_file is not None:
+        try:
+            with open(pattern_file, encoding='utf-8') as f:
+                patterns.extend(f.read().splitlines())
+        except OSError as e:
+            print(f"An error occurred: {e}", file=sys.stderr)
+            exit(2)
+
+    # The -E flag must be followed by the pattern
+    try:
+        if '-E' in args:
+            raise IndexError # -E was the last argument
+        elif pattern_str is None and not patterns:
+            if len(args) >= 2:
+                 pattern_str = args[0]
+                 args.pop(0)
+
+        paths = args
+    except IndexError:
+        print("Usage: python3 ast.py [-r] [-j N] [--readahead N] [-q | -l | -L | -c] [-m NUM] [-o] [-n] [-b] [--binary-files=TYPE] [--include=GLOB] [--exclude=GLOB] [--exclude-dir=GLOB] [--no-ignore] [--index] [--cache] [--cache-dir DIR] [--cache-size BYTES] [--line-buffered] [--stats[=json]] [-e <pattern>]... [-f <file>] -E <pattern> [path1] [path2] ...", file=sys.stderr)
+        exit(2)
+
+    if pattern_str:
+        patterns.insert(0, pattern_str)
+
+    # --- THIS IS THE FIX ---
+    # Only exit if the pattern is missing. It's okay if 'paths' is empty.
+    if not patterns and pattern_file is None:
+        print("Usage: python3 ast.py [-r] [-j N] [--readahead N] [-q | -l | -L | -c] [-m NUM] [-o] [-n] [-b] [--binary-files=TYPE] [--include=GLOB] [--exclude=GLOB] [--exclude-dir=GLOB] [--no-ignore] [--index] [--cache] [--cache-dir DIR] [--cache-size BYTES] [--line-buffered] [--stats[=json]] [-e <pattern>]... [-f <file>] -E <pattern> [path1] [path2] ...", file=sys.stderr)
+        exit(2)
+    
+    # --- 2. Main Logic ---
+    any_match_found = False
+    try:
+        if max_program_size is not None:
+            MAX_PROGRAM_SIZE = int(max_program_size)
+        if dfa_cache_size is not None:
+            matcher = build_matcher(patterns, int(dfa_cache_size))
+        else:
+            matcher = build_matcher(patterns)
+        debug(f"prefilter: {matcher.prefilter!r}")
+        if use_cache:
+            if cache_size is not None:
+                RESULT_CACHE = ResultCache(cache_dir, patterns, int(cache_size))
+            else:
+                RESULT_CACHE = ResultCache(cache_dir, patterns)
+
+        print_filenames = recursive or len(paths) > 1
+        if line_buffered:
+            # Flush every match, e.g. for "tail -f log | grep ... | next-stage" pipelines.
+            sys.stdout.reconfigure(line_buffering=True)
+        # -j 0 uses every CPU.
+        jobs = 1 if jobs is None else (int(jobs) or os.cpu_count() or 1)
+        if line_options.pop('only_matching', False):
+            line_options['only_matching'] = [Pattern(pattern) for pattern in patterns]
+        output = OutputMode(mode, None if max_count is None else int(max_count), **line_options)
+        if binary_block_size is not None:
+            binary_files = BinaryFiles(binary_mode, int(binary_block_size))
+        else:
+            binary_files = BinaryFiles(binary_mode)
+
+        search_started = time.perf_counter()
+        if paths:
+            # -c and -L report files without matches too, so they need every indexed file.
+            index_query = None
+            if use_index and mode not in ('count', 'files-without-match'):
+                index_query = patterns_query(patterns)
+            debug(f"index query: {index_query!r}")
+            targets = iter_search_targets(paths, recursive, print_filenames, walk_filter,
+                                          use_index, index_query)
+            if jobs > 1:
+                any_match_found = search_parallel(targets, matcher, jobs, output, binary_files)
+            elif readahead is not None and int(readahead) > 0:
+                any_match_found = search_pipelined(targets, matcher, int(readahead), output, binary_files)
+            else:
+                for filename, print_filename in targets:
+                    if search_file(filename, matcher, print_filename, output, binary_files):
+                        any_match_found = True
+                        if mode == 'quiet':
+                            break # The exit status is known; don't open any more files
+        
+        elif mode == 'lines':
+            try:
+                lines = scan_open_file(sys.stdin.buffer, matcher, binary_files, output.located)
+                for line in output.limit(lines):
+                    _print_match(STDIN_NAME, line, False, output)
+                    any_match_found = True
+            except BinaryFileMatches:
+                _print_binary_match(STDIN_NAME)
+                any_match_found = True
+        else:
+            lines = scan_open_file(sys.stdin.buffer, matcher, _binary_files_for(output, binary_files))
+            any_match_found = output.emit(output.collect(lines), STDIN_NAME, False)
+
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        exit(1)
+
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.evict()
+    if jobs == 1:
+        debug(f"matcher stats: {matcher.stats()}")
+    if STATS is not None:
+        STATS.match_seconds = time.perf_counter() - search_started
+        report = STATS.report(matcher)
+        if stats_format == 'json':
+            print(json.dumps(report), file=sys.stderr)
+        else:
+            print(format_stats(report), file=sys.stderr)
 
     # --- 3. Exit Status ---
     if any_match_found:
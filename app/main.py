@@ -1,5 +1,11 @@
 import sys
 
+DEBUG = False
+
+def debug(message):
+    if DEBUG:
+        print(f"debug: {message}", file=sys.stderr)
+
 def match(pattern, input_line):
     for i in range(len(input_line) + 1):
         if pattern[0] == "^":
@@ -12,14 +18,17 @@ def match(pattern, input_line):
 # If returns false match() will go through the next iteration of the for loop
 # If returns true then match will return true bc a match was found
 def matchhere(pattern, input_line):
-    print("pattern: " + pattern, file=sys.stderr)
-    print("input_line: " + input_line, file=sys.stderr)
+    # Tracing is checked at each call site so the messages are not even formatted when disabled.
+    if DEBUG:
+        debug("pattern: " + pattern)
+        debug("input_line: " + input_line)
 
     if not pattern:
         return True
     alternatives = split_alternatives(pattern)
     if len(alternatives) > 1: # Only proceed if there's actually an "|" at the top level
-        print(f"Alteration detected: Alternatiives: {str(alternatives)}", file=sys.stderr)
+        if DEBUG:
+            debug(f"Alteration detected: Alternatiives: {str(alternatives)}")
         for sub_pattern in alternatives:
             if matchhere(sub_pattern, input_line):
                 return True
@@ -57,8 +66,9 @@ def matchhere(pattern, input_line):
             # so this else handles when len(pattern) > 2
             included_char = pattern[0] + pattern[2:]
             excluded_char = pattern[2:]
-        print(f"included_char: {included_char}", file=sys.stderr)
-        print(f"excluded_char: {excluded_char}", file=sys.stderr)
+        if DEBUG:
+            debug(f"included_char: {included_char}")
+            debug(f"excluded_char: {excluded_char}")
         if matchchar(included_char, input_line) or matchchar(excluded_char, input_line):
             return True 
 
@@ -162,6 +172,10 @@ def find_matching_paraenthesis(pattern, start_index):
     raise ValueError("Unmatched opening paraenthesis")
 
 def main():
+    global DEBUG
+    if '--debug' in sys.argv:
+        DEBUG = True
+        sys.argv.remove('--debug')
     pattern = sys.argv[2]
     input_line = sys.stdin.read()
 
@@ -169,14 +183,14 @@ def main():
         print("Expected first argument to be '-E'")
         exit(1)
 
-    print("Logs from your program will appear here!", file=sys.stderr)
+    debug("Logs from your program will appear here!")
 
     if match(pattern, input_line):
-        print("pattern: " + pattern, file=sys.stderr)
-        print("exit 0", file=sys.stderr)
+        debug("pattern: " + pattern)
+        debug("exit 0")
         exit(0)
     else:
-        print("exit 1", file=sys.stderr)
+        debug("exit 1")
         exit(1)
 
 
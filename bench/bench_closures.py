@@ -0,0 +1,91 @@
+"""
+Compares the interpreted backtracker (match_possibilities) with the compiled closures
+(compile_closures) on patterns with backreferences, which always run on the backtracker.
+
+Usage: python3 bench/bench_closures.py [repeat]
+"""
+import importlib.util
+import os
+import random
+import sys
+import time
+
+AST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'ast.py')
+
+def load_grep():
+    # app/ast.py shadows the stdlib ast module, so it is loaded under another name.
+    spec = importlib.util.spec_from_file_location('grep_ast', AST_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+PATTERNS = [
+    r'(\w+) \1',
+    r'(\d+)-(\d+) \2-\1',
+    r'user=(\w+) .* by \1',
+    r'([ab]+)c\1',
+    r'(cat|dog) and \1',
+    r'^(\w+).*\1$',
+]
+
+def make_lines(count, seed=0):
+    rng = random.Random(seed)
+    words = ['user=alice', 'user=bob', 'cat', 'dog', 'and', 'by', 'ok', 'abab', '12-34', '34-12']
+    lines = []
+    for _ in range(count):
+        line = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 14)))
+        lines.append(line)
+    return lines
+
+def first_match(possibilities, lines):
+    found = 0
+    for line in lines:
+        for pos in range(len(line) + 1):
+            if next(possibilities(line, pos), None) is not None:
+                found += 1
+                break
+    return found
+
+def time_it(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    grep = load_grep()
+    lines = make_lines(500)
+    print(f"{'pattern':<24} {'interpreted':>12} {'compiled':>10} {'speedup':>8}")
+    for pattern in PATTERNS:
+        parser = grep.RegexParser(pattern)
+        ast = parser.parse()
+        memo = grep.compile_backtrack_memo(ast)
+        closures = grep.compile_closures(ast)
+        caps = [None] * (2 * (parser.group_count + 1)) # The capture store: two slots per group
+
+        def interpreted(line, pos):
+            return grep.match_possibilities(ast, line, pos, caps, memo)
+
+        def compiled(line, pos):
+            return closures(line, pos, caps)
+
+        # The memo is per line in match_entire_ast; reset it the same way here.
+        def run(possibilities):
+            def each(line, pos):
+                if pos == 0:
+                    memo.reset()
+                return possibilities(line, pos)
+            return lambda: first_match(each, lines)
+
+        slow, expected = time_it(run(interpreted), repeat)
+        fast, found = time_it(run(compiled), repeat)
+        if found != expected:
+            raise SystemExit(f"{pattern}: compiled matcher found {found} lines, interpreted {expected}")
+        print(f"{pattern:<24} {slow * 1000:>10.1f}ms {fast * 1000:>8.1f}ms {slow / fast:>7.2f}x")
+
+if __name__ == '__main__':
+    main()
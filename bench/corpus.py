@@ -0,0 +1,57 @@
+"""
+Deterministic synthetic corpora for the benchmarks. The same seed always produces the same
+text, so timings from different runs are measured on identical input.
+"""
+import os
+import random
+
+LEVELS = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+SERVICES = ['auth', 'billing', 'search', 'gateway', 'worker']
+MESSAGES = [
+    'request served in {ms}ms',
+    'user {user} logged in from 10.0.{a}.{b}',
+    'connection refused by upstream {service}',
+    'timeout after {ms}ms waiting for {service}',
+    'cache miss for key {user}:{a}',
+    'retrying job {a}{b} (attempt {attempt})',
+]
+USERS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank']
+
+def log_lines(count, seed=0):
+    """Log-like lines: timestamp, level, service and a templated message."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        message = rng.choice(MESSAGES).format(
+            ms=rng.randint(1, 5000), user=rng.choice(USERS), service=rng.choice(SERVICES),
+            a=rng.randint(0, 255), b=rng.randint(0, 255), attempt=rng.randint(1, 5))
+        lines.append(f"2024-05-{1 + i % 28:02d} 12:{i % 60:02d}:{(i * 7) % 60:02d} "
+                     f"{rng.choice(LEVELS)} [{rng.choice(SERVICES)}] {message}")
+    return lines
+
+def long_lines(count, length, seed=0):
+    """Long lines of random words, for engines whose cost grows with line length."""
+    rng = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', '42', 'x_1', 'ERROR', 'user', 'cat', 'dog']
+    lines = []
+    for _ in range(count):
+        parts = []
+        size = 0
+        while size < length:
+            word = rng.choice(words)
+            parts.append(word)
+            size += len(word) + 1
+        lines.append(' '.join(parts)[:length])
+    return lines
+
+def evil_lines(count, length=24):
+    """Runs of 'a' with no terminating 'b': the worst case for naive backtracking."""
+    return ['a' * (length + i % 3) for i in range(count)]
+
+def small_files(directory, count, lines_per_file, seed=0):
+    """Writes count small log files into a nested tree under directory, for -r searches."""
+    for i in range(count):
+        subdirectory = os.path.join(directory, f"dir{i % 10}", f"sub{i % 3}")
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f"file{i}.log"), 'w') as f:
+            f.write('\n'.join(log_lines(lines_per_file, seed + i)) + '\n')
@@ -0,0 +1,233 @@
+"""
+Benchmarks app/main.py's match() and app/ast.py's match_entire_ast() on synthetic corpora,
+plus app/ast.py's command line on a tree of small files with -r.
+
+Every case is timed (best of --repeat runs) and the results are written as JSON. They are
+compared with a stored baseline, and the exit status is 1 if a case got slower than the
+threshold allows, stopped finishing, or changed its number of matching lines.
+
+Usage:
+    python3 bench/run.py                      # run and compare with bench/baseline-full.json
+    python3 bench/run.py --json results.json  # also write the results
+    python3 bench/run.py --update-baseline    # store this run as the new baseline
+    python3 bench/run.py --quick --only catastrophic
+
+Cases are abandoned after --timeout seconds using SIGALRM, so the harness needs a Unix system.
+Timings depend on the machine, so a baseline is only meaningful on the machine that
+recorded it: refresh it with --update-baseline before comparing changes elsewhere.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+
+MIN_DELTA = 0.02 # Seconds; smaller slowdowns are treated as noise whatever the ratio
+
+# (family, name, pattern, corpora, engines). 'main' is only listed for the syntax it supports.
+CASES = [
+    ('literal', 'literal', 'ERROR', ['log', 'long'], ['main', 'ast']),
+    ('literal', 'dot', 'l.gged in', ['log'], ['main', 'ast']),
+    ('class', 'digit', r'\d\d\d\dms', ['log', 'long'], ['main', 'ast']),
+    ('class', 'word', r'user \w\w\w\w ', ['log'], ['main', 'ast']),
+    ('set', 'char-set', '[xyz]', ['log', 'long'], ['main', 'ast']),
+    ('set', 'negated-set', 'attempt [^1]', ['log'], ['main', 'ast']),
+    ('anchor', 'start', '^2024-05-0', ['log'], ['main', 'ast']),
+    ('anchor', 'end', 'ms$', ['log', 'long'], ['main', 'ast']),
+    ('quantifier', 'plus', 'ca+che', ['log'], ['main', 'ast']),
+    ('quantifier', 'optional', 'retry?ing', ['log'], ['main', 'ast']),
+    ('quantifier', 'star', 'user .*logged', ['log', 'long'], ['ast']),
+    ('alternation', 'top-level', 'refused|timeout', ['log'], ['main', 'ast']),
+    ('alternation', 'group', '(alice|bob|gamma) ', ['log', 'long'], ['ast']),
+    ('group', 'capture', r'(\d+)ms', ['log'], ['ast']),
+    ('backreference', 'repeated-word', r'(\w+) \1', ['log', 'long'], ['ast']),
+    ('catastrophic', 'chained-plus', 'a+a+a+a+a+a+a+b', ['evil'], ['main', 'ast']),
+    ('catastrophic', 'nested-plus', '(a+)+b', ['evil'], ['ast']),
+    ('catastrophic', 'overlapping-alternation', '(a|aa)+b', ['evil'], ['ast']),
+    ('catastrophic', 'nested-star', '(a*)*b', ['evil'], ['ast']),
+    ('catastrophic', 'nested-star-backreference', r'(a*)*b\1', ['evil'], ['ast']),
+    ('files', 'recursive', r'timeout after \d+ms', ['files'], ['ast-cli']),
+]
+
+SCALES = {
+    # corpus -> size parameters
+    'full': {'log': 5000, 'long': (20, 20000), 'evil': 20, 'files': (300, 40)},
+    'quick': {'log': 500, 'long': (4, 5000), 'evil': 5, 'files': (30, 20)},
+}
+
+class BenchTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise BenchTimeout()
+
+def load_module(name, filename):
+    # app/ast.py shadows the stdlib ast module, so the app files are loaded under other names.
+    spec = importlib.util.spec_from_file_location(name, os.path.join(APP_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def build_corpora(scale, workdir):
+    sizes = SCALES[scale]
+    files_dir = os.path.join(workdir, 'files')
+    corpus.small_files(files_dir, *sizes['files'])
+    return {
+        'log': corpus.log_lines(sizes['log']),
+        'long': corpus.long_lines(*sizes['long']),
+        'evil': corpus.evil_lines(sizes['evil']),
+        'files': files_dir,
+    }
+
+def line_matcher(engine, pattern, grep_main, grep_ast):
+    """Returns a function line -> bool for the engine."""
+    if engine == 'main':
+        return lambda line: grep_main.match(pattern, line)
+    parser = grep_ast.RegexParser(pattern)
+    ast = parser.parse()
+    return lambda line: grep_ast.match_entire_ast(ast, line, parser)[0]
+
+def count_matches(matches, lines):
+    return sum(1 for line in lines if matches(line))
+
+def count_cli_matches(pattern, directory):
+    result = subprocess.run([sys.executable, os.path.join(APP_DIR, 'ast.py'), '-r', '-E', pattern, directory],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+    return result.stdout.count(b'\n')
+
+def run_case(engine, pattern, data, grep_main, grep_ast, repeat, timeout):
+    """Returns {'status', 'seconds', 'matches'} for one case."""
+    try:
+        if engine == 'ast-cli':
+            work = lambda: count_cli_matches(pattern, data)
+        else:
+            matches = line_matcher(engine, pattern, grep_main, grep_ast)
+            work = lambda: count_matches(matches, data)
+        best = None
+        found = None
+        for _ in range(repeat):
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                start = time.perf_counter()
+                found = work()
+                elapsed = time.perf_counter() - start
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            best = elapsed if best is None else min(best, elapsed)
+        return {'status': 'ok', 'seconds': round(best, 6), 'matches': found}
+    except BenchTimeout:
+        return {'status': 'timeout', 'seconds': None, 'matches': None}
+    except (RecursionError, ValueError, IndexError) as e:
+        return {'status': f"error: {type(e).__name__}", 'seconds': None, 'matches': None}
+
+def run_benchmarks(scale, repeat, timeout, only):
+    grep_main = load_module('grep_main', 'main.py')
+    grep_ast = load_module('grep_ast', 'ast.py')
+    signal.signal(signal.SIGALRM, _alarm)
+    workdir = tempfile.mkdtemp(prefix='grep-bench-')
+    results = {}
+    try:
+        corpora = build_corpora(scale, workdir)
+        for family, name, pattern, corpus_names, engines in CASES:
+            for corpus_name in corpus_names:
+                for engine in engines:
+                    key = f"{engine}/{family}/{name}/{corpus_name}"
+                    if only and only not in key:
+                        continue
+                    result = run_case(engine, pattern, corpora[corpus_name], grep_main, grep_ast,
+                                      repeat, timeout)
+                    result['pattern'] = pattern
+                    results[key] = result
+                    print(_format_result(key, result), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'meta': {'scale': scale, 'repeat': repeat, 'timeout': timeout,
+                 'python': platform.python_version(), 'platform': platform.platform()},
+        'results': results,
+    }
+
+def _format_result(key, result):
+    if result['status'] != 'ok':
+        return f"{key:<60} {result['status']}"
+    return f"{key:<60} {result['seconds'] * 1000:>10.1f}ms {result['matches']:>7} matches"
+
+def compare(report, baseline, threshold):
+    """Returns a list of regression descriptions (empty if there are none)."""
+    regressions = []
+    if baseline['meta'].get('scale') != report['meta']['scale']:
+        print(f"warning: baseline scale {baseline['meta'].get('scale')!r} differs from "
+              f"{report['meta']['scale']!r}; skipping comparison", file=sys.stderr)
+        return regressions
+    for key, result in report['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        if base['status'] == 'ok' and result['status'] != 'ok':
+            regressions.append(f"{key}: {result['status']} (baseline finished in {base['seconds']:.3f}s)")
+        elif base['status'] == 'ok' and result['matches'] != base['matches']:
+            regressions.append(f"{key}: {result['matches']} matches, baseline had {base['matches']}")
+        elif base['status'] == 'ok':
+            slower = result['seconds'] - base['seconds']
+            if result['seconds'] > base['seconds'] * (1 + threshold) and slower > MIN_DELTA:
+                regressions.append(f"{key}: {result['seconds']:.3f}s vs baseline {base['seconds']:.3f}s "
+                                   f"(+{slower / base['seconds']:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='use small corpora')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case; the best is kept')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a run is abandoned')
+    parser.add_argument('--only', help='only run cases whose key contains this text')
+    parser.add_argument('--json', help="write the results to this file ('-' for stdout)")
+    parser.add_argument('--baseline', help='baseline file to compare with (default: bench/baseline-<scale>.json)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slowdown as a fraction of the baseline time')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    options = parser.parse_args()
+
+    scale = 'quick' if options.quick else 'full'
+    if options.baseline is None:
+        options.baseline = os.path.join(BENCH_DIR, f"baseline-{scale}.json")
+    report = run_benchmarks(scale, options.repeat, options.timeout, options.only)
+
+    if options.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.update_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"baseline written to {options.baseline}", file=sys.stderr)
+        return
+
+    if not os.path.exists(options.baseline):
+        print(f"no baseline at {options.baseline}; run with --update-baseline to create one", file=sys.stderr)
+        return
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, options.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+    print("no regressions against the baseline", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
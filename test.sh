@@ -9,6 +9,18 @@ set -e
 
 echo "--- Running Local Tests ---"
 
+# Runs the Python code read from stdin with app/ast.py loaded as the module 'grep'. The file
+# shadows the stdlib ast module, so it is imported by path under another name.
+grep_python() {
+  python3 -c "
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('grep_ast', 'app/ast.py')
+grep = importlib.util.module_from_spec(spec)
+sys.modules['grep_ast'] = grep # Lets compiled matchers and patterns pickle
+spec.loader.exec_module(grep)
+$(cat)"
+}
+
 # --- Run test 1: Match literal character ---
 echo "Match literal character"
 echo -n "apple" | python3 app/main.py -E "a"
@@ -380,6 +392,1079 @@ rm fruits.txt
 echo "Test 16 passed."
 echo ""
 
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Nested quantifiers run in linear time -- \033[0m"
+echo " ------------------------------------------------ "
+
+set +e  # Allow commands to fail without exiting
+long_a=$(printf 'a%.0s' {1..200})
+echo -n "$long_a" | timeout 10 python3 app/ast.py -E "(a*)*b"
+code1=$?
+echo -n "${long_a}x" | timeout 10 python3 app/ast.py -E "\w+\w+\w+x"
+code2=$?
+set -e
+
+if [ $code1 -ne 1 ]; then
+  echo "Expected exit code 1 for (a*)*b on a long line of a's, got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 0 ]; then
+  echo "Expected exit code 0 for \w+\w+\w+x on a long line, got $code2"
+  exit 1
+fi
+
+echo "Test 17 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Small DFA cache falls back to the NFA -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf 'abcabd\nxyz\nab1abd2\n' > dfa_input.txt
+output=$(python3 app/ast.py --dfa-cache-size 2 -E "ab(c|\d)abd" dfa_input.txt)
+expected=$(printf 'abcabd\nab1abd2')
+rm dfa_input.txt
+
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected', but got '$output'"
+  exit 1
+fi
+
+echo "Test 18 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Anchors inside alternations and reverse matching -- \033[0m"
+echo " ------------------------------------------------ "
+
+set +e  # Allow commands to fail without exiting
+echo -n "xyz cat" | python3 app/ast.py -E "^dog|cat"
+code1=$?
+echo -n "request took 250ms" | python3 app/ast.py -E "took \d+ms$"
+code2=$?
+echo -n "request took 250ms!" | python3 app/ast.py -E "took \d+ms$"
+code3=$?
+set -e
+
+if [ $code1 -ne 0 ]; then
+  echo "Expected exit code 0 for 'xyz cat' with ^dog|cat, got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 0 ]; then
+  echo "Expected exit code 0 for 'request took 250ms', got $code2"
+  exit 1
+fi
+
+if [ $code3 -ne 1 ]; then
+  echo "Expected exit code 1 for 'request took 250ms!', got $code3"
+  exit 1
+fi
+
+echo "Test 19 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Search a multi-line file and a pipe -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf 'INFO 1 ok\n  ERROR 42 timeout  \nERROR x refused\nERROR 7 refused' > log_input.txt
+expected=$(printf 'ERROR 42 timeout\nERROR 7 refused')
+
+output=$(python3 app/ast.py -E "ERROR \d+ (timeout|refused)" log_input.txt)
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from the file, but got '$output'"
+  exit 1
+fi
+
+output=$(python3 app/ast.py -E "ERROR \d+ (timeout|refused)" <(cat log_input.txt))
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from the pipe, but got '$output'"
+  exit 1
+fi
+rm log_input.txt
+
+echo "Test 20 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Parallel recursive search keeps walk order -- \033[0m"
+echo " ------------------------------------------------ "
+
+mkdir -p parallel_dir/sub
+printf 'pear\napple pie\n' > parallel_dir/one.txt
+printf 'grape\npineapple\n' > parallel_dir/sub/two.txt
+printf 'applesauce\n' > parallel_dir/sub/three.txt
+
+serial_output=$(python3 app/ast.py -r -E "apple" parallel_dir)
+parallel_output=$(python3 app/ast.py -r -j 3 -E "apple" parallel_dir)
+rm -r parallel_dir
+
+if [ -z "$serial_output" ] || [ "$serial_output" != "$parallel_output" ]; then
+  echo "    [FAIL] Expected '$serial_output' with -j 3, but got '$parallel_output'"
+  exit 1
+fi
+
+# Large files are split into byte ranges, one per task: together the ranges must yield
+# every matching line once, including when a range ends with a newline.
+if ! grep_python <<'EOF'
+import os
+with open('chunked_input.txt', 'w') as f:
+    for i in range(40):
+        f.write('apple %d ' % i + 'x' * (i * 37 % 300) + '\n')
+size = os.path.getsize('chunked_input.txt')
+parser = grep.RegexParser(r'apple \d+')
+matcher = grep.LineMatcher(parser.parse(), parser)
+expected = list(grep.scan_file_range('chunked_input.txt', matcher, 0, size))
+for chunk in (1, 7, 77, 300):
+    lines = [line for start in range(0, size, chunk)
+             for line in grep.scan_file_range('chunked_input.txt', matcher, start, start + chunk)]
+    assert lines == expected and len(lines) == 40, (chunk, len(lines))
+os.remove('chunked_input.txt')
+EOF
+then
+  rm -f chunked_input.txt
+  echo "    [FAIL] File ranges yielded a line more or less than once"
+  exit 1
+fi
+
+echo "Test 21 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Streaming stdin -- \033[0m"
+echo " ------------------------------------------------ "
+
+long_line="$(head -c 300000 /dev/zero | tr '\0' 'x')needle"
+output=$(printf 'first needle\nnothing here\n%s\nlast needle' "$long_line" | python3 app/ast.py --line-buffered -E "needle$" | cut -c1-12)
+expected=$(printf 'first needle\nxxxxxxxxxxxx\nlast needle')
+
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected', but got '$output'"
+  exit 1
+fi
+
+echo "Test 22 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Backreferences on long lines -- \033[0m"
+echo " ------------------------------------------------ "
+
+set +e  # Allow commands to fail without exiting
+long_word=$(printf 'a%.0s' {1..2000})
+echo -n "$long_word and $long_word" | timeout 10 python3 app/ast.py -E "(\w+) and \1"
+code1=$?
+echo -n "$long_word and b" | timeout 10 python3 app/ast.py -E "^(\w+) and \1$"
+code2=$?
+set -e
+
+if [ $code1 -ne 0 ]; then
+  echo "Expected exit code 0 for a long repeated word, got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 1 ]; then
+  echo "Expected exit code 1 for a long word followed by a different one, got $code2"
+  exit 1
+fi
+
+echo "Test 23 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Memoized backtracking -- \033[0m"
+echo " ------------------------------------------------ "
+
+set +e  # Allow commands to fail without exiting
+echo -n "abababababababababababababababababababababababababab" | timeout 10 python3 app/ast.py -E "(a)(.*.*b)*c\1"
+code1=$?
+echo -n "ababababababababababababababababababababababababc a" | timeout 10 python3 app/ast.py -E "(a)(.*.*b)*c \1"
+code2=$?
+set -e
+
+if [ $code1 -ne 1 ]; then
+  echo "Expected exit code 1 for (a)(.*.*b)*c\1 without a 'c', got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 0 ]; then
+  echo "Expected exit code 0 for (a)(.*.*b)*c \1, got $code2"
+  exit 1
+fi
+
+echo "Test 24 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Multiple patterns (-e, -f) -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf 'error: disk full\nwarning: cpu hot\nuser id 42\nokok\nall good\n' > /tmp/ast_multi_input.txt
+printf 'disk full\n\\d+\n' > /tmp/ast_multi_patterns.txt
+set +e  # Allow commands to fail without exiting
+output=$(python3 app/ast.py -e "cpu" -e "(ok)\1" -f /tmp/ast_multi_patterns.txt /tmp/ast_multi_input.txt 2>/dev/null)
+code1=$?
+python3 app/ast.py -e "absent" -e "missing" /tmp/ast_multi_input.txt > /dev/null 2>&1
+code2=$?
+set -e
+expected=$(printf 'error: disk full\nwarning: cpu hot\nuser id 42\nokok')
+rm -f /tmp/ast_multi_input.txt /tmp/ast_multi_patterns.txt
+
+if [ $code1 -ne 0 ] || [ "$output" != "$expected" ]; then
+  echo "Expected the lines matching any of the patterns, got: $output"
+  exit 1
+fi
+
+if [ $code2 -ne 1 ]; then
+  echo "Expected exit code 1 when no pattern matches, got $code2"
+  exit 1
+fi
+
+echo "Test 25 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Statistics report (--stats) -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf 'ab ab\nab cd\nnothing\n' > /tmp/ast_stats_input.txt
+set +e  # Allow commands to fail without exiting
+report=$(python3 app/ast.py --stats=json -E "(\w+) \1" /tmp/ast_stats_input.txt 2>&1 >/dev/null)
+code1=$?
+set -e
+rm -f /tmp/ast_stats_input.txt
+
+if [ $code1 -ne 0 ]; then
+  echo "Expected exit code 0 with --stats=json, got $code1"
+  exit 1
+fi
+
+if ! echo "$report" | python3 -c "
+import json, sys
+report = json.load(sys.stdin)
+assert report['engine'] == 'backtrack', report
+assert report['lines_scanned'] == 3 and report['lines_matched'] == 1, report
+assert report['prefilter_rejects'] == 1, report
+assert report['nodes_evaluated'] > 0 and report['backtracks'] > 0, report
+assert report['slowest_files'][0]['file'] == '/tmp/ast_stats_input.txt', report
+"; then
+  echo "Unexpected --stats=json report: $report"
+  exit 1
+fi
+
+echo "Test 26 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Ranges and \\s \\S \\D \\W classes -- \033[0m"
+echo " ------------------------------------------------ "
+
+set +e  # Allow commands to fail without exiting
+echo -n "id: x42" | python3 app/ast.py -E "^[a-z]+:\s[a-z0-9_]+$"
+code1=$?
+echo -n "id: X42" | python3 app/ast.py -E "^[a-z]+:\s[a-z0-9_]+$"
+code2=$?
+echo -n "a1-b2" | python3 app/ast.py -E "\d\W\D\S"
+code3=$?
+echo -n "a1 b2" | python3 app/ast.py -E "\d\W\D\S\s"
+code4=$?
+echo -n "tab sep" | python3 app/ast.py -E "^[\w-]+$"
+code5=$?
+set -e
+
+if [ $code1 -ne 0 ]; then
+  echo "Expected exit code 0 for ranges and \\s, got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 1 ]; then
+  echo "Expected exit code 1 for an uppercase letter outside [a-z0-9_], got $code2"
+  exit 1
+fi
+
+if [ $code3 -ne 0 ]; then
+  echo "Expected exit code 0 for \\d\\W\\D\\S, got $code3"
+  exit 1
+fi
+
+if [ $code4 -ne 1 ]; then
+  echo "Expected exit code 1 for \\d\\W\\D\\S\\s, got $code4"
+  exit 1
+fi
+
+if [ $code5 -ne 1 ]; then
+  echo "Expected exit code 1 for ^[\\w-]+$ on 'tab sep', got $code5"
+  exit 1
+fi
+
+echo "Test 27 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Output modes -q, -l, -L, -c and -m -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf "a1\nb\na2\na3\n" > modes1.txt
+printf "b\n" > modes2.txt
+for JOBS in 1 2; do
+  set +e  # Allow commands to fail without exiting
+  output=$(python3 app/ast.py -j $JOBS -q -E "a" modes1.txt modes2.txt)
+  code1=$?
+  python3 app/ast.py -j $JOBS -q -E "z" modes1.txt modes2.txt
+  code2=$?
+  set -e
+
+  if [ $code1 -ne 0 ] || [ -n "$output" ]; then
+    echo "Expected exit code 0 and no output for -q with a match (-j $JOBS), got $code1 and '$output'"
+    exit 1
+  fi
+
+  if [ $code2 -ne 1 ]; then
+    echo "Expected exit code 1 for -q without a match (-j $JOBS), got $code2"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS -l -E "a" modes1.txt modes2.txt)
+  if [ "$output" != "modes1.txt" ]; then
+    echo "    [FAIL] Expected 'modes1.txt' from -l (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS -L -E "a" modes1.txt modes2.txt)
+  if [ "$output" != "modes2.txt" ]; then
+    echo "    [FAIL] Expected 'modes2.txt' from -L (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS -c -E "a" modes1.txt modes2.txt)
+  expected=$(printf 'modes1.txt:3\nmodes2.txt:0')
+  if [ "$output" != "$expected" ]; then
+    echo "    [FAIL] Expected '$expected' from -c (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS -m 2 -E "a" modes1.txt)
+  expected=$(printf 'a1\na2')
+  if [ "$output" != "$expected" ]; then
+    echo "    [FAIL] Expected '$expected' from -m 2 (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+done
+
+output=$(printf "a\nb\na\n" | python3 app/ast.py -c -m 1 -E "a")
+rm -f modes1.txt modes2.txt
+
+if [ "$output" != "1" ]; then
+  echo "    [FAIL] Expected '1' from -c -m 1 on stdin, but got '$output'"
+  exit 1
+fi
+
+# A pattern that looks like a flag is still the pattern.
+for FLAG in -c -n -o -l -m; do
+  set +e  # Allow commands to fail without exiting
+  output=$(echo "x $FLAG y" | python3 app/ast.py -E "$FLAG")
+  code1=$?
+  set -e
+  if [ $code1 -ne 0 ] || [ "$output" != "x $FLAG y" ]; then
+    echo "Expected exit code 0 and 'x $FLAG y' for -E \"$FLAG\", got $code1 and '$output'"
+    exit 1
+  fi
+done
+
+output=$(echo "x -c y" | python3 app/ast.py -c -e "-o" -e "-c")
+if [ "$output" != "1" ]; then
+  echo "    [FAIL] Expected '1' from -c with the patterns -o and -c, but got '$output'"
+  exit 1
+fi
+
+echo "Test 28 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Binary files and --binary-files -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf "hello\0world\nhello again\n" > binary.dat
+printf "hello text\n" > text.txt
+for JOBS in 1 2; do
+  output=$(python3 app/ast.py -j $JOBS -E "hello" binary.dat text.txt)
+  expected=$(printf 'Binary file binary.dat matches\ntext.txt:hello text')
+  if [ "$output" != "$expected" ]; then
+    echo "    [FAIL] Expected '$expected' (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS --binary-files=without-match -E "hello" binary.dat text.txt)
+  if [ "$output" != "text.txt:hello text" ]; then
+    echo "    [FAIL] Expected only text.txt with --binary-files=without-match (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+
+  output=$(python3 app/ast.py -j $JOBS --binary-files=text -E "again" binary.dat)
+  if [ "$output" != "hello again" ]; then
+    echo "    [FAIL] Expected 'hello again' with --binary-files=text (-j $JOBS), but got '$output'"
+    exit 1
+  fi
+done
+
+count_output=$(python3 app/ast.py -c -E "hello" binary.dat)
+block_output=$(python3 app/ast.py --binary-block-size 3 -E "again" binary.dat)
+stdin_output=$(python3 app/ast.py -E "hello" < binary.dat)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py --binary-files=bogus -E "hello" text.txt 2>/dev/null
+code1=$?
+set -e
+rm -f binary.dat text.txt
+
+if [ "$count_output" != "2" ]; then
+  echo "    [FAIL] Expected '2' from -c on a binary file, but got '$count_output'"
+  exit 1
+fi
+
+if [ "$block_output" != "hello again" ]; then
+  echo "    [FAIL] Expected 'hello again' when the NUL is past --binary-block-size, but got '$block_output'"
+  exit 1
+fi
+
+if [ "$stdin_output" != "Binary file (standard input) matches" ]; then
+  echo "    [FAIL] Expected a binary report for stdin, but got '$stdin_output'"
+  exit 1
+fi
+
+if [ $code1 -ne 2 ]; then
+  echo "Expected exit code 2 for an unknown --binary-files type, got $code1"
+  exit 1
+fi
+
+echo "Test 29 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Recursive traversal: ignore files and globs -- \033[0m"
+echo " ------------------------------------------------ "
+
+mkdir -p walk_dir/.git walk_dir/node_modules/pkg walk_dir/src/gen walk_dir/sub
+for f in .git/a.txt node_modules/pkg/a.txt src/a.txt src/a.log src/gen/a.txt sub/a.txt sub/b.txt; do
+  echo "needle" > "walk_dir/$f"
+done
+printf "node_modules/\n*.log\nsrc/gen/\n" > walk_dir/.gitignore
+printf "!a.log\n" > walk_dir/src/.gitignore
+printf "b.txt\n" > walk_dir/sub/.ignore
+
+ignore_output=$(python3 app/ast.py -r -E "needle" walk_dir | sort)
+no_ignore_count=$(python3 app/ast.py -r --no-ignore -E "needle" walk_dir | wc -l)
+include_output=$(python3 app/ast.py -r --no-ignore --include='*.log' -E "needle" walk_dir)
+exclude_output=$(python3 app/ast.py -r --exclude-dir=src --exclude='b*' -E "needle" walk_dir)
+rm -rf walk_dir
+
+expected=$(printf 'walk_dir/src/a.log:needle\nwalk_dir/src/a.txt:needle\nwalk_dir/sub/a.txt:needle')
+if [ "$ignore_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' with the ignore rules, but got '$ignore_output'"
+  exit 1
+fi
+
+if [ "$no_ignore_count" -ne 6 ]; then
+  echo "    [FAIL] Expected 6 matches with --no-ignore (all but .git), but got $no_ignore_count"
+  exit 1
+fi
+
+if [ "$include_output" != "walk_dir/src/a.log:needle" ]; then
+  echo "    [FAIL] Expected only the .log file with --include, but got '$include_output'"
+  exit 1
+fi
+
+if [ "$exclude_output" != "walk_dir/sub/a.txt:needle" ]; then
+  echo "    [FAIL] Expected only sub/a.txt with --exclude-dir/--exclude, but got '$exclude_output'"
+  exit 1
+fi
+
+echo "Test 30 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Trigram index (index, --index) -- \033[0m"
+echo " ------------------------------------------------ "
+
+mkdir -p index_dir/sub
+printf "timeout after 30ms\nok\n" > index_dir/a.log
+printf "connection refused\n" > index_dir/sub/b.log
+python3 app/ast.py index index_dir 2>/dev/null
+
+if [ ! -f index_dir/.grep-index ]; then
+  echo "    [FAIL] Expected 'index' to write index_dir/.grep-index"
+  exit 1
+fi
+
+output=$(python3 app/ast.py --index -E "timeout after \d+ms" index_dir)
+if [ "$output" != "index_dir/a.log:timeout after 30ms" ]; then
+  echo "    [FAIL] Expected the a.log match from the indexed search, but got '$output'"
+  exit 1
+fi
+
+output=$(python3 app/ast.py --index -E "(refused|ok)" index_dir | wc -l)
+if [ "$output" -ne 2 ]; then
+  echo "    [FAIL] Expected 2 matches for an alternation query, but got $output"
+  exit 1
+fi
+
+output=$(python3 app/ast.py -r -E "grep-index" index_dir | wc -l)
+if [ "$output" -ne 0 ]; then
+  echo "    [FAIL] Expected the index file not to be searched, but got $output matches"
+  exit 1
+fi
+
+output=$(python3 app/ast.py --index -c -E "refused" index_dir | sort)
+expected=$(printf 'index_dir/a.log:0\nindex_dir/sub/b.log:1')
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from -c with --index, but got '$output'"
+  exit 1
+fi
+
+printf "timeout after 5ms\n" >> index_dir/sub/b.log
+output=$(python3 app/ast.py index index_dir 2>&1)
+if [ "$output" != "index_dir: indexed 2 files (1 read)" ]; then
+  echo "    [FAIL] Expected an incremental update reading 1 file, but got '$output'"
+  exit 1
+fi
+
+output=$(python3 app/ast.py --index -E "after 5ms" index_dir)
+if [ "$output" != "index_dir/sub/b.log:timeout after 5ms" ]; then
+  rm -rf index_dir
+  echo "    [FAIL] Expected the appended line after the update, but got '$output'"
+  exit 1
+fi
+
+# Without reindexing, a new file and a line appended to an indexed file are still found.
+printf "refused again\n" > index_dir/c.log
+printf "refused too\n" >> index_dir/a.log
+output=$(python3 app/ast.py --index -E "refused \w+" index_dir | sort)
+rm -rf index_dir
+expected=$(printf 'index_dir/a.log:refused too\nindex_dir/c.log:refused again')
+if [ "$output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from a stale index, but got '$output'"
+  exit 1
+fi
+
+# "index" is a subcommand only as the first argument; elsewhere it is a file to search.
+mkdir -p index_name_dir/d
+printf "foo in a file named index\n" > index_name_dir/index
+file_output=$(cd index_name_dir && python3 ../app/ast.py -E foo index)
+dir_output=$(cd index_name_dir && python3 ../app/ast.py -E foo index d)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py index -E foo index_name_dir/d 2>/dev/null
+code1=$?
+set -e
+written=$(ls -A index_name_dir/d)
+rm -rf index_name_dir
+
+if [ "$file_output" != "foo in a file named index" ] || [ "$dir_output" != "index:foo in a file named index" ]; then
+  echo "    [FAIL] Expected the file named index to be searched, but got '$file_output' and '$dir_output'"
+  exit 1
+fi
+
+if [ $code1 -ne 2 ] || [ -n "$written" ]; then
+  echo "Expected exit code 2 and no index for 'index' with a pattern, got $code1 and '$written'"
+  exit 1
+fi
+
+echo "Test 31 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Result cache (--cache-dir) -- \033[0m"
+echo " ------------------------------------------------ "
+
+cache_dir="$(mktemp -d)"
+mkdir -p cache_files
+printf "apple pie\napple tart\nplum\n" > cache_files/a.txt
+touch -r test.sh cache_files/a.txt
+first_count=$(python3 app/ast.py --cache-dir "$cache_dir" -r -E "apple \w+" cache_files | wc -l)
+# Same size, inode and mtime: the cached result is used without reading the file.
+printf "apply pie\napple tart\nplum\n" > cache_files/a.txt
+touch -r test.sh cache_files/a.txt
+cached_count=$(python3 app/ast.py --cache-dir "$cache_dir" -c -E "apple \w+" cache_files/a.txt)
+cached_lines=$(python3 app/ast.py --cache-dir "$cache_dir" -E "apple \w+" cache_files/a.txt)
+python3 app/ast.py invalidate-cache --cache-dir "$cache_dir" cache_files 2>/dev/null
+invalidated_count=$(python3 app/ast.py --cache-dir "$cache_dir" -c -E "apple \w+" cache_files/a.txt)
+printf "apple pie, apple tart\n" > cache_files/a.txt
+changed_count=$(python3 app/ast.py --cache-dir "$cache_dir" -c -E "apple \w+" cache_files/a.txt)
+python3 app/ast.py --cache-dir "$cache_dir" --cache-size 0 -c -E "apple" cache_files/a.txt > /dev/null
+evicted=$(ls "$cache_dir")
+# A bracket pattern gets the same key in every run, whatever order its set iterates in.
+PYTHONHASHSEED=1 python3 app/ast.py --cache-dir "$cache_dir" -c -E "[aelp]+ \w+" cache_files/a.txt > /dev/null
+PYTHONHASHSEED=2 python3 app/ast.py --cache-dir "$cache_dir" -c -E "[aelp]+ \w+" cache_files/a.txt > /dev/null
+bracket_entries=$(ls "$cache_dir" | wc -l)
+# "invalidate-cache" is a subcommand only as the first argument; elsewhere it is a file.
+printf "apple in a file named invalidate-cache\n" > cache_files/invalidate-cache
+named_output=$(cd cache_files && python3 ../app/ast.py --cache-dir "$cache_dir" -E apple invalidate-cache)
+named_entries=$(ls "$cache_dir" | wc -l)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py invalidate-cache --cache-dir "$cache_dir" -E apple 2>/dev/null
+code1=$?
+set -e
+kept_entries=$(ls "$cache_dir" | wc -l)
+rm -rf cache_files "$cache_dir"
+
+if [ "$first_count" -ne 2 ]; then
+  echo "    [FAIL] Expected 2 matches on the first run, but got $first_count"
+  exit 1
+fi
+
+if [ "$cached_count" != "2" ]; then
+  echo "    [FAIL] Expected -c to be answered from the cache (2), but got '$cached_count'"
+  exit 1
+fi
+
+expected=$(printf 'apply pie\napple tart')
+if [ "$cached_lines" != "$expected" ]; then
+  echo "    [FAIL] Expected cached spans to be read from the file ('$expected'), but got '$cached_lines'"
+  exit 1
+fi
+
+if [ "$invalidated_count" != "1" ]; then
+  echo "    [FAIL] Expected 1 match after invalidate-cache, but got '$invalidated_count'"
+  exit 1
+fi
+
+if [ "$changed_count" != "1" ]; then
+  echo "    [FAIL] Expected 1 match for a changed file, but got '$changed_count'"
+  exit 1
+fi
+
+if [ -n "$evicted" ]; then
+  echo "    [FAIL] Expected --cache-size 0 to evict every entry, but found '$evicted'"
+  exit 1
+fi
+
+if [ "$bracket_entries" -ne 1 ]; then
+  echo "    [FAIL] Expected one cache entry for a bracket pattern run twice, but found $bracket_entries"
+  exit 1
+fi
+
+if [ "$named_output" != "apple in a file named invalidate-cache" ] || [ "$named_entries" -ne 2 ]; then
+  echo "    [FAIL] Expected the file named invalidate-cache to be searched and cached, but got '$named_output' and $named_entries entries"
+  exit 1
+fi
+
+if [ $code1 -ne 2 ] || [ "$kept_entries" -ne 2 ]; then
+  echo "Expected exit code 2 and no entries removed for 'invalidate-cache' with a pattern, got $code1 and $kept_entries entries"
+  exit 1
+fi
+
+echo "Test 32 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Read-ahead pipeline (--readahead) -- \033[0m"
+echo " ------------------------------------------------ "
+
+mkdir -p readahead_dir
+for i in $(seq 1 40); do printf "line $i\nmatch $i\n" > "readahead_dir/f$i.txt"; done
+printf "big\0binary match\n" > readahead_dir/bin.dat
+for MODE in "" "-c" "-l" "-m 1"; do
+  expected=$(python3 app/ast.py $MODE -r -E "match \d+" readahead_dir | md5sum)
+  output=$(python3 app/ast.py --readahead 4 $MODE -r -E "match \d+" readahead_dir | md5sum)
+  if [ "$output" != "$expected" ]; then
+    rm -rf readahead_dir
+    echo "    [FAIL] Expected --readahead to keep the serial output ($MODE)"
+    exit 1
+  fi
+done
+
+binary_output=$(python3 app/ast.py --readahead 4 -r -E "binary" readahead_dir)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py --readahead 4 -q -r -E "match 7" readahead_dir
+code1=$?
+set -e
+rm -rf readahead_dir
+
+if [ "$binary_output" != "Binary file readahead_dir/bin.dat matches" ]; then
+  echo "    [FAIL] Expected a binary report, but got '$binary_output'"
+  exit 1
+fi
+
+if [ $code1 -ne 0 ]; then
+  echo "Expected exit code 0 for -q with --readahead, got $code1"
+  exit 1
+fi
+
+echo "Test 33 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Large inputs match like small ones -- \033[0m"
+echo " ------------------------------------------------ "
+
+# Large buffers are matched in batches when NumPy is installed.
+python3 -c "
+import random
+rng = random.Random(34)
+words = ['alpha', 'Beta', 'café', '123', '4567', 'x9', '', 'été', 'z']
+with open('batch_input.txt', 'w', encoding='utf-8') as f:
+    for i in range(6000):
+        f.write('  ' + ' '.join(rng.choice(words) for _ in range(rng.randint(0, 8))) + ' \\n')
+    f.write('x' * 3000 + ' 123 tail\\n')
+"
+for PATTERN in "\d\d\d \w+" "^[A-Z]\w+ \w+$" "é\w" "(x9|z) caf" "t\w*l$"; do
+  expected="$(python3 -c "
+import re, sys
+pattern = re.compile(sys.argv[1])
+for line in open('batch_input.txt', encoding='utf-8'):
+    if pattern.search(line.strip()):
+        print(line.strip())
+" "$PATTERN" | md5sum)"
+  file_output=$(python3 app/ast.py -E "$PATTERN" batch_input.txt | md5sum)
+  stdin_output=$(python3 app/ast.py -E "$PATTERN" < batch_input.txt | md5sum)
+  if [ "$file_output" != "$expected" ] || [ "$stdin_output" != "$expected" ]; then
+    rm -f batch_input.txt
+    echo "    [FAIL] Expected the lines Python's re matches for '$PATTERN' from the file and stdin"
+    exit 1
+  fi
+done
+rm -f batch_input.txt
+
+echo "Test 34 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- compile() API, -o, -n and -b -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf "  foo 12 bar 345\nnone\n\tcafé 7 é 88\n" > only_input.txt
+only_output=$(python3 app/ast.py -o -E "\d+" only_input.txt)
+located_output=$(python3 app/ast.py -n -b -E "\d+" only_input.txt)
+offset_output=$(python3 app/ast.py -o -b -E "é 8\d" only_input.txt)
+multi_output=$(python3 app/ast.py -o -n -e "(\w)\1" -e "ba" < only_input.txt)
+parallel_output=$(python3 app/ast.py -n -j 2 -E "café" only_input.txt only_input.txt)
+empty_output=$(echo "foo bar" | python3 app/ast.py -o -E "x*|foo")
+rm -f only_input.txt
+
+expected=$(printf '12\n345\n7\n88')
+if [ "$only_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from -o, but got '$only_output'"
+  exit 1
+fi
+
+expected=$(printf '1:0:foo 12 bar 345\n3:22:café 7 é 88')
+if [ "$located_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from -n -b, but got '$located_output'"
+  exit 1
+fi
+
+if [ "$offset_output" != "31:é 88" ]; then
+  echo "    [FAIL] Expected '31:é 88' from -o -b, but got '$offset_output'"
+  exit 1
+fi
+
+expected=$(printf '1:oo\n1:ba\n3:88')
+if [ "$multi_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from -o -n with several patterns, but got '$multi_output'"
+  exit 1
+fi
+
+expected=$(printf 'only_input.txt:3:café 7 é 88\nonly_input.txt:3:café 7 é 88')
+if [ "$parallel_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from -n -j 2, but got '$parallel_output'"
+  exit 1
+fi
+
+# An empty match at 0 is followed by the non-empty match there, as in re.
+if [ "$empty_output" != "foo" ]; then
+  echo "    [FAIL] Expected 'foo' from -o with x*|foo, but got '$empty_output'"
+  exit 1
+fi
+
+if ! grep_python <<'EOF'
+import concurrent.futures, re
+pattern = grep.compile(r'(\d+)-(\w+)')
+match = pattern.search('id 12-ab 3-c')
+assert match.span() == (3, 8) and match.groups() == ('12', 'ab') and match.span(2) == (6, 8), match
+assert [m.group() for m in pattern.finditer('1-a 22-b 333-ccc')] == ['1-a', '22-b', '333-ccc']
+assert pattern.fullmatch('12-ab') and not pattern.fullmatch('12-ab!') and not pattern.search('none')
+assert pattern.search('12-ab', 1).group(1) == '2'
+repeated = grep.compile(r'(\w+) \1')
+lines = ['say %s %s ok' % (word, word if i % 3 else word + 'x') for i, word in enumerate(['hi', 'yo', 'hey'] * 200)]
+expected = [repeated.search(line) is not None for line in lines]
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    assert list(pool.map(lambda line: repeated.search(line) is not None, lines)) == expected
+assert repeated.search('a hello hello').group(1) == 'hello'
+for pattern in ['x*|foo', '(x*)\\1|foo', 'a??', '(|b)a*']:
+    spans = [m.span() for m in grep.compile(pattern).finditer('foo bar aab')]
+    assert spans == [m.span() for m in re.finditer(pattern, 'foo bar aab')], (pattern, spans)
+EOF
+then
+  echo "    [FAIL] The compile() API returned unexpected matches"
+  exit 1
+fi
+
+echo "Test 35 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Backtracker captures are restored on backtracking -- \033[0m"
+echo " ------------------------------------------------ "
+
+if ! grep_python <<'EOF'
+match = grep.compile(r'(\w+) \1').search('say hello hello')
+assert match.span(1) == (4, 9) and match.span() == (4, 15), match
+# The first attempts set group 2 to 'ab' before backtracking; it must not leak into the match.
+match = grep.compile(r'((a)(b))+ \3|(\w+)b \4').search('abab aba')
+assert match.groups() == (None, None, None, 'aba') and match.span(4) == (0, 3), match.groups()
+parser = grep.RegexParser(r'(a|ab)(c|bcd)\2(d*)')
+assert grep.match_entire_ast(parser.parse(), 'abcdbcdd', parser) == (True, 8, [None, 'a', 'bcd', 'd'])
+EOF
+then
+  echo "    [FAIL] Backtracker captures leaked or were lost"
+  exit 1
+fi
+
+echo "Test 36 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Shared leaves, flat programs and pickling -- \033[0m"
+echo " ------------------------------------------------ "
+
+if ! grep_python <<'EOF'
+import pickle
+first, second = grep.RegexParser(r'a[^xy]\d').parse(), grep.RegexParser(r'(a)|[^xy]\d+').parse()
+leaves = lambda ast: [node for node in ast.walk() if not node.children]
+assert all(any(node is other for other in leaves(second)) for node in leaves(first))
+program = grep.compile_program(grep.RegexParser(r'(\w+)-[xyz]\s*é$').parse(), 1)
+assert program.ops.typecode == 'i' and len(program.xs) == len(program.ys) == len(program)
+copy = pickle.loads(pickle.dumps(program))
+assert [inst[0] for inst in copy.insts] == list(program.ops) and copy.insts[-3][1] == 'end'
+parser = grep.RegexParser(r'user=(\w+) [^0-9]+\d+ms$')
+matcher = grep.LineMatcher(parser.parse(), parser)
+lines = ['user=bob took 12ms', 'user=bob took 12s', 'user= x 1ms', 'user=é q 7ms']
+expected = [matcher.matches(line) for line in lines]
+assert expected == [True, False, False, True], expected
+assert [pickle.loads(pickle.dumps(matcher)).matches(line) for line in lines] == expected
+assert pickle.loads(pickle.dumps(grep.compile(r'(\d+)ms'))).search('took 12ms').span(1) == (5, 7)
+EOF
+then
+  echo "    [FAIL] Leaves were not shared, or a program or matcher did not survive pickling"
+  exit 1
+fi
+
+echo "Test 37 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Counted repetition and lazy quantifiers -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf "id=1a2b3c ok\nid=1a2b3 short\nid=1a2b3c4d5e6f7 long\n2024-05-01 12:00\na{2} literal\n<b>x</b><b>y</b>\n" > counted_input.txt
+range_output=$(python3 app/ast.py -E "id=[0-9a-f]{6,12} " counted_input.txt)
+open_output=$(python3 app/ast.py -o -E "[0-9a-f]{7,}" counted_input.txt)
+exact_output=$(python3 app/ast.py -E "^\d{4}-\d{2}-\d{2} " counted_input.txt)
+lazy_output=$(python3 app/ast.py -o -E "<b>.*?</b>" counted_input.txt)
+lazy_counted_output=$(python3 app/ast.py -o -E "[0-9a-f]{2,}?" counted_input.txt | head -1)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py -E "a{2} lit" counted_input.txt
+code1=$?
+python3 app/ast.py -E "a{} lit" counted_input.txt
+code2=$?
+python3 app/ast.py -E "^a{,} " counted_input.txt
+code3=$?
+python3 app/ast.py -E "a{5,2}" counted_input.txt 2>/dev/null
+code4=$?
+set -e
+
+if [ "$range_output" != "id=1a2b3c ok" ]; then
+  echo "    [FAIL] Expected 'id=1a2b3c ok' for {6,12}, but got '$range_output'"
+  exit 1
+fi
+
+if [ "$open_output" != "1a2b3c4d5e6f7" ]; then
+  echo "    [FAIL] Expected '1a2b3c4d5e6f7' for {7,}, but got '$open_output'"
+  exit 1
+fi
+
+if [ "$exact_output" != "2024-05-01 12:00" ]; then
+  echo "    [FAIL] Expected the date line for \\d{4}-\\d{2}-\\d{2}, but got '$exact_output'"
+  exit 1
+fi
+
+expected=$(printf '<b>x</b>\n<b>y</b>')
+if [ "$lazy_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' for .*?, but got '$lazy_output'"
+  exit 1
+fi
+
+if [ "$lazy_counted_output" != "1a" ]; then
+  echo "    [FAIL] Expected '1a' for {2,}?, but got '$lazy_counted_output'"
+  exit 1
+fi
+
+if [ $code1 -ne 1 ]; then
+  echo "Expected exit code 1 for a{2} (a repetition, not a literal), got $code1"
+  exit 1
+fi
+
+if [ $code2 -ne 1 ] || [ $code3 -ne 1 ]; then
+  echo "Expected exit code 1 for the literal braces a{} and a{,}, got $code2 and $code3"
+  exit 1
+fi
+
+if [ $code4 -eq 0 ]; then
+  echo "Expected a{5,2} to be rejected, got exit code 0"
+  exit 1
+fi
+
+# Programs over --max-program-size run on the backtracker, with the same results.
+for PATTERN in "id=[0-9a-f]{6,12} " "(\w{2}){2,3}3c" "<b>.+?</b>$" "^\d{4}-(\d{2})-\d{2}"; do
+  expected=$(python3 app/ast.py -n -o -E "$PATTERN" counted_input.txt)
+  output=$(python3 app/ast.py --max-program-size 8 -n -o -E "$PATTERN" counted_input.txt)
+  if [ "$output" != "$expected" ]; then
+    rm -f counted_input.txt
+    echo "    [FAIL] Expected '$expected' with --max-program-size 8 for '$PATTERN', but got '$output'"
+    exit 1
+  fi
+done
+rm -f counted_input.txt
+
+# {1,5000} is too large for a program, so the backtracker counts the 3,000 repetitions.
+python3 -c "print('ab' * 3000)" > counted_long.txt
+file_output=$(python3 app/ast.py -c -E '(ab){1,5000}$' counted_long.txt)
+stdin_output=$(python3 app/ast.py -c -E '^(ab){1,5000}$' < counted_long.txt)
+set +e  # Allow commands to fail without exiting
+python3 app/ast.py -q -E '^(ab){3001,5000}$' counted_long.txt
+code5=$?
+set -e
+rm -f counted_long.txt
+
+if [ "$file_output" != "1" ] || [ "$stdin_output" != "1" ]; then
+  echo "    [FAIL] Expected a count of 1 for (ab){1,5000} from the file and stdin, but got '$file_output' and '$stdin_output'"
+  exit 1
+fi
+
+if [ $code5 -ne 1 ]; then
+  echo "Expected exit code 1 for (ab){3001,5000} on 3,000 pairs, got $code5"
+  exit 1
+fi
+
+if ! grep_python <<'EOF'
+import re
+parser = grep.RegexParser(r'(ab|c){2,3}?x\d{1000}')
+ast = parser.parse()
+assert 'min_count=2, max_count=3' in repr(ast) and len(grep.compile_program(ast, 1)) < 1100
+assert grep.nfa_program(grep.RegexParser(r'(a|b){5000}').parse(), 1) is None
+line = 'cab' + 'abcx' + '7' * 1000
+for pattern in [r'(ab|c){2,3}?x\d{1000}', r'(ab|c){2,3}x\d{999}', r'(ab|c){2}a', r'b\w{0,2}?x', r'(a|b{0})c']:
+    expected = re.search(pattern, line)
+    for search in (grep.compile(pattern).search, lambda l: grep.backtrack_search(grep.RegexParser(pattern).parse(), l, re.compile(pattern).groups)):
+        got = search(line)
+        got = got if got is None or isinstance(got, list) else list(got._slots)
+        assert (got is None) == (expected is None) and (got is None or (got[0], got[1]) == expected.span()), (pattern, got)
+EOF
+then
+  echo "    [FAIL] Counted repetitions matched differently from Python's re"
+  exit 1
+fi
+
+echo "Test 38 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Long lines under a repeated multi-character group -- \033[0m"
+echo " ------------------------------------------------ "
+
+# The backtracker repeats (ab)+ with an explicit stack, not one nested generator per pair.
+python3 -c "print('ab' * 3000 + ' ab')" > long_group.txt
+file_output=$(python3 app/ast.py -c -E '(ab)+ \1' long_group.txt)
+stdin_output=$(python3 app/ast.py -c -E '(ab)+ \1' < long_group.txt)
+only_output=$(python3 app/ast.py -o -E '(ab)+ \1' long_group.txt | wc -c)
+rm -f long_group.txt
+
+if [ "$file_output" != "1" ] || [ "$stdin_output" != "1" ]; then
+  echo "    [FAIL] Expected a count of 1 from the file and stdin, but got '$file_output' and '$stdin_output'"
+  exit 1
+fi
+
+if [ "$only_output" -ne 6004 ]; then
+  echo "    [FAIL] Expected -o to print the whole 6003-character line, but got $only_output bytes"
+  exit 1
+fi
+
+echo "Test 39 passed."
+echo ""
+
+echo " ------------------------------------------------ "
+echo -e "\033[1m -- Required-literal prefilter -- \033[0m"
+echo " ------------------------------------------------ "
+
+printf 'ERROR only\nERROR 5 ok\nERROR timeout\nINFO 42 timeout\nxERROR 9 refused\nERROR 42 timeout\nhello world\nhelo\nsay hello\nHELLO\na dog\ncats\na.b\naxb\n' > prefilter_input.txt
+
+# The prefilter choice is reported by --debug.
+required_debug=$(python3 app/ast.py --debug -E "ERROR \d+ (timeout|refused)" prefilter_input.txt 2>&1 >/dev/null | grep "prefilter:")
+literal_debug=$(python3 app/ast.py --debug -E "hello" prefilter_input.txt 2>&1 >/dev/null | grep "prefilter:")
+set_debug=$(python3 app/ast.py --debug -E "(cat|dog)" prefilter_input.txt 2>&1 >/dev/null | grep "prefilter:")
+none_debug=$(python3 app/ast.py --debug -E "\d+" prefilter_input.txt 2>&1 >/dev/null | grep "prefilter:")
+literal_engine=$(python3 app/ast.py --stats=json -E "hello" prefilter_input.txt 2>&1 >/dev/null | grep -o '"engine": "[a-z-]*"')
+
+# Lines with only the required literal "ERROR " must still be rejected by the matcher.
+required_output=$(python3 app/ast.py -E "ERROR \d+ (timeout|refused)" prefilter_input.txt)
+required_stdin_output=$(python3 app/ast.py -E "ERROR \d+ (timeout|refused)" < prefilter_input.txt)
+# Exact patterns are answered by the literal search alone.
+literal_output=$(python3 app/ast.py -E "hello" prefilter_input.txt)
+set_output=$(python3 app/ast.py -o -E "(cat|dog)" prefilter_input.txt)
+escaped_output=$(python3 app/ast.py -c -E "a\.b" prefilter_input.txt)
+rm -f prefilter_input.txt
+
+if [ "$required_debug" != "debug: prefilter: LiteralPrefilter(kind='literal', literals=['ERROR '], exact=False)" ]; then
+  echo "    [FAIL] Expected the required literal 'ERROR ' (not exact), but got '$required_debug'"
+  exit 1
+fi
+
+if [ "$literal_debug" != "debug: prefilter: LiteralPrefilter(kind='literal', literals=['hello'], exact=True)" ]; then
+  echo "    [FAIL] Expected an exact literal prefilter for hello, but got '$literal_debug'"
+  exit 1
+fi
+
+if [ "$set_debug" != "debug: prefilter: LiteralPrefilter(kind='literal-set', literals=['cat', 'dog'], exact=True)" ]; then
+  echo "    [FAIL] Expected an exact literal-set prefilter for (cat|dog), but got '$set_debug'"
+  exit 1
+fi
+
+if [ "$none_debug" != "debug: prefilter: None" ]; then
+  echo "    [FAIL] Expected no prefilter for \\d+, but got '$none_debug'"
+  exit 1
+fi
+
+if [ "$literal_engine" != '"engine": "literal"' ]; then
+  echo "    [FAIL] Expected the literal engine for hello, but got '$literal_engine'"
+  exit 1
+fi
+
+expected=$(printf 'xERROR 9 refused\nERROR 42 timeout')
+if [ "$required_output" != "$expected" ] || [ "$required_stdin_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from the file and stdin, but got '$required_output' and '$required_stdin_output'"
+  exit 1
+fi
+
+expected=$(printf 'hello world\nsay hello')
+if [ "$literal_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from the literal engine, but got '$literal_output'"
+  exit 1
+fi
+
+expected=$(printf 'dog\ncat')
+if [ "$set_output" != "$expected" ]; then
+  echo "    [FAIL] Expected '$expected' from the literal-set engine, but got '$set_output'"
+  exit 1
+fi
+
+if [ "$escaped_output" != "1" ]; then
+  echo "    [FAIL] Expected '1' for the escaped literal a\\.b, but got '$escaped_output'"
+  exit 1
+fi
+
+echo "Test 40 passed."
+echo ""
+
 echo "All tests passed successfully!"
 echo ""
 